@@ -0,0 +1,141 @@
+import random
+from array import array
+
+
+class PieceAvailability:
+    """
+    Сколько известных пиров имеет каждый кусок.
+
+    Счётчики обновляются инкрементально при подключении пира, сообщении
+    Have и отключении. Куски-кандидаты (ещё не начатые и не пропускаемые)
+    разложены по корзинам с ключом (-приоритет, число пиров), поэтому
+    самый редкий кусок из имеющихся у пира находится просмотром нескольких
+    корзин, а не всех кусков и всех пиров. Внутри корзины кусок выбирается
+    случайно, чтобы клиенты не набрасывались на одни и те же куски.
+    """
+    SAMPLES = 8 # сколько случайных проб сделать в корзине до полного обхода
+
+    def __init__(self, total_pieces: int, rng: random.Random = None):
+        self.total_pieces = total_pieces
+        self.counts = array('H', bytes(2 * total_pieces))
+        self._random = rng or random.Random()
+        self._priority = {} # индекс кандидата -> приоритет
+        self._buckets = {} # (-приоритет, число пиров) -> _Bucket
+
+    def add_peer(self, bitfield):
+        for index in _set_bits(bitfield, self.total_pieces):
+            self._increment(index)
+
+    def remove_peer(self, bitfield):
+        for index in _set_bits(bitfield, self.total_pieces):
+            self._decrement(index)
+
+    def have(self, index: int):
+        self._increment(index)
+
+    def add_candidate(self, index: int, priority: int):
+        self.discard_candidate(index)
+        self._priority[index] = priority
+        key = (-priority, self.counts[index])
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket()
+        bucket.add(index)
+
+    def discard_candidate(self, index: int):
+        priority = self._priority.pop(index, None)
+        if priority is not None:
+            self._remove(-priority, self.counts[index], index)
+
+    def rarest(self, bitfield, skip=()):
+        """
+        Индекс самого приоритетного, а среди них самого редкого
+        кандидата, который есть в bitfield и не входит в skip, или None.
+        """
+        for key in sorted(self._buckets):
+            if key[1] == 0:
+                continue
+            items = self._buckets[key].items
+            size = len(items)
+            for _ in range(min(self.SAMPLES, size)):
+                index = items[self._random.randrange(size)]
+                if bitfield[index] and index not in skip:
+                    return index
+            start = self._random.randrange(size)
+            for i in range(size):
+                index = items[(start + i) % size]
+                if bitfield[index] and index not in skip:
+                    return index
+        return None
+
+    def _increment(self, index: int):
+        count = self.counts[index]
+        self.counts[index] = count + 1
+        priority = self._priority.get(index)
+        if priority is not None:
+            self._move(index, -priority, count, count + 1)
+
+    def _decrement(self, index: int):
+        count = self.counts[index]
+        if not count:
+            return
+        self.counts[index] = count - 1
+        priority = self._priority.get(index)
+        if priority is not None:
+            self._move(index, -priority, count, count - 1)
+
+    def _move(self, index, priority_key, old, new):
+        self._remove(priority_key, old, index)
+        key = (priority_key, new)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket()
+        bucket.add(index)
+
+    def _remove(self, priority_key, count, index):
+        key = (priority_key, count)
+        bucket = self._buckets[key]
+        bucket.remove(index)
+        if not bucket.items:
+            del self._buckets[key]
+
+
+class _Bucket:
+    # список для случайного выбора и словарь позиций для удаления за O(1)
+    __slots__ = ('items', 'positions')
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def add(self, index):
+        self.positions[index] = len(self.items)
+        self.items.append(index)
+
+    def remove(self, index):
+        position = self.positions.pop(index)
+        last = self.items.pop()
+        if last != index:
+            self.items[position] = last
+            self.positions[last] = position
+
+
+# номера единичных бит (старший бит первый) для каждого значения байта
+_BYTE_BITS = [tuple(bit for bit in range(8) if value & (0x80 >> bit))
+              for value in range(256)]
+
+
+def _set_bits(bitfield, limit: int):
+    # bitstring.BitArray перебирается по байтам через таблицу, это
+    # намного быстрее побитового доступа и findall
+    if hasattr(bitfield, 'tobytes'):
+        bits = (base + bit
+                for base, value in zip(range(0, limit, 8), bitfield.tobytes())
+                if value
+                for bit in _BYTE_BITS[value])
+    else:
+        bits = (i for i, bit in enumerate(bitfield) if bit)
+    for index in bits:
+        if index >= limit:
+            break
+        yield index
@@ -0,0 +1,1116 @@
+"""
+Замеры производительности. Запуск: python benchmarks.py decoder
+Без аргументов выполняются все замеры по очереди.
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+import timeit
+from hashlib import sha1
+
+from decoder import Decoder, Encoder, StreamEncoder, ViewDecoder
+from testutil import FakeTorrent, seed_server
+from torrent import PieceHashes, TorrentFile
+
+TORRENTS = ['RimWorld.torrent',
+            'random.torrent',
+            'windows_10_pro_64bit_fleshka.torrent']
+
+
+def _report(title, seconds, number, size=None):
+    line = '{title:<40} {ms:9.3f} ms'.format(
+        title=title, ms=seconds / number * 1000)
+    if size:
+        line += ' {mb:9.1f} MB/s'.format(mb=size * number / seconds / 2**20)
+    print(line)
+
+
+def bench_decoder(number=200):
+    """
+    Decoder против ViewDecoder на .torrent файлах из репозитория.
+    """
+    for filename in TORRENTS:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        assert Decoder(data).decode() == ViewDecoder(data).decode()
+        print(filename)
+        for title, func in [
+                ('Decoder', lambda: Decoder(data).decode()),
+                ('ViewDecoder', lambda: ViewDecoder(data).decode()),
+                ('ViewDecoder(copy=False)',
+                 lambda: ViewDecoder(data, copy=False).decode())]:
+            _report('  ' + title, timeit.timeit(func, number=number),
+                    number, len(data))
+
+
+def bench_metainfo(number=200):
+    """
+    Загрузка метаданных: декодирование и info_hash через повторный Encoder
+    против хэша по исходному диапазону байт info.
+    """
+    def encode_info(data):
+        meta_info = Decoder(data).decode()
+        return sha1(Encoder(meta_info[b'info']).encode()).digest()
+
+    def span_info(data):
+        decoder = ViewDecoder(data)
+        decoder.decode()
+        start, end = decoder.spans[b'info']
+        return sha1(decoder.view[start:end]).digest()
+
+    for filename in TORRENTS:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        assert encode_info(data) == span_info(data)
+        print(filename)
+        _report('  Decoder + Encoder',
+                timeit.timeit(lambda: encode_info(data), number=number),
+                number)
+        _report('  ViewDecoder + info span',
+                timeit.timeit(lambda: span_info(data), number=number),
+                number)
+
+
+def bench_encoder(number=200):
+    """
+    Encoder против StreamEncoder в память и в файловый sink.
+    """
+    for filename in TORRENTS:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        meta_info = Decoder(data).decode()
+        assert StreamEncoder().encode(meta_info) == data
+        print(filename)
+        for title, func in [
+                ('Encoder', lambda: Encoder(meta_info).encode()),
+                ('StreamEncoder', lambda: StreamEncoder().encode(meta_info)),
+                ('StreamEncoder(sink=BytesIO)',
+                 lambda: StreamEncoder(io.BytesIO()).encode(meta_info))]:
+            _report('  ' + title, timeit.timeit(func, number=number),
+                    number, len(data))
+
+
+
+def _fake_torrent(piece_count, piece_length=2**18):
+    # все куски из нулевых байт, поэтому у них одинаковый правильный хэш
+    return FakeTorrent([TorrentFile('bench.bin', piece_count * piece_length)],
+                       piece_length,
+                       PieceHashes(sha1(bytes(piece_length)).digest() *
+                                   piece_count))
+
+
+def bench_piece_manager():
+    """
+    Стоимость block_received на один блок при росте числа одновременно
+    скачиваемых кусков и ожидающих запросов.
+    """
+    from piece import PieceManager
+    from protocol import REQUEST_SIZE
+
+    block = bytes(REQUEST_SIZE)
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            for ongoing in [10, 100, 1000]:
+                manager = PieceManager(_fake_torrent(ongoing))
+                manager.add_peer('peer', [1] * ongoing)
+                requests = []
+                while True:
+                    request = manager.next_request('peer')
+                    if not request:
+                        break
+                    requests.append((request.piece, request.offset))
+                pending = len(manager.pending_blocks)
+
+                # последний блок каждого куска не отдаём, чтобы замерять
+                # только поиск блока, без проверки хэша и записи на диск
+                last = manager.torrent.piece_length - REQUEST_SIZE
+                received = [r for r in requests if r[1] != last]
+                start = time.perf_counter()
+                for index, offset in received:
+                    manager.block_received('peer', index, offset, block)
+                elapsed = time.perf_counter() - start
+                _report('  {0} pieces, {1} pending'.format(ongoing, pending),
+                        elapsed, len(received))
+                manager.close()
+        finally:
+            os.chdir(cwd)
+
+
+def bench_timeouts(number=1000):
+    """
+    Проверка просроченных запросов на каждый next_request: прежний
+    линейный обход pending_blocks против вершины кучи сроков.
+    """
+    from piece import PieceManager, _now
+
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            for pieces in [64, 640, 6400]:
+                manager = PieceManager(_fake_torrent(pieces))
+                manager.add_peer('peer', [1] * pieces)
+                while manager.next_request('peer'):
+                    pass
+                pending = len(manager.pending_blocks)
+                bitfield = manager.peers['peer']
+                now = _now()
+
+                def scan():
+                    for request in manager.pending_blocks.values():
+                        if bitfield[request.block.piece] and \
+                                request.added + manager.max_pending_time < now:
+                            return request
+
+                _report('  linear scan, {0} pending'.format(pending),
+                        timeit.timeit(scan, number=number), number)
+                _report('  deadline heap, {0} pending'.format(pending),
+                        timeit.timeit(lambda: manager._expire_requests(now),
+                                      number=number), number)
+                manager.close()
+        finally:
+            os.chdir(cwd)
+
+
+def _swarm(manager, rates, depth=4, latency=0.05, on_step=None,
+           bitfields=None):
+    """
+    Рой в модельном времени: пир с именем из rates отдаёт блоки по
+    очереди со своей скоростью (байт в секунду), у каждого в пути не
+    больше depth запросов.
+    bitfields - куски каждого пира, по умолчанию у всех всё.
+    on_step(now) вызывается после каждого блока.
+    Возвращает время завершения каждого куска и число принятых байт,
+    включая дубликаты, которые Cancel не успел остановить.
+    """
+    import heapq
+
+    events = [] # (время прихода, номер, пир, блок, начало передачи)
+    in_flight = {peer: 0 for peer in rates}
+    busy = {peer: 0.0 for peer in rates}
+    cancelled = {} # (пир, кусок, offset) -> когда Cancel дойдёт
+    finished = {}
+    received = 0
+    now = 0.0
+    sequence = 0
+
+    def fill(peer):
+        nonlocal sequence
+        while in_flight[peer] < depth:
+            block = manager.next_request(peer)
+            if not block:
+                break
+            start = max(now + latency, busy[peer])
+            busy[peer] = start + block.length / rates[peer]
+            in_flight[peer] += 1
+            sequence += 1
+            heapq.heappush(events, (busy[peer], sequence, peer, block, start))
+
+    def delivered(peer, block, start):
+        # Cancel помогает, только если дошёл до начала передачи
+        return cancelled.get((peer, block.piece, block.offset),
+                             start + 1) > start
+
+    pieces = manager.total_pieces
+    for peer in rates:
+        manager.add_peer(peer,
+                         bitfields[peer] if bitfields else [1] * pieces,
+                         lambda block, peer=peer: cancelled.setdefault(
+                             (peer, block.piece, block.offset),
+                             now + latency))
+    for peer in rates:
+        fill(peer)
+    while events and not manager.complete:
+        now, _, peer, block, start = heapq.heappop(events)
+        in_flight[peer] -= 1
+        if delivered(peer, block, start):
+            received += block.length
+            manager.block_received(peer, block.piece, block.offset,
+                                   bytes(block.length))
+            if block.piece in manager.have_pieces:
+                finished.setdefault(block.piece, now)
+        if on_step:
+            on_step(now)
+        for other in rates:
+            fill(other)
+    # что уже передаётся после завершения, тоже лишний трафик
+    for _, _, peer, block, start in events:
+        if delivered(peer, block, start):
+            received += block.length
+    return finished, received
+
+
+def bench_endgame(pieces=64):
+    """
+    Локальный рой в модельном времени: три быстрых пира и один в 20 раз
+    медленнее. Сравнивается, сколько длится хвост загрузки без эндшпиля
+    (endgame_copies=1) и с ним, и сколько лишних байт приходит.
+    """
+    from piece import PieceManager
+
+    rates = {'fast0': 2**21, 'fast1': 2**21, 'fast2': 2**21, 'slow': 2**21 / 20}
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            for copies in [1, 3]:
+                manager = PieceManager(_fake_torrent(pieces),
+                                       endgame_copies=copies)
+                finished, received = _swarm(manager, rates)
+                times = sorted(finished.values())
+                total = pieces * manager.torrent.piece_length
+                print('  endgame_copies={0}: done in {1:.2f} s, last 5% of '
+                      'pieces took {2:.2f} s, {3:.1f}% extra bytes'.format(
+                          copies, times[-1],
+                          times[-1] - times[int(len(times) * 0.95) - 1],
+                          (received - total) / total * 100))
+                manager.close()
+        finally:
+            os.chdir(cwd)
+
+
+def bench_memory(pieces=64, piece_length=4 * 2**20, peers=40):
+    """
+    Память под куски в модельном рое: у каждого из peers пиров свои
+    10% кусков (у первого все), четверть пиров в 8 раз медленнее.
+    Начатые куски висят в памяти, пока не докачаются; сравниваются
+    загрузка без предела и с бюджетом: пик зарезервированного, пик по
+    tracemalloc и время.
+    """
+    import random
+    import tracemalloc
+    from memory import MemoryBudget
+    from piece import PieceManager
+
+    rng = random.Random(1)
+    rates = {'peer{0}'.format(i): 2**18 if i % 4 else 2**15
+             for i in range(peers)}
+    bitfields = {peer: [int(rng.random() < 0.1) for _ in range(pieces)]
+                 for peer in rates}
+    first = next(iter(rates))
+    bitfields[first] = [1] * pieces # чтобы у каждого куска был источник
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            for title, limit in [('unlimited', 2**40), ('32 MiB', 32 * 2**20),
+                                 ('16 MiB', 16 * 2**20)]:
+                budget = MemoryBudget(limit)
+                manager = PieceManager(_fake_torrent(pieces, piece_length),
+                                       memory=budget)
+                tracemalloc.start()
+                finished, _ = _swarm(manager, rates, bitfields=bitfields)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print('  {0:<10} reserved peak {1:6.1f} MiB, traced peak '
+                      '{2:6.1f} MiB, done in {3:6.2f} s'.format(
+                          title, budget.peak / 2**20, peak / 2**20,
+                          max(finished.values())))
+                manager.close()
+        finally:
+            os.chdir(cwd)
+
+
+def bench_streaming(pieces=128, bitrate=2**20):
+    """
+    Просмотр во время загрузки в модельном времени: проигрыватель читает
+    bitrate байт в секунду с начала, как только первый кусок готов.
+    Время до первого байта и число остановок (кусок нужен, а его нет)
+    для обычного rarest-first и для окна после курсора чтения.
+    """
+    from piece import PieceManager
+
+    swarms = {
+        'even': {'peer{0}'.format(i): 2**19 for i in range(4)},
+        'one slow': dict({'peer{0}'.format(i): 2**19 for i in range(3)},
+                         slow=2**19 / 20),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            for name, rates in swarms.items():
+                for window in [0, 8]:
+                    manager = PieceManager(_fake_torrent(pieces))
+                    manager.stream_window = window
+                    manager.set_cursor(0)
+                    piece_time = manager.torrent.piece_length / bitrate
+                    state = {'cursor': 0, 'first': None, 'clock': None,
+                             'stalls': 0, 'stalled': False}
+
+                    def play(now):
+                        # проигрыватель доходит до куска к моменту clock
+                        while state['cursor'] < pieces and \
+                                manager.is_readable(state['cursor']):
+                            if state['first'] is None:
+                                state['first'] = state['clock'] = now
+                            elif state['clock'] + piece_time < now:
+                                state['clock'] = now # ждали кусок
+                            else:
+                                state['clock'] += piece_time
+                            state['cursor'] += 1
+                            state['stalled'] = False
+                            manager.set_cursor(min(state['cursor'],
+                                                   pieces - 1))
+                        if state['first'] is not None and \
+                                state['cursor'] < pieces and \
+                                not state['stalled'] and \
+                                state['clock'] + piece_time < now:
+                            state['stalls'] += 1
+                            state['stalled'] = True
+
+                    finished, _ = _swarm(manager, rates, on_step=play)
+                    print('  {0:<9} window={1:<2} first byte {2:6.2f} s, '
+                          '{3:3d} stalls, done in {4:6.2f} s'.format(
+                              name, window, state['first'], state['stalls'],
+                              max(finished.values())))
+                    manager.close()
+        finally:
+            os.chdir(cwd)
+
+
+def bench_pipeline(size=2 * 2**20, rtt=0.05, bandwidth=8 * 2**20):
+    """
+    Скорость загрузки с локального пира с большой задержкой: ответ на
+    каждый Request приходит через rtt секунд, пир отдаёт не больше
+    bandwidth байт в секунду. Очередь из одного запроса против
+    адаптивной глубины с разными верхними границами.
+    """
+    import asyncio
+    import contextlib
+    from piece import PieceManager
+    from protocol import ConnectionToPeer
+
+    info_hash = sha1(b'pipeline').digest()
+    piece_length = 2**18
+    pieces = size // piece_length
+
+    connections = []
+
+    serve = seed_server(info_hash, pieces, connections, rtt, bandwidth)
+
+    async def download(max_depth):
+        manager = PieceManager(_fake_torrent(pieces, piece_length),
+                               max_queue_depth=max_depth)
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        queue = asyncio.Queue()
+        queue.put_nowait(server.sockets[0].getsockname()[:2])
+        start = time.perf_counter()
+        peer = ConnectionToPeer(queue, info_hash, b'-PC0001-000000000000',
+                                manager, lambda **kwargs:
+                                manager.block_received(**kwargs))
+        while not manager.complete:
+            await asyncio.sleep(0.005)
+        elapsed = time.perf_counter() - start
+        depth = min(manager.timers[peer.remote_id].depth, max_depth)
+        peer.stop()
+        server.close()
+        for writer in connections:
+            writer.close()
+        await asyncio.sleep(0.01) # serve() завершается по закрытию
+        manager.close()
+        return elapsed, depth
+
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            for max_depth in [1, 16, 128]:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    elapsed, depth = asyncio.run(download(max_depth))
+                print('  max_queue_depth={0:<4} {1:7.2f} s {2:8.2f} MB/s, '
+                      'final depth {3}'.format(max_depth, elapsed,
+                                               size / elapsed / 2**20, depth))
+        finally:
+            os.chdir(cwd)
+
+
+def _send_stream(port, blocks):
+    # выполняется в отдельном процессе: отдаёт блоки как можно быстрее
+    import socket
+    import struct
+    from protocol import REQUEST_SIZE
+
+    payload = bytes(REQUEST_SIZE)
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        batch = b''.join(
+            struct.pack('>IbII', 9 + REQUEST_SIZE, 7, i // 64,
+                        i % 64 * REQUEST_SIZE) + payload for i in range(64))
+        for _ in range(blocks // 64):
+            sock.sendall(batch)
+
+
+def bench_receive(size=512 * 2**20):
+    """
+    Приём потока блоков по 16 KiB от пира в отдельном процессе:
+    StreamReader с разбором StreamOfPeerIteratoration и копированием
+    блока в буфер куска против PeerProtocol, который читает блок прямо в
+    буфер куска (read_ahead=0) или дочитывает в него хвост блока после
+    чтения вперёд на 64 и 256 KiB. Время процессора - только приёмника.
+    """
+    import asyncio
+    import contextlib
+    import multiprocessing
+    from protocol import PeerProtocol, StreamOfPeerIteratoration, \
+        REQUEST_SIZE
+
+    blocks = size // REQUEST_SIZE
+    pieces = [bytearray(64 * REQUEST_SIZE) for _ in range(blocks // 64)]
+
+    def block_buffer(index, begin, length):
+        return memoryview(pieces[index])[begin:begin + length]
+
+    async def receive(mode):
+        done = asyncio.get_running_loop().create_future()
+
+        async def stream_reader(reader, writer):
+            async for message in StreamOfPeerIteratoration(reader):
+                target = block_buffer(message.index, message.begin,
+                                      len(message.block))
+                target[:] = message.block
+            done.set_result(None)
+
+        if mode is None:
+            server = await asyncio.start_server(stream_reader,
+                                                '127.0.0.1', 0)
+        else:
+            async def consume(protocol):
+                async for message in protocol:
+                    if message.block.obj is not pieces[message.index]:
+                        raise AssertionError('block was copied')
+                done.set_result(None)
+
+            def factory():
+                protocol = PeerProtocol(block_buffer)
+                protocol._handshake = False
+                protocol.read_ahead = mode
+                asyncio.ensure_future(consume(protocol))
+                return protocol
+
+            server = await asyncio.get_running_loop().create_server(
+                factory, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        sender = multiprocessing.Process(target=_send_stream,
+                                         args=(port, blocks))
+        start = time.perf_counter()
+        cpu = time.process_time()
+        sender.start()
+        await done
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        sender.join()
+        server.close()
+        return elapsed, cpu
+
+    for title, mode in [('StreamReader', None),
+                        ('PeerProtocol, read ahead 0', 0),
+                        ('PeerProtocol, read ahead 64 KiB', 2**16),
+                        ('PeerProtocol, read ahead 256 KiB', 2**18)]:
+        with contextlib.redirect_stdout(io.StringIO()): # декодеры печатают
+            elapsed, cpu = asyncio.run(receive(mode))
+        print('  {0:<32} {1:7.1f} MB/s, {2:5.2f} ms CPU per MiB'
+              .format(title, size / elapsed / 2**20,
+                      cpu / (size / 2**20) * 1000))
+
+
+def _leech(port, blocks, piece_blocks, window=64):
+    # выполняется в отдельном процессе: держит window запросов в пути и
+    # считает принятые байты, ответы не разбирает
+    import socket
+    import struct
+    from protocol import REQUEST_SIZE
+
+    message = 13 + REQUEST_SIZE
+    buffer = bytearray(2**20)
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sent = received = 0
+        while received < blocks * message:
+            wanted = min(blocks, received // message + window)
+            if sent < wanted:
+                sock.sendall(b''.join(
+                    struct.pack('>IbIII', 13, 6, i // piece_blocks,
+                                i % piece_blocks * REQUEST_SIZE, REQUEST_SIZE)
+                    for i in range(sent, wanted)))
+                sent = wanted
+            received += sock.recv_into(buffer)
+
+
+def bench_upload(size=128 * 2**20, piece_length=2**20):
+    """
+    Раздача блоков по 16 KiB пиру в отдельном процессе, который держит 64
+    запроса в пути: холодные куски через preadv в буфер блока или через
+    os.sendfile, горячие - из кэша чтения. Время процессора - только
+    раздающего.
+    """
+    import asyncio
+    import contextlib
+    import multiprocessing
+    from piece import PieceManager
+    from protocol import OutgoingQueue, REQUEST_SIZE, Request, \
+        StreamOfPeerIteratoration
+
+    pieces = size // piece_length
+    piece_blocks = piece_length // REQUEST_SIZE
+    chunk = os.urandom(piece_length)
+
+    async def upload(manager, sendfile):
+        done = asyncio.get_running_loop().create_future()
+
+        async def seed(reader, writer):
+            uploader = manager.uploader('leecher', OutgoingQueue(writer))
+            uploader.sendfile = sendfile
+            async for message in StreamOfPeerIteratoration(reader):
+                if type(message) is Request:
+                    uploader.request(message.index, message.begin,
+                                     message.length)
+            uploader.close()
+            done.set_result(None)
+
+        server = await asyncio.start_server(seed, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        leecher = multiprocessing.Process(
+            target=_leech, args=(port, pieces * piece_blocks, piece_blocks))
+        start = time.perf_counter()
+        cpu = time.process_time()
+        leecher.start()
+        await done
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        leecher.join()
+        server.close()
+        return elapsed, cpu
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(root)
+        try:
+            with open('bench.bin', 'wb') as f:
+                for _ in range(pieces):
+                    f.write(chunk)
+            for title, sendfile, cached in [('preadv', False, False),
+                                            ('sendfile', True, False),
+                                            ('read cache', True, True)]:
+                manager = PieceManager(_fake_torrent(pieces, piece_length),
+                                       read_cache=size if cached else 0)
+                manager.have_pieces.update(range(pieces))
+                if cached:
+                    for index in range(pieces):
+                        manager.read_cache.put(index, chunk)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    elapsed, cpu = asyncio.run(upload(manager, sendfile))
+                manager.close()
+                print('  {0:<12} {1:7.1f} MB/s, {2:5.2f} ms CPU per MiB'
+                      .format(title, size / elapsed / 2**20,
+                              cpu / (size / 2**20) * 1000))
+        finally:
+            os.chdir(cwd)
+
+
+def bench_choker(peers=40, seconds=1800, slots=4):
+    """
+    Рой в модельном времени: каждый из peers пиров отдаёт нам со своей
+    скоростью (от 5 до 200 KB/s), но только пока мы его не блокируем.
+    Средняя скорость скачивания с Choker против slots случайных пиров,
+    сменяемых раз в CHOKE_INTERVAL.
+    """
+    import random
+    from types import SimpleNamespace
+    from choker import CHOKE_INTERVAL, Choker
+    from stats import RateMeter, TransferStats
+
+    class Connection:
+        def __init__(self, rate):
+            self.rate = rate
+            self.stats = TransferStats()
+            self.stats.download_rate = RateMeter(now=0)
+            self.peer_interested = True
+            self.peer_choked = True
+
+        def choke_peer(self):
+            self.peer_choked = True
+
+        def unchoke_peer(self):
+            self.peer_choked = False
+
+    def swarm(reciprocate, seed):
+        rng = random.Random(seed)
+        connections = [Connection(rng.uniform(5000, 200000))
+                       for _ in range(peers)]
+        best = sum(sorted(c.rate for c in connections)[-slots:])
+        choker = Choker(SimpleNamespace(complete=False), slots, rng=rng)
+        for connection in connections:
+            choker.add(connection)
+        downloaded = 0
+        for second in range(seconds):
+            if second % CHOKE_INTERVAL == 0:
+                if reciprocate:
+                    choker.rechoke(second)
+                else:
+                    chosen = rng.sample(connections, slots)
+                    for connection in connections:
+                        connection.peer_choked = connection not in chosen
+            for connection in connections:
+                if not connection.peer_choked:
+                    connection.stats.payload_in(connection.rate, second + 1)
+                    downloaded += connection.rate
+        return downloaded / seconds, best
+
+    for title, reciprocate in [('random slots', False),
+                               ('tit-for-tat', True)]:
+        results = [swarm(reciprocate, seed) for seed in range(5)]
+        rate = sum(r[0] for r in results) / len(results)
+        best = sum(r[1] for r in results) / len(results)
+        print('  {0:<13} {1:6.1f} KB/s, {2:3.0f} % of the {3} fastest peers'
+              .format(title, rate / 1000, rate / best * 100, slots))
+
+
+def bench_outgoing(messages=200000, burst=32):
+    """
+    Отправка мелких сообщений (Cancel, 17 байт) пачками по burst за
+    проход цикла событий на локальный приёмник: write() и drain() после
+    каждого сообщения против OutgoingQueue.
+    """
+    import asyncio
+    from protocol import Cancel, OutgoingQueue
+
+    data = Cancel(1, 2).encode()
+
+    async def send(queued):
+        done = asyncio.get_running_loop().create_future()
+
+        async def sink(reader, writer):
+            while await reader.read(2**16):
+                pass
+            writer.close()
+            done.set_result(None)
+
+        server = await asyncio.start_server(sink, '127.0.0.1', 0)
+        _, writer = await asyncio.open_connection(
+            *server.sockets[0].getsockname()[:2])
+        outbox = OutgoingQueue(writer)
+        start = time.perf_counter()
+        for _ in range(messages // burst):
+            for _ in range(burst):
+                if queued:
+                    outbox.send(data)
+                else:
+                    writer.write(data)
+                    await writer.drain()
+            if queued:
+                await outbox.wait_writable()
+            await asyncio.sleep(0) # следующий проход цикла
+        outbox.flush()
+        await writer.drain()
+        elapsed = time.perf_counter() - start
+        writer.close()
+        await done
+        server.close()
+        return elapsed, outbox.writes if queued else messages
+
+    for title, queued in [('write + drain', False), ('OutgoingQueue', True)]:
+        elapsed, writes = asyncio.run(send(queued))
+        print('  {0:<14} {1:9.0f} messages/s, {2:6d} writes'.format(
+            title, messages / elapsed, writes))
+
+
+def bench_framing(rounds=200):
+    """
+    Разбор записанного потока сообщений: BitField, затем пачки Have
+    вперемешку с блоками по 16 KiB. Поток отдаётся кусками по 10 KiB и
+    по 256 KiB, как из сокета; считается, сколько сообщений в секунду
+    проходит через StreamOfPeerIteratoration.
+    """
+    import asyncio
+    import contextlib
+    from protocol import BitField, Have, Piece, StreamOfPeerIteratoration, \
+        REQUEST_SIZE, Unchoke
+
+    block = bytes(REQUEST_SIZE)
+    parts = [BitField(bytes(128)).encode(), Unchoke().encode()]
+    for i in range(rounds):
+        parts.extend(Have(i * 10 + j).encode() for j in range(10))
+        parts.extend(Piece(i, j * REQUEST_SIZE, block).encode()
+                     for j in range(4))
+    stream = b''.join(parts)
+    count = len(parts)
+
+    class Reader:
+        def __init__(self, chunk):
+            self.chunk = chunk
+            self.position = 0
+
+        async def read(self, size):
+            # отдаёт chunk байт, даже если просили меньше: так выглядит
+            # чтение после долгой паузы цикла или с большим буфером
+            data = stream[self.position:
+                          self.position + max(size, self.chunk)]
+            self.position += len(data)
+            return data
+
+    async def run(chunk):
+        received = 0
+        async for _ in StreamOfPeerIteratoration(Reader(chunk)):
+            received += 1
+        return received
+
+    for chunk in [10 * 1024, 256 * 1024]:
+        with contextlib.redirect_stdout(io.StringIO()): # декодеры печатают
+            start = time.perf_counter()
+            received = asyncio.run(run(chunk))
+            elapsed = time.perf_counter() - start
+        assert received == count, received
+        print('  {count} messages, {size:.1f} MB in {chunk:3d} KiB reads: '
+              '{rate:8.0f} messages/s, {mb:7.1f} MB/s'.format(
+                  count=count, size=len(stream) / 1e6, chunk=chunk // 1024,
+                  rate=count / elapsed, mb=len(stream) / elapsed / 1e6))
+
+
+def bench_stats(number=10**6):
+    """
+    Цена учёта на одно сообщение: счётчики соединения вместе со
+    счётчиками торрента, и запрос сглаженной скорости.
+    """
+    from stats import TransferStats
+
+    torrent = TransferStats()
+    peer = TransferStats(torrent)
+    for title, call in [('wire_in', lambda: peer.wire_in(16397)),
+                        ('payload_in', lambda: peer.payload_in(16384)),
+                        ('download_rate.rate()', peer.download_rate.rate)]:
+        seconds = timeit.timeit(call, number=number)
+        print('{title:<40} {ns:9.0f} ns'.format(
+            title=title, ns=seconds / number * 1e9))
+
+
+def bench_picker(peers=200):
+    """
+    Выбор самого редкого куска: прежний перебор всех недостающих кусков
+    и всех пиров против корзин PieceAvailability.
+    """
+    import random
+    import bitstring
+    from availability import PieceAvailability
+
+    def scan_rarest(missing, bitfields, bitfield):
+        counts = {}
+        for index in missing:
+            if not bitfield[index]:
+                continue
+            counts[index] = sum(1 for b in bitfields if b[index])
+        return min(counts, key=counts.get)
+
+    rng = random.Random(0)
+    for pieces in [10000, 100000]:
+        bitfields = [bitstring.BitArray(bytes=rng.randbytes(pieces // 8))
+                     for _ in range(peers)]
+        availability = PieceAvailability(pieces)
+        start = time.perf_counter()
+        for index in range(pieces):
+            availability.add_candidate(index, 1)
+        for bitfield in bitfields:
+            availability.add_peer(bitfield)
+        _report('  {0} pieces: build, {1} peers'.format(pieces, peers),
+                time.perf_counter() - start, 1)
+
+        number = 1000
+        start = time.perf_counter()
+        for i in range(number):
+            index = availability.rarest(bitfields[i % peers])
+            availability.discard_candidate(index)
+        _report('  {0} pieces: PieceAvailability.rarest'.format(pieces),
+                time.perf_counter() - start, number)
+
+        if pieces <= 10000:
+            missing = list(range(pieces))
+            _report('  {0} pieces: scan of pieces x peers'.format(pieces),
+                    timeit.timeit(lambda: scan_rarest(missing, bitfields,
+                                                      bitfields[0]),
+                                  number=1), 1)
+
+
+def bench_blocks(size=60 * 2**30, piece_length=2**18):
+    """
+    Память и время создания PieceManager для очень большого торрента.
+    """
+    import gc
+    import tracemalloc
+    from piece import PieceManager
+
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            torrent = _fake_torrent(size // piece_length, piece_length)
+            gc.collect()
+            tracemalloc.start()
+            start = time.perf_counter()
+            manager = PieceManager(torrent)
+            elapsed = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('  {gb} GiB, {pieces} pieces: {s:.2f} s, {mb:.1f} MiB '
+                  '(peak {peak:.1f} MiB)'.format(
+                      gb=size // 2**30, pieces=len(torrent.pieces), s=elapsed,
+                      mb=current / 2**20, peak=peak / 2**20))
+            manager.close()
+        finally:
+            os.chdir(cwd)
+
+
+def bench_piece_buffer(number=5):
+    """
+    Сборка и проверка куска: прежние отдельные bytes на блок с
+    b''.join для хэша и для записи против буфера куска с
+    инкрементальным SHA1. Каждый блок - новый объект, как при приёме.
+    """
+    import random
+    import tracemalloc
+    from piece import Piece
+    from protocol import REQUEST_SIZE
+
+    def joined(payload, offsets, piece_hash):
+        received = {}
+        for offset in offsets:
+            received[offset] = payload[offset:offset + REQUEST_SIZE]
+        ordered = [received[offset] for offset in sorted(received)]
+        assert sha1(b''.join(ordered)).digest() == piece_hash
+        return len(b''.join(ordered)) # вторая склейка, как в _write
+
+    def buffered(payload, offsets, piece_hash):
+        piece = Piece(0, len(payload), piece_hash)
+        for offset in offsets:
+            piece.block_received(offset, payload[offset:offset + REQUEST_SIZE])
+        assert piece.is_hash_matching()
+        return len(piece.data)
+
+    rng = random.Random(0)
+    for length in [4 * 2**20, 16 * 2**20]:
+        payload = rng.randbytes(length)
+        piece_hash = sha1(payload).digest()
+        offsets = list(range(0, length, REQUEST_SIZE))
+        # почти по порядку, как обычно приходят блоки от нескольких пиров
+        for i in range(0, len(offsets), 4):
+            window = offsets[i:i + 4]
+            rng.shuffle(window)
+            offsets[i:i + 4] = window
+        print('{0} MiB piece'.format(length // 2**20))
+        for title, func in [('blocks + join', joined),
+                            ('buffer + incremental sha1', buffered)]:
+            elapsed = timeit.timeit(
+                lambda: func(payload, offsets, piece_hash), number=number)
+            tracemalloc.start()
+            func(payload, offsets, piece_hash)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('  {title:<38} {ms:9.3f} ms {mb:9.1f} MiB peak'.format(
+                title=title, ms=elapsed / number * 1000, mb=peak / 2**20))
+
+
+def bench_writer(pieces=64, piece_length=4 * 2**20):
+    """
+    Задержка цикла событий во время пачки записей: синхронная запись
+    из цикла против StorageWriter. Таймер каждую миллисекунду отмечает,
+    насколько он опоздал.
+    """
+    import asyncio
+    from storage import FileStorage, StorageWriter
+
+    payload = bytes(piece_length)
+
+    async def measure(write, finish):
+        lags = []
+        done = False
+
+        async def ticker():
+            loop = asyncio.get_running_loop()
+            while not done:
+                expected = loop.time() + 0.001
+                await asyncio.sleep(0.001)
+                lags.append(loop.time() - expected)
+
+        task = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        for index in range(pieces):
+            await write(index * piece_length)
+            await asyncio.sleep(0) # как между сообщениями от пиров
+        await finish()
+        elapsed = time.perf_counter() - start
+        done = True
+        await task
+        lags.sort()
+        return elapsed, lags[len(lags) // 2], lags[-1]
+
+    with tempfile.TemporaryDirectory() as directory:
+        for title in ['os.pwrite in the loop', 'StorageWriter']:
+            storage = FileStorage(
+                [TorrentFile('data', pieces * piece_length)], directory)
+            writer = StorageWriter(storage)
+
+            async def sync_write(offset):
+                storage.write(offset, payload)
+
+            async def async_write(offset):
+                writer.submit(offset, payload)
+                await writer.wait_writable()
+
+            async def sync_finish():
+                pass
+
+            async def async_finish():
+                while writer.queued:
+                    await asyncio.sleep(0.001)
+
+            if title == 'StorageWriter':
+                result = asyncio.run(measure(async_write, async_finish))
+            else:
+                result = asyncio.run(measure(sync_write, sync_finish))
+            writer.close()
+            storage.close()
+            print('  {title:<38} {s:7.2f} s, loop lag median {median:.2f} ms,'
+                  ' max {max:.2f} ms'.format(
+                      title=title, s=result[0], median=result[1] * 1000,
+                      max=result[2] * 1000))
+
+
+def bench_hashing(pieces=32, piece_length=16 * 2**20):
+    """
+    Проверка хэшей готовых кусков: в цикле событий, в пуле потоков и в
+    пуле процессов. Блоки куска пришли не по порядку, поэтому хэшируется
+    весь кусок. Таймер каждую миллисекунду отмечает, насколько он опоздал.
+    """
+    import asyncio
+    from hasher import PieceHasher
+    from piece import Block, Piece
+
+    data = os.urandom(piece_length)
+    piece = Piece(0, piece_length, sha1(data).digest())
+    piece.buffer = bytearray(data)
+    piece.status[:] = bytes([Block.Retrieved]) * piece.block_count
+
+    async def measure(hasher):
+        lags = []
+        verified = []
+        done = False
+
+        async def ticker():
+            loop = asyncio.get_running_loop()
+            while not done:
+                expected = loop.time() + 0.001
+                await asyncio.sleep(0.001)
+                lags.append(loop.time() - expected)
+
+        task = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        for _ in range(pieces):
+            # буфер общий, но хэш каждый раз считается заново
+            piece._sha = sha1()
+            piece._hashed = 0
+            hasher.submit(piece, lambda p, matches: verified.append(matches))
+            await asyncio.sleep(0) # как между сообщениями от пиров
+        while len(verified) < pieces:
+            await asyncio.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        done = True
+        await task
+        assert all(verified)
+        lags.sort()
+        return elapsed, lags[len(lags) // 2], lags[-1]
+
+    for title, hasher in [('in the loop', PieceHasher(0)),
+                          ('2 threads', PieceHasher(2)),
+                          ('2 processes', PieceHasher(2, processes=True))]:
+        elapsed, median, worst = asyncio.run(measure(hasher))
+        hasher.close()
+        print('  {title:<12} {rate:7.1f} MB/s, loop lag median {median:6.2f}'
+              ' ms, max {max:7.2f} ms'.format(
+                  title=title, rate=pieces * piece_length / elapsed / 1e6,
+                  median=median * 1000, max=worst * 1000))
+
+
+def bench_recheck(size=512 * 2**20, piece_length=2**20):
+    """
+    Проверка уже скачанных данных: последовательное чтение кусков в
+    одном процессе против recheck() через mmap и пул процессов.
+    """
+    from recheck import recheck
+
+    block = os.urandom(piece_length)
+    count = size // piece_length
+    hashes = sha1(block).digest() * count
+    with tempfile.TemporaryDirectory() as directory:
+        files = []
+        for i in range(4):
+            name = 'part{0}'.format(i)
+            with open(os.path.join(directory, name), 'wb') as f:
+                for _ in range(count // 4):
+                    f.write(block)
+            files.append(TorrentFile(name, size // 4))
+
+        def read_serial():
+            valid = 0
+            for f in files:
+                with open(os.path.join(directory, f.name), 'rb') as data:
+                    for i in range(f.length // piece_length):
+                        if sha1(data.read(piece_length)).digest() == \
+                                hashes[i * 20:i * 20 + 20]:
+                            valid += 1
+            assert valid == count
+
+        def check(workers):
+            assert len(recheck(files, piece_length, hashes, directory,
+                               workers=workers)) == count
+
+        _report('read + sha1, one process', timeit.timeit(
+            read_serial, number=1), 1, size)
+        _report('recheck, 1 worker', timeit.timeit(
+            lambda: check(1), number=1), 1, size)
+        _report('recheck, {0} workers'.format(os.cpu_count()), timeit.timeit(
+            lambda: check(None), number=1), 1, size)
+
+
+BENCHMARKS = {
+    'decoder': bench_decoder,
+    'metainfo': bench_metainfo,
+    'encoder': bench_encoder,
+    'piece_manager': bench_piece_manager,
+    'timeouts': bench_timeouts,
+    'endgame': bench_endgame,
+    'streaming': bench_streaming,
+    'memory': bench_memory,
+    'pipeline': bench_pipeline,
+    'receive': bench_receive,
+    'stats': bench_stats,
+    'framing': bench_framing,
+    'outgoing': bench_outgoing,
+    'choker': bench_choker,
+    'upload': bench_upload,
+    'picker': bench_picker,
+    'blocks': bench_blocks,
+    'piece_buffer': bench_piece_buffer,
+    'writer': bench_writer,
+    'recheck': bench_recheck,
+    'hashing': bench_hashing,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run, all by default: ' +
+                             ', '.join(BENCHMARKS))
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: ' + name)
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
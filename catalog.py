@@ -0,0 +1,175 @@
+"""
+Каталог .torrent файлов: метаданные разбираются параллельно в пуле
+процессов и сохраняются в локальный индекс SQLite. При повторном
+сканировании файлы с неизменившимся mtime не перечитываются.
+
+python catalog.py [--db catalog.sqlite] scan <каталог>
+python catalog.py [--db catalog.sqlite] lookup <info_hash в hex>
+"""
+import argparse
+import logging
+import os
+import sqlite3
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+
+from decoder import ViewDecoder
+
+DEFAULT_DB = 'catalog.sqlite'
+
+CatalogEntry = namedtuple('CatalogEntry', [
+    'path', 'mtime', 'info_hash', 'name', 'total_size', 'piece_length',
+    'piece_count', 'announce'])
+
+ScanResult = namedtuple('ScanResult', ['scanned', 'skipped', 'failed',
+                                       'removed'])
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS torrents (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    info_hash BLOB NOT NULL,
+    name TEXT NOT NULL,
+    total_size INTEGER NOT NULL,
+    piece_length INTEGER NOT NULL,
+    piece_count INTEGER NOT NULL,
+    announce TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS torrents_info_hash ON torrents (info_hash);
+'''
+
+
+class Catalog:
+
+    def __init__(self, db_path: str = DEFAULT_DB):
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(_SCHEMA)
+
+    def scan(self, directory: str, workers: int = None) -> ScanResult:
+        """
+        Индексирует все .torrent файлы в directory (рекурсивно). Записи
+        удалённых с диска файлов из этого каталога убираются из индекса,
+        как и записи файлов, которые изменились и больше не читаются.
+        """
+        directory = os.path.abspath(directory)
+        prefix = os.path.join(directory, '')
+        known = {path: mtime for path, mtime in self.db.execute(
+            'SELECT path, mtime FROM torrents WHERE substr(path, 1, ?) = ?',
+            (len(prefix), prefix))}
+
+        changed = []
+        found = set()
+        for path, mtime in _find_torrents(directory):
+            found.add(path)
+            if known.get(path) != mtime:
+                changed.append((path, mtime))
+        skipped = len(found) - len(changed)
+
+        failed = []
+        rows = []
+        if changed:
+            workers = workers or os.cpu_count() or 1
+            chunksize = max(1, len(changed) // (4 * workers))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for (path, _), entry in zip(changed, pool.map(
+                        _read_entry, changed, chunksize=chunksize)):
+                    if entry:
+                        rows.append(entry)
+                    else:
+                        failed.append(path)
+
+        removed = [(path,) for path in known if path not in found]
+        stale = [(path,) for path in failed if path in known] # прежняя запись уже не про этот файл
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO torrents VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                rows)
+            self.db.executemany('DELETE FROM torrents WHERE path = ?',
+                                removed + stale)
+        return ScanResult(len(rows), skipped, len(failed), len(removed))
+
+    def lookup(self, info_hash: bytes) -> [CatalogEntry]:
+        """
+        Все проиндексированные файлы с данным info_hash.
+        """
+        return [CatalogEntry(*row) for row in self.db.execute(
+            'SELECT * FROM torrents WHERE info_hash = ?', (info_hash,))]
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM torrents').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+def _find_torrents(directory):
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            if filename.endswith('.torrent'):
+                path = os.path.join(root, filename)
+                yield path, os.stat(path).st_mtime
+
+
+def _read_entry(job) -> CatalogEntry:
+    # выполняется в процессе пула, поэтому функция модульного уровня
+    path, mtime = job
+    try:
+        with open(path, 'rb') as f:
+            decoder = ViewDecoder(f.read(), copy=False)
+        meta_info = decoder.decode()
+        start, end = decoder.spans[b'info']
+        info = meta_info[b'info']
+
+        if b'files' in info:
+            total_size = sum(f[b'length'] for f in info[b'files'])
+        else:
+            total_size = info[b'length']
+        announce = []
+        if b'announce' in meta_info:
+            announce.append(bytes(meta_info[b'announce']).decode('utf-8'))
+        for tier in meta_info.get(b'announce-list', []):
+            for url in tier:
+                url = bytes(url).decode('utf-8')
+                if url not in announce:
+                    announce.append(url)
+
+        return CatalogEntry(
+            path, mtime, sha1(decoder.view[start:end]).digest(),
+            bytes(info[b'name']).decode('utf-8', 'replace'), total_size,
+            info[b'piece length'], len(info[b'pieces']) // 20,
+            '\n'.join(announce))
+    except Exception as e:
+        logging.warning('Unable to read {path}: {error}'.format(
+            path=path, error=e))
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default=DEFAULT_DB,
+                        help='the SQLite index file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    scan = commands.add_parser('scan', help='index a directory of .torrent')
+    scan.add_argument('directory')
+    scan.add_argument('--workers', type=int, default=None)
+    lookup = commands.add_parser('lookup', help='find torrents by info_hash')
+    lookup.add_argument('info_hash', help='hex encoded info_hash')
+    args = parser.parse_args()
+
+    catalog = Catalog(args.db)
+    if args.command == 'scan':
+        result = catalog.scan(args.directory, args.workers)
+        print('Scanned: {0}, unchanged: {1}, failed: {2}, removed: {3}'
+              .format(*result))
+    else:
+        for entry in catalog.lookup(bytes.fromhex(args.info_hash)):
+            print('{path}\n  {name}, {size} bytes, {count} pieces of {length}'
+                  .format(path=entry.path, name=entry.name,
+                          size=entry.total_size, count=entry.piece_count,
+                          length=entry.piece_length))
+    catalog.close()
+
+
+if __name__ == '__main__':
+    main()
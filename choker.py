@@ -0,0 +1,111 @@
+"""
+Кому из пиров мы отдаём данные (tit-for-tat).
+"""
+import asyncio
+import random
+import time
+
+UPLOAD_SLOTS = 4 # сколько заинтересованных пиров раздача держит разблокированными
+CHOKE_INTERVAL = 10 # с, как часто пересматривать разблокированных
+OPTIMISTIC_INTERVAL = 30 # с, как часто менять оптимистично разблокированного
+
+
+class Choker:
+    """
+    Раз в interval секунд разблокирует slots - 1 заинтересованных пиров
+    с наибольшей скоростью: пока качаем - скоростью, с которой они отдают
+    нам, на раздаче - с которой забирают у нас. Остальные блокируются.
+
+    Ещё один слот отдаётся случайному заблокированному пиру и меняется
+    раз в optimistic_interval секунд (optimistic unchoke): так находятся
+    пиры, которые ответят взаимностью, а новые пиры получают первые куски.
+
+    Соединения должны уметь peer_interested, peer_choked, choke_peer(),
+    unchoke_peer() и иметь stats с download_rate и upload_rate.
+    """
+    def __init__(self, piece_manager, slots: int = UPLOAD_SLOTS,
+                 interval: float = CHOKE_INTERVAL,
+                 optimistic_interval: float = OPTIMISTIC_INTERVAL,
+                 rng: random.Random = None):
+        """
+        :param piece_manager: по его complete выбирается, какую скорость
+                              сравнивать
+        :param rng: источник случайности для оптимистичного слота
+        """
+        self.piece_manager = piece_manager
+        self.slots = slots
+        self.interval = interval
+        self.optimistic_interval = optimistic_interval
+        self.rng = rng or random.Random()
+        self.connections = [] # соединения, прошедшие рукопожатие
+        self.optimistic = None # оптимистично разблокированное соединение
+        self._optimistic_since = None
+        self._task = None
+
+    def add(self, connection):
+        if connection not in self.connections:
+            self.connections.append(connection)
+
+    def remove(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+        if self.optimistic is connection:
+            self.optimistic = None
+
+    def interested(self, connection):
+        """
+        Пир стал заинтересован: если есть свободный слот, не ждём
+        следующего пересмотра
+        """
+        unchoked = sum(1 for c in self.connections
+                       if c.peer_interested and not c.peer_choked)
+        if connection.peer_choked and unchoked < self.slots:
+            connection.unchoke_peer()
+
+    def rechoke(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+        interested = [c for c in self.connections if c.peer_interested]
+        if self.piece_manager.complete:
+            rate = lambda c: c.stats.upload_rate.rate(now)
+        else:
+            rate = lambda c: c.stats.download_rate.rate(now)
+        # при равных скоростях первыми остаются уже разблокированные
+        ranked = sorted(interested, key=lambda c: (rate(c), not c.peer_choked),
+                        reverse=True)
+        regular = ranked[:max(self.slots - 1, 0)]
+
+        if self.optimistic not in interested or self.optimistic in regular or \
+                now - self._optimistic_since >= self.optimistic_interval:
+            candidates = [c for c in interested
+                          if c not in regular and c is not self.optimistic]
+            if not candidates and self.optimistic in interested and \
+                    self.optimistic not in regular:
+                candidates = [self.optimistic] # сменить не на кого
+            self.optimistic = self.rng.choice(candidates) \
+                if candidates else None
+            self._optimistic_since = now
+
+        unchoke = set(regular)
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+        for connection in self.connections:
+            if connection in unchoke:
+                if connection.peer_choked:
+                    connection.unchoke_peer()
+            elif not connection.peer_choked:
+                connection.choke_peer()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self.rechoke()
+            await asyncio.sleep(self.interval)
@@ -1,26 +1,70 @@
 import argparse #Модуль argparse позволяет легко писать удобные интерфейсы командной строки. Программа определяет, какие аргументы ей требуются, а argparse выяснит, как их разобрать из вывода функции sys.argv.
 import asyncio
 import signal
+import sys
+import time
 import logging
 
 from concurrent.futures import CancelledError
 
 from torrent import Torrent
 from  clientTorrent import TorrentClient
+from choker import UPLOAD_SLOTS
+from recheck import recheck
+
+
+def verify(argv):
+    """
+    Проверяет уже скачанные данные торрента, не подключаясь к пирам:
+    python cli.py verify Random.torrent
+    """
+    parser = argparse.ArgumentParser(prog='cli.py verify')
+    parser.add_argument('torrent', help='the .torrent to verify')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='hashing processes, all CPUs by default')
+    args = parser.parse_args(argv)
+
+    torrent = Torrent(args.torrent)
+    start = time.perf_counter()
+    valid = recheck(torrent.files, torrent.piece_length, torrent.pieces,
+                    workers=args.workers)
+    elapsed = time.perf_counter() - start
+    # последний кусок может быть короче остальных
+    last = len(torrent.pieces) - 1
+    verified = len(valid) * torrent.piece_length
+    if last in valid:
+        verified -= (last + 1) * torrent.piece_length - torrent.total_size
+    print('{have} / {total} pieces OK, {size:.2f} GB verified in {time:.2f} s '
+          '({rate:.2f} GB/s)'.format(
+              have=len(valid), total=len(torrent.pieces),
+              size=verified / 1e9, time=elapsed,
+              rate=verified / 1e9 / elapsed))
 
 
 def main():
+    if sys.argv[1:2] == ['verify']:
+        verify(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser()
     parser.add_argument('torrent',
                         help='the .torrent to download')
   #позволяет запускать  команду вида python cli.py Random.torrent
+    parser.add_argument('--recheck', action='store_true',
+                        help='verify existing data before downloading')
+    parser.add_argument('--upload-slots', type=int, default=UPLOAD_SLOTS,
+                        help='peers unchoked at once, one of them optimistic')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='exit once downloaded instead of seeding')
 
     args = parser.parse_args()
 # сразу устанавливаю высокий уровень логгирования
     logging.basicConfig(level=logging.INFO)
 
     loop = asyncio.get_event_loop() #создаем обработчик событий
-    client = TorrentClient(Torrent(args.torrent))
+    client = TorrentClient(Torrent(args.torrent), recheck=args.recheck,
+                           upload_slots=args.upload_slots,
+                           seed=not args.no_seed)
     task = loop.create_task(client.start()) #запуск потока внутри обработчика
 
     def signal_handler(*_):
@@ -35,4 +79,5 @@ def main():
     except CancelledError:
         logging.warning('Event loop was canceled')
 
-main()
+if __name__ == '__main__':
+    main()
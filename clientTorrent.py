@@ -1,4 +1,5 @@
 import asyncio
+import io
 import logging
 import math
 import os
@@ -8,6 +9,7 @@ from collections import namedtuple, defaultdict
 from hashlib import sha1
 from piece import *
 
+from choker import Choker, UPLOAD_SLOTS
 from protocol import ConnectionToPeer, REQUEST_SIZE
 from tracker import Tracker
 
@@ -26,55 +28,85 @@ class TorrentClient:
     (или еще хуже процессы) мы можем создать их все сразу и они будут
     ждать, пока в очереди не появится одноранговый узел для потребления.
     """
-    def __init__(self, torrent):
+    def __init__(self, torrent, recheck: bool = False, memory=None,
+                 buffered: bool = False, upload_slots: int = UPLOAD_SLOTS,
+                 seed: bool = True):
+        """
+        :param seed: после загрузки продолжать раздавать и анонсироваться,
+                     пока клиент не остановят; False - завершиться сразу
+        """
         self.tracker = Tracker(torrent) # инициализация трекера. Реализация в tracker.py
         self.available_peers = Queue() # Список потенциальных пиров - это рабочая очередь, потребляемая ConnectionToPeer
         self.peers = [] # Список пиров — это список воркеров, которые *могут* быть подключены. В противном случае они ждут, чтобы потреблять новые удаленные одноранговые узлы из
-        self.piece_manager = PieceManager(torrent) # Менеджер частей реализует стратегию, на которой фигуры должны запрос, а также логика сохранения полученных фрагментов на диск.
+        self.piece_manager = PieceManager(torrent, memory=memory) # Менеджер частей реализует стратегию, на которой фигуры должны запрос, а также логика сохранения полученных фрагментов на диск.
+        if recheck: # уже скачанные куски не запрашиваем у пиров
+            self.piece_manager.recheck()
         self.abort = False
+        self.buffered = buffered # соединения через PeerProtocol
+        self.choker = Choker(self.piece_manager, upload_slots) # кому отдаём данные
+        self.seed = seed
+        self.check_interval = 5 # с, как часто проверять, не пора ли к трекеру
 
     async def start(self):
         """
         Начать загрузку торрента, удерживаемого этим клиентом.
 
         Это приводит к подключению к трекеру для получения списка
-        сверстники для общения. Как только торрент полностью скачается или
-        если загрузка будет прервана, этот метод завершится.
+        сверстники для общения. Скачав торрент, клиент сообщает трекеру
+        event=completed и раздаёт дальше, пока его не остановят; с
+        seed=False метод завершится, как только торрент скачается.
         """
         self.peers = [ConnectionToPeer(self.available_peers,
                                      self.tracker.torrent.info_hash,
                                      self.tracker.peer_id,
                                      self.piece_manager,
-                                     self._on_block_retrieved)
+                                     self._on_block_retrieved,
+                                     self.buffered,
+                                     self.choker)
                       for _ in range(MAX_PEER_CONNECTIONS)] # инициализация поля пиры объектами ConnectionToPeer. Реализация в ConnectionToPeer
+        self.choker.start() # пересмотр раз в CHOKE_INTERVAL секунд
 
         previous = None # предыдущий по умолчанию None
         interval = 30*60 # интервал звонка. Отметка времени
+        downloading = not self.piece_manager.complete # completed шлём, только если качали
 
         while True: # бесконечный цикл
-            if self.piece_manager.complete:  # если загрузка завершена сказать, что все закончилось
+            completed = downloading and self.piece_manager.complete
+            if completed:
+                downloading = False
                 logging.info('Torrent fully downloaded!')
+            if self.piece_manager.complete and not self.seed and \
+                    not completed: # раздавать не нужно, completed уже отправлен
                 break
             if self.abort: # иначе сообщить о проблеме
                 logging.info('Aborting download...')
                 break
 
             current = time.time() # получение текущего времени
-            if (not previous) or (previous + interval < current): # если сумма предыдущего и времени меньше временной метки
+            if completed or (not previous) or (previous + interval < current): # о завершении трекер узнаёт сразу
                 response = await self.tracker.connect(
-                    first=previous if previous else False,
+                    first=previous is None, # started - только в первом анонсе
                     uploaded=self.piece_manager.bytes_uploaded,
-                    downloaded=self.piece_manager.bytes_downloaded) # сделать асинхронный запрос к трекеру используя предыдущее время, загруженные байты,байты которые надо скачать
+                    downloaded=self.piece_manager.bytes_downloaded,
+                    on_peers=self._on_peers,
+                    left=self.piece_manager.bytes_left,
+                    completed=completed) # сделать асинхронный запрос к трекеру используя предыдущее время, загруженные байты,байты которые надо скачать
 
                 if response: # если ответ получен
                     previous = current # присвоение предыдущему времени текущей метки времени
                     interval = response.interval # инициализация временного интервала временем ответа
-                    self._empty_queue() # чистим очередь
-                    for peer in response.peers: # пока есть пиры в ответе
-                        self.available_peers.put_nowait(peer) # положить пиры без блокировки
             else:
-                await asyncio.sleep(5) # асинхронная задержка 5 миллисекунд
-        self.stop() # остановить загрузку
+                await asyncio.sleep(self.check_interval) # асинхронная задержка в секундах
+        self.stop() # остановить загрузку или раздачу
+
+    def _on_peers(self, peers):
+        """
+        Вызывается трекером, как только из ответа разобран список пиров,
+        чтобы подключаться к ним, не дожидаясь конца ответа.
+        """
+        self._empty_queue() # чистим очередь
+        for peer in peers: # пока есть пиры в ответе
+            self.available_peers.put_nowait(peer) # положить пиры без блокировки
 
     def _empty_queue(self): # метод очистки очереди
         while not self.available_peers.empty(): # пока все доступные пиры не пустые
@@ -85,11 +117,20 @@ class TorrentClient:
         Остановите процесс загрузки или заполнения.
         """
         self.abort = True # отменить процесс True
+        self.choker.stop()
         for peer in self.peers: # пока есть пиры
             peer.stop() # останавливаем пиры. Реализация функции stop в protocol.py
         self.piece_manager.close() # закрываем файл для записи
         self.tracker.close() # закрываем http соединение
 
+    def open(self, window: int = STREAM_WINDOW):
+        """
+        Читатель содержимого торрента, который можно использовать до
+        окончания загрузки: куски в окне после его позиции скачиваются
+        первыми, read() ждёт только нужные ему куски.
+        """
+        return TorrentReader(self.piece_manager, window)
+
     def _on_block_retrieved(self, peer_id, piece_index, block_offset, data): # при получении блока
         """
         Функция обратного вызова, вызываемая `ConnectionToPeer`, когда блок
@@ -103,3 +144,68 @@ class TorrentClient:
         self.piece_manager.block_received(
             peer_id=peer_id, piece_index=piece_index,
             block_offset=block_offset, data=data) # получение блока по выше указанным параметрам
+
+
+class TorrentReader:
+    """
+    Асинхронный файлоподобный объект над всеми файлами торрента как одним
+    потоком байт (в порядке файлов в метаданных).
+    """
+    def __init__(self, piece_manager, window: int = STREAM_WINDOW):
+        self.piece_manager = piece_manager
+        self.position = 0
+        self.size = piece_manager.storage.total_size
+        piece_manager.stream_window = window
+        piece_manager.set_cursor(0)
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError('Invalid whence {0}'.format(whence))
+        if offset < 0:
+            raise ValueError('Negative seek position {0}'.format(offset))
+        self.position = offset
+        self._move_cursor(offset)
+        return offset
+
+    async def read(self, size: int = -1) -> bytes:
+        """
+        Читает до size байт, дождавшись нужных кусков. Если диапазон
+        задевает пропускаемые (SKIP) файлы, поднимает ValueError
+        """
+        end = self.size if size < 0 else min(self.size, self.position + size)
+        if self.position >= end:
+            return b''
+        piece_length = self.piece_manager.torrent.piece_length
+        storage = self.piece_manager.storage
+        for index in range(self.position // piece_length,
+                           (end - 1) // piece_length + 1):
+            start = max(self.position, index * piece_length)
+            stop = min(end, (index + 1) * piece_length)
+            if any(storage.priorities[i] == SKIP
+                   for i in storage.files_in_range(start, stop - start)):
+                # на диске этих байт нет, вместо них читались бы нули
+                raise ValueError('Piece {0} lies in skipped files'
+                                 .format(index))
+            self.piece_manager.set_cursor(index)
+            await self.piece_manager.wait_piece(index)
+        data = await asyncio.get_running_loop().run_in_executor(
+            None, self.piece_manager.storage.read, self.position,
+            end - self.position)
+        self.position = end
+        self._move_cursor(end)
+        return data
+
+    def close(self):
+        self.piece_manager.set_cursor(None)
+
+    def _move_cursor(self, offset: int):
+        if offset < self.size:
+            self.piece_manager.set_cursor(
+                offset // self.piece_manager.torrent.piece_length)
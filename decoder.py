@@ -1,4 +1,7 @@
 from collections import OrderedDict
+from itertools import chain
+from operator import itemgetter
+import mmap
 
 TOKEN_INT= b'i'
 TOKEN_LIST = b'l'
@@ -6,6 +9,9 @@ TOKEN_DICT=b'd'
 TOKEN_END=b'e'
 TOKEN_SEPARATE=b':'
 
+MAX_DEPTH = 128 # максимальная вложенность списков и словарей
+MAX_SIZE = 128 * 2**20 # максимальный размер входных данных, 128 MiB
+
 
 
 
@@ -65,6 +71,100 @@ class Encoder:
         result += b'e'
         return result
 
+class StreamEncoder:
+    """
+    Кодирует значение за один проход в один растущий bytearray без
+    промежуточных буферов на каждый список и словарь.
+
+    Если задан sink (файл с write() или сокет с sendall()), данные
+    сбрасываются в него порциями по flush_size байт. Ключи словарей
+    сортируются как байты, как того требует спецификация bencode.
+    """
+    FLUSH_SIZE = 2**16
+
+    def __init__(self, sink=None, flush_size: int = FLUSH_SIZE):
+        self.sink = sink
+        self.flush_size = flush_size
+        self.buffer = bytearray()
+        self.written = 0 # сколько байт уже отдано в sink
+        if sink is None:
+            self._write = None
+        elif hasattr(sink, 'write'):
+            self._write = sink.write
+        else:
+            self._write = sink.sendall
+
+    def encode(self, data):
+        """
+        Без sink возвращает bytes, с sink - число записанных байт.
+        Если значение не кодируется, поднимается TypeError, а его начало
+        убирается из буфера; уже отданное в sink не вернуть.
+        """
+        buf = self.buffer
+        write = self._write
+        flush_size = self.flush_size
+        start = self.written
+        stack = [iter((data,))]
+        mark = len(buf) # начало этого значения в буфере
+
+        try:
+            while stack:
+                for item in stack[-1]:
+                    t = type(item)
+                    if t is bytes or t is bytearray or t is memoryview:
+                        buf += b'%d:' % len(item)
+                        buf += item
+                    elif t is str:
+                        item = item.encode('utf-8')
+                        buf += b'%d:' % len(item)
+                        buf += item
+                    elif t is int:
+                        buf += b'i%de' % item
+                    elif t is list or t is tuple:
+                        buf += TOKEN_LIST
+                        stack.append(iter(item))
+                        break
+                    elif t is dict or t is OrderedDict:
+                        buf += TOKEN_DICT
+                        stack.append(_sorted_items(item))
+                        break
+                    else:
+                        raise TypeError('Cannot encode {0}'.format(t.__name__))
+                    if write and len(buf) >= flush_size:
+                        self.flush()
+                else:
+                    stack.pop()
+                    if stack:
+                        buf += TOKEN_END
+        except Exception:
+            # недописанное значение не должно попасть в начало следующего;
+            # если буфер уже сбрасывался в sink, в нём только это значение
+            del buf[mark if self.written == start else 0:]
+            raise
+
+        if write:
+            self.flush()
+            return self.written - start
+        result = bytes(buf)
+        buf.clear()
+        return result
+
+    def flush(self):
+        if self.buffer:
+            self._write(self.buffer)
+            self.written += len(self.buffer)
+            self.buffer.clear()
+
+
+def _sorted_items(data: dict):
+    # пары (ключ, значение) по возрастанию ключа в виде плоской
+    # последовательности ключ, значение, ключ, значение...
+    items = [(k.encode('utf-8') if type(k) is str else k, v)
+             for k, v in data.items()]
+    items.sort(key=itemgetter(0))
+    return chain.from_iterable(items)
+
+
 class Decoder:
     def __init__(self,data):
         if not isinstance(data,bytes):
@@ -152,7 +252,239 @@ class Decoder:
 
 
 
-with open("RimWorld.torrent", 'rb') as f:
-            meta_info = f.read()
-            meta_info = Decoder(meta_info).decode()
-            info = Encoder(meta_info[b'info']).encode()
+
+class ViewDecoder:
+    """
+    Декодер bencode без рекурсии: проходит данные через memoryview,
+    вложенные списки и словари держит в явном стеке.
+
+    Результат совпадает с Decoder.decode(). При copy=False строки
+    возвращаются как memoryview на исходный буфер (ключи словарей
+    всегда bytes), копия делается только по запросу - bytes(view).
+
+    Для словаря верхнего уровня в spans запоминаются границы исходных
+    байт каждого значения: spans[b'info'] == (start, end), по ним
+    info_hash считается прямо от view[start:end] без повторного Encoder.
+    """
+    def __init__(self, data, copy: bool = True,
+                 max_depth: int = MAX_DEPTH, max_size: int = MAX_SIZE):
+        if not isinstance(data, (bytes, bytearray, mmap.mmap)):
+            raise TypeError("data must be bytes, bytearray or mmap")
+        if len(data) > max_size:
+            raise ValueError('Data size {0} exceeds the limit of {1} bytes'
+                             .format(len(data), max_size))
+        self.data = data
+        self.view = memoryview(data)
+        self.copy = copy
+        self.max_depth = max_depth
+        self.index = 0
+        self.spans = {}
+
+    def decode(self):
+        data = self.data
+        view = self.view
+        copy = self.copy
+        is_bytes = type(data) is bytes
+        size = len(data)
+        stack = [] # открытые списки и словари
+        keys = [] # ключ, ожидающий значения, для каждого уровня стека
+        spans = self.spans
+        value_start = 0
+        i = self.index
+
+        while True:
+            if i >= size:
+                raise EOFError('Unexpected end-of-file')
+            c = data[i]
+            if c == 0x69: # i
+                end = data.find(TOKEN_END, i + 1)
+                if end < 0:
+                    raise RuntimeError('Unable to find token {0}'.format(
+                        str(TOKEN_END)))
+                value = int(data[i + 1:end])
+                i = end + 1
+            elif 0x30 <= c <= 0x39: # 0-9
+                colon = data.find(TOKEN_SEPARATE, i)
+                if colon < 0:
+                    raise RuntimeError('Unable to find token {0}'.format(
+                        str(TOKEN_SEPARATE)))
+                start = colon + 1
+                end = start + int(data[i:colon])
+                if end > size:
+                    raise IndexError(
+                        'Cannot read {0} bytes from current position {1}'
+                        .format(str(end - start), str(start)))
+                if copy or (stack and keys[-1] is _NO_KEY
+                            and type(stack[-1]) is OrderedDict):
+                    value = data[start:end] if is_bytes \
+                        else bytes(view[start:end])
+                else:
+                    value = view[start:end]
+                i = end
+            elif c == 0x6c or c == 0x64: # l, d
+                if len(stack) >= self.max_depth:
+                    raise RuntimeError('Nesting deeper than {0} at {1}'.format(
+                        self.max_depth, str(i)))
+                stack.append([] if c == 0x6c else OrderedDict())
+                keys.append(_NO_KEY)
+                i += 1
+                continue
+            elif c == 0x65: # e
+                if not stack:
+                    self.index = i
+                    return None
+                value = stack.pop()
+                keys.pop()
+                i += 1
+            else:
+                raise RuntimeError('Invalid token read at {0}'.format(str(i)))
+
+            if not stack:
+                self.index = i
+                return value
+            container = stack[-1]
+            if type(container) is list:
+                container.append(value)
+            elif keys[-1] is _NO_KEY:
+                keys[-1] = value
+                if len(stack) == 1:
+                    value_start = i
+            else:
+                if len(stack) == 1:
+                    spans[keys[-1]] = (value_start, i)
+                container[keys[-1]] = value
+                keys[-1] = _NO_KEY
+
+
+_NO_KEY = object() # метка "ключ словаря ещё не прочитан"
+
+
+class StreamDecoder:
+    """
+    Потоковый декодер bencode: данные подаются кусками через feed() по мере
+    прихода из сети или файла, разбор продолжается с места остановки.
+
+    Если корневое значение - словарь, feed() возвращает пары (ключ, значение)
+    верхнего уровня сразу, как только они полностью получены. При keep=False
+    выданные пары не накапливаются в корневом словаре.
+    """
+    MAX_HEADER = 32 # длиннее не бывает ни длина строки, ни разумное число
+
+    def __init__(self, keep: bool = True,
+                 max_depth: int = MAX_DEPTH, max_size: int = MAX_SIZE):
+        self.keep = keep
+        self.max_depth = max_depth
+        self.max_size = max_size
+        self.size = 0 # сколько байт уже подано
+        self.done = False
+        self.result = None
+        self._buffer = bytearray()
+        self._stack = []
+        self._keys = []
+
+    def feed(self, data) -> list:
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise ValueError('Data size {0} exceeds the limit of {1} bytes'
+                             .format(self.size, self.max_size))
+        if self.done:
+            return [] # как и Decoder, игнорируем данные после значения
+        buf = self._buffer
+        buf += data
+        stack = self._stack
+        keys = self._keys
+        items = []
+        size = len(buf)
+        i = 0
+
+        while i < size:
+            c = buf[i]
+            if c == 0x69: # i
+                end = buf.find(TOKEN_END, i + 1)
+                if end < 0:
+                    self._check_header(size - i)
+                    break
+                value = int(buf[i + 1:end])
+                i = end + 1
+            elif 0x30 <= c <= 0x39: # 0-9
+                colon = buf.find(TOKEN_SEPARATE, i)
+                if colon < 0:
+                    self._check_header(size - i)
+                    break
+                start = colon + 1
+                end = start + int(buf[i:colon])
+                if end > size:
+                    break # ждём оставшиеся байты строки
+                value = bytes(buf[start:end])
+                i = end
+            elif c == 0x6c or c == 0x64: # l, d
+                if len(stack) >= self.max_depth:
+                    raise RuntimeError('Nesting deeper than {0} at {1}'.format(
+                        self.max_depth, str(self.size - size + i)))
+                stack.append([] if c == 0x6c else OrderedDict())
+                keys.append(_NO_KEY)
+                i += 1
+                continue
+            elif c == 0x65: # e
+                if not stack:
+                    raise RuntimeError('Invalid token read at {0}'.format(
+                        str(self.size - size + i)))
+                value = stack.pop()
+                keys.pop()
+                i += 1
+            else:
+                raise RuntimeError('Invalid token read at {0}'.format(
+                    str(self.size - size + i)))
+
+            if not stack:
+                self.result = value
+                self.done = True
+                break
+            container = stack[-1]
+            if type(container) is list:
+                container.append(value)
+            elif keys[-1] is _NO_KEY:
+                keys[-1] = value
+            else:
+                if len(stack) == 1:
+                    items.append((keys[-1], value))
+                    if self.keep:
+                        container[keys[-1]] = value
+                else:
+                    container[keys[-1]] = value
+                keys[-1] = _NO_KEY
+
+        del buf[:i]
+        return items
+
+    def feed_file(self, f, chunk_size: int = 2**16):
+        """
+        Читает файл кусками и по одной выдаёт пары верхнего уровня.
+        """
+        while not self.done:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield from self.feed(chunk)
+        self.close()
+
+    def close(self):
+        """
+        Завершает разбор и возвращает корневое значение.
+        """
+        if not self.done:
+            raise EOFError('Unexpected end-of-file')
+        self._buffer = bytearray()
+        return self.result
+
+    def _check_header(self, length):
+        if length > StreamDecoder.MAX_HEADER:
+            raise RuntimeError('Token header longer than {0} bytes'.format(
+                StreamDecoder.MAX_HEADER))
+
+
+if __name__ == '__main__':
+    with open("RimWorld.torrent", 'rb') as f:
+        meta_info = f.read()
+        meta_info = Decoder(meta_info).decode()
+        info = Encoder(meta_info[b'info']).encode()
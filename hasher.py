@@ -0,0 +1,78 @@
+"""
+Проверка хэшей готовых кусков вне цикла событий. hashlib отпускает GIL
+на больших буферах, поэтому по умолчанию хватает пула потоков; пул
+процессов можно включить, если хэши считаются медленнее, чем приходят
+данные.
+"""
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import sha1
+
+
+class PieceHasher:
+    """
+    submit() отдаёт кусок в пул, done(piece, matches) вызывается в цикле
+    событий, когда хэш посчитан. Без цикла событий (утилиты, тесты) и при
+    workers=0 хэш считается сразу.
+
+    Потокам достаётся только непосчитанный остаток куска: начало, пришедшее
+    по порядку, уже прошло через хэш в Piece. Процессу кусок копируется
+    и хэшируется целиком.
+    """
+    def __init__(self, workers: int = 2, processes: bool = False):
+        self.workers = workers
+        self.processes = processes
+        self.hashed = 0 # байт, отданных в пул
+        self.in_progress = 0 # кусков в пуле
+        self._executor = None
+
+    def submit(self, piece, done):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or not self.workers:
+            done(piece, piece.is_hash_matching())
+            return
+        if self._executor is None:
+            pool = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+            self._executor = pool(self.workers)
+        if self.processes:
+            data = bytes(piece.data)
+            future = loop.run_in_executor(self._executor, _hash_data, data)
+        else:
+            sha, data = piece.hash_state()
+            future = loop.run_in_executor(self._executor, _finish_hash,
+                                          sha, data)
+        self.hashed += len(data)
+        self.in_progress += 1
+        future.add_done_callback(
+            lambda f: self._finished(f, piece, done))
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _finished(self, future, piece, done):
+        self.in_progress -= 1
+        if future.cancelled():
+            return
+        if future.exception():
+            logging.error('Unable to hash piece {index}: {error}'.format(
+                index=piece.index, error=future.exception()))
+            done(piece, False) # кусок скачается заново
+            return
+        done(piece, future.result() == piece.hash)
+
+
+def _finish_hash(sha, data) -> bytes:
+    # выполняется в потоке пула
+    sha.update(data)
+    return sha.digest()
+
+
+def _hash_data(data: bytes) -> bytes:
+    # выполняется в процессе пула, поэтому функция модульного уровня
+    return sha1(data).digest()
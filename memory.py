@@ -0,0 +1,33 @@
+"""
+Общий бюджет памяти под данные кусков. Один MemoryBudget можно
+передать нескольким PieceManager, тогда все торренты делят один предел.
+"""
+
+DEFAULT_LIMIT = 256 * 2**20
+LOW_MEMORY_DEPTH = 2 # сколько запросов держать у пира, пока памяти не хватает
+
+
+class MemoryBudget:
+    """
+    Память резервируется целым куском, когда он начинает скачиваться
+    (в него попадут все запрошенные блоки), и освобождается, когда кусок
+    записан на диск. Пока новый кусок не помещается в предел, новые
+    куски не начинаются и очереди запросов к пирам укорачиваются, а
+    начатые куски докачиваются, освобождая память.
+    """
+    def __init__(self, limit: int = DEFAULT_LIMIT):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+
+    def can_reserve(self, size: int) -> bool:
+        # хотя бы один кусок разрешён всегда, иначе загрузка встанет
+        return not self.used or self.used + size <= self.limit
+
+    def reserve(self, size: int):
+        self.used += size
+        if self.used > self.peak:
+            self.peak = self.used
+
+    def release(self, size: int):
+        self.used -= size
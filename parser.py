@@ -1,9 +1,7 @@
 from hashlib import sha1
-from collections import namedtuple
 
 from decoder import *
-
-TorrentFileContainer = namedtuple('TorrentFileContainer', ['name', 'length'])
+from torrent import PieceHashes, torrent_files
 
 
 class TorrentContent:
@@ -13,22 +11,21 @@ class TorrentContent:
 
         with open(self.file_title, 'rb') as file:
             meta_data = file.read()
-            self.meta_data = Decoder(meta_data).decode()
-            self.torrent_info = Encoder(self.meta_data[b'info']).encode("utf-8")
+            decoder = ViewDecoder(meta_data)
+            self.meta_data = decoder.decode()
+            start, end = decoder.spans[b'info']
+            self.torrent_info = meta_data[start:end]
             self.torrent_info_hash = sha1(self.torrent_info).digest()
-            # self.get_files_list()
+            self.chunk_table = PieceHashes(self.meta_data[b'info'][b'pieces'])
+            self.get_files_list()
 
     def PrintTorrentContent(self):
           print(self.meta_data)
           return None
 
     def get_files_list(self):
-        if self.multi_file:
-            raise RuntimeError('Multi-file torrents is not supported!')
-        self.file_list.append(
-            TorrentFileContainer(
-                self.meta_data[b'info'][b'name'].decode('utf-8'),
-                self.meta_data[b'info'][b'length']))
+        self.file_list = torrent_files(self.meta_data[b'info'])
+        return self.file_list
 
     @property
     def declare(self):
@@ -44,21 +41,11 @@ class TorrentContent:
 
     @property
     def all_size(self):
-        if self.multi_file:
-            raise RuntimeError('Multi-file torrents is not supported!')
-        return self.file_list[0].length
+        return sum(f.length for f in self.file_list)
 
     @property
     def chunks(self):
-        data = self.meta_data[b'info'][b'pieces']
-        chunks = []
-        offset = 0
-        length = len(data)
-
-        while offset < length:
-            chunks.append(data[offset:offset + 20])
-            offset += 20
-        return chunks
+        return self.chunk_table
 
     @property
     def export_file(self):
@@ -69,12 +56,13 @@ class TorrentContent:
                'File content length: {1}\n' \
                'Declared URL: {2}\n' \
                'File SHA hash: {3}'.format(self.meta_data[b'info'][b'name'],
-                                  self.meta_data[b'info'][b'length'],
+                                  self.all_size,
                                   self.meta_data[b'announce'],
                                   self.torrent_info_hash)
 
-TorrentReader = TorrentContent('RimWorld.torrent')
-TorrentReader.PrintTorrentContent()
+if __name__ == '__main__':
+    TorrentReader = TorrentContent('RimWorld.torrent')
+    TorrentReader.PrintTorrentContent()
 
 # from decoder import *
 #
@@ -1,5 +1,7 @@
 
 import asyncio
+import heapq
+import itertools
 import logging
 import math
 import os
@@ -8,168 +10,599 @@ from asyncio import Queue
 from collections import namedtuple, defaultdict
 from hashlib import sha1
 
+from availability import PieceAvailability
+from hasher import PieceHasher
+from memory import MemoryBudget, LOW_MEMORY_DEPTH
+from recheck import recheck
+from seeding import MAX_BLOCK, READ_CACHE, PeerUploader, ReadCache
+from stats import TransferStats
 from protocol import ConnectionToPeer, REQUEST_SIZE
+from storage import FileStorage, StorageWriter, SKIP, NORMAL
 from tracker import Tracker
 
 MAX_PEER_CONNECTIONS = 40
 
+INITIAL_REQUEST_TIMEOUT = 60 * 1000 # ms, пока у пира нет ни одного замера
+MIN_REQUEST_TIMEOUT = 2 * 1000 # ms
+
+INITIAL_QUEUE_DEPTH = 4 # сколько запросов держать в пути у нового пира
+MAX_QUEUE_DEPTH = 128 # верхняя граница очереди запросов к одному пиру
+
+STREAM_WINDOW = 16 # сколько кусков после курсора чтения качать в первую очередь
+STREAM_SLACK = 2 # во сколько раз пир может опоздать к сроку куска в окне
+
+ENDGAME_COPIES = 3 # сколько пиров одновременно просят один блок в эндшпиле
+ENDGAME_BYTES = 4 * 2**20 # сколько байт дублирующих запросов может быть в пути
 
 
-class Block:
 
+class Block:
+    """
+    Запрос одного блока. Создаётся только для блоков в пути, состояние
+    всех блоков торрента хранится в PieceManager.block_status.
+    """
     Missing = 0
     Pending = 1
     Retrieved = 2
 
+    __slots__ = ('piece', 'offset', 'length')
+
     def __init__(self, piece: int, offset: int, length: int):
         self.piece = piece
         self.offset = offset #положение блока данных в куске
         self.length = length
-        self.status = Block.Missing #Состояния отсутствует,ожидается, готово(судя по переводу восстановлен что не соответсвует контексту)
-        self.data = None
 
 class Piece:
 
-    def __init__(self, index: int, blocks: [], hash_value):
+    def __init__(self, index: int, length: int, hash_value, status=None):
+        """
+        :param length: длина куска в байтах
+        :param status: буфер состояний блоков куска (срез общего массива
+                       PieceManager.block_status), по умолчанию свой
+        """
         self.index = index
-        self.blocks = blocks
+        self.length = length
         self.hash = hash_value
-
-    def deleteall(self):
+        self.priority = NORMAL # наибольший приоритет среди файлов куска
+        self.block_count = -(-length // REQUEST_SIZE)
+        self.status = status if status is not None \
+            else bytearray(self.block_count) # Missing, Pending или Retrieved для каждого блока
+        self.remaining = self.block_count - \
+            bytes(self.status).count(Block.Retrieved) # сколько блоков ещё не получено
+        self._missing = [i for i in range(self.block_count - 1, -1, -1)
+                         if self.status[i] != Block.Retrieved] # индексы незапрошенных блоков, первый в конце
+        self.buffer = None # данные куска, выделяются при получении первого блока
+        self._sha = sha1() # хэш непрерывного начала куска
+        self._hashed = 0 # сколько байт с начала уже прошло через _sha
+
+    def reset(self):
    #Метод для удаления всех данных в куске для скачивания повторно
-        for block in self.blocks:
-            block.status = Block.Missing
+        self.status[:] = bytes(self.block_count)
+        self.remaining = self.block_count
+        self._missing = list(range(self.block_count - 1, -1, -1))
+        self._sha = sha1()
+        self._hashed = 0
+
+    def block_length(self, index: int) -> int:
+        return min(REQUEST_SIZE, self.length - index * REQUEST_SIZE)
 
     def next_request_block(self):
     #Возвращает следующий блок для скачивания или ничего если нечего закачивать
-        missing = [b for b in self.blocks if b.status is Block.Missing]
-        if missing:
-            missing[0].status = Block.Pending
-            return missing[0]
+        while self._missing:
+            index = self._missing.pop()
+            if self.status[index] == Block.Missing:
+                self.status[index] = Block.Pending
+                return Block(self.index, index * REQUEST_SIZE,
+                             self.block_length(index))
         return None
 
-    def block_received(self, offset: int, data: bytes):
-    #Отмечает блок как скачанный если его текущая  позиция в куске равна запланированной
-        matches = [b for b in self.blocks if b.offset == offset]
-        block = matches[0] if matches else None
-        if block:
-            block.status = Block.Retrieved
-            block.data = data
-        else:
-            logging.warning('Trying to complete a non-existing block {offset}'
-                            .format(offset=offset))
+    def block_released(self, offset: int):
+    #Запрошенный блок снова становится незапрошенным (таймаут, пир ушёл)
+        index = offset // REQUEST_SIZE
+        if index < self.block_count and self.status[index] == Block.Pending:
+            self.status[index] = Block.Missing
+            self._missing.append(index) # будет запрошен первым
+
+    @property
+    def has_unrequested(self) -> bool:
+        return bool(self._missing)
+
+    def block_received(self, offset: int, data: bytes) -> bool:
+    #Отмечает блок как скачанный если его текущая  позиция в куске равна запланированной,
+    #возвращает False, если блок не нужен (дубликат или неверное смещение)
+        index, rest = divmod(offset, REQUEST_SIZE)
+        if rest or index >= self.block_count or \
+                len(data) != self.block_length(index):
+            logging.warning('Trying to complete a non-existing block %d',
+                            offset)
+            return False
+        if self.status[index] == Block.Retrieved:
+            return False # дубликат, данные уже в буфере и, возможно, в хэше
+        if self.buffer is None:
+            self.buffer = bytearray(self.length)
+        if not (isinstance(data, memoryview) and data.obj is self.buffer):
+            # блок копируется сразу на своё место в буфере куска; данные из
+            # block_view() уже лежат там
+            memoryview(self.buffer)[offset:offset + len(data)] = data
+        self.status[index] = Block.Retrieved
+        self.remaining -= 1
+        if offset == self._hashed:
+            self._update_hash()
+        return True
+
+    def block_view(self, offset: int, length: int):
+        """
+        Место блока в буфере куска, куда его можно читать прямо из сокета,
+        или None, если такого блока нет или он уже получен
+        """
+        index, rest = divmod(offset, REQUEST_SIZE)
+        if rest or index >= self.block_count or \
+                length != self.block_length(index) or \
+                self.status[index] == Block.Retrieved:
+            return None
+        if self.buffer is None:
+            self.buffer = bytearray(self.length)
+        return memoryview(self.buffer)[offset:offset + length]
+
+    def _update_hash(self):
+        # досчитывает хэш по всем полученным блокам подряд от начала
+        view = memoryview(self.buffer)
+        index = self._hashed // REQUEST_SIZE
+        start = self._hashed
+        while index < self.block_count and \
+                self.status[index] == Block.Retrieved:
+            index += 1
+        end = min(index * REQUEST_SIZE, self.length)
+        if end > start:
+            self._sha.update(view[start:end])
+            self._hashed = end
 
     def is_complete_retrieved(self): #не осталось блоков со статусом не готов
-        blocks = [b for b in self.blocks if b.status is not Block.Retrieved]
-        return len(blocks) == 0
+        return self.remaining == 0
 
     def is_hash_matching(self):
 
-        piece_hash = sha1(self.data).digest()
+        if self._hashed < self.length:
+            self._update_hash()
+        if self._hashed < self.length:
+            return False
+        piece_hash = self._sha.digest()
         return self.hash == piece_hash
 
+    def hash_state(self):
+        """
+        Копия хэша уже посчитанного начала куска и ещё не посчитанный
+        остаток данных: хэш можно досчитать в другом потоке
+        """
+        return self._sha.copy(), self.data[self._hashed:]
+
     @property
     def data(self):
         """
-        Соединяет байты  из  списка blocks_data вместе
-        return b''.join
-     результат    b'\xd1\x81\xd1\x83\xd0\xbf\xd0\xb5\xd1\x80'
-
+        Данные куска прямо из буфера, без копирования
         """
-        retrieved = sorted(self.blocks, key=lambda b: b.offset)
-        blocks_data = [b.data for b in retrieved]
-        return b''.join(blocks_data)
+        return memoryview(self.buffer) if self.buffer is not None else b''
 
 # The type used for keeping track of pending request that can be re-issued
-PendingRequest = namedtuple('PendingRequest', ['block', 'added'])
+PendingRequest = namedtuple('PendingRequest',
+                            ['block', 'peer_id', 'added', 'deadline'])
+
+
+class RequestTimer:
+    """
+    Время ответа и скорость одного пира, из которых считается таймаут
+    запроса, как RTO в TCP: srtt + 4 * rttvar плюс время, за которое
+    пир отдаст уже запрошенные у него outstanding байт. Каждый таймаут удваивает
+    следующий, пока не придёт новый ответ.
+
+    По тем же замерам выбирается depth - сколько запросов держать в пути:
+    произведение скорости на минимальное время ответа (bandwidth-delay
+    product) с запасом. depth движется к этой цели на один запрос за
+    полученный блок: пока очередь сама ограничивает скорость, цель выше
+    текущей глубины и очередь растёт. После Choke и таймаута depth
+    уменьшается вдвое.
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self):
+        self.srtt = None # ms
+        self.rttvar = 0
+        self.min_rtt = None # ms, время ответа без очереди у пира
+        self.backoff = 1
+        self.depth = INITIAL_QUEUE_DEPTH
+        self.outstanding = 0 # байт запрошено и ещё не получено
+        self._last = None # когда пришёл последний блок
+        self._ms_per_byte = None # сглаженное время между блоками на байт
+
+    def sample(self, added: int, now: int, length: int):
+        rtt = max(now - added, 1)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        # блоки идут один за другим, время передачи считаем от
+        # предыдущего полученного, а не от отправки запроса; сглаживается
+        # время, а не скорость, иначе пачки блоков завышают оценку
+        start = added if self._last is None else max(added, self._last)
+        ms_per_byte = max(now - start, 0.001) / length
+        self._ms_per_byte = ms_per_byte if self._ms_per_byte is None else \
+            self._ms_per_byte + self.ALPHA * (ms_per_byte - self._ms_per_byte)
+        self._last = now
+        self.backoff = 1
+
+        target = math.ceil(1.5 * self.rate * self.min_rtt / REQUEST_SIZE) + 1
+        # к цели по одному запросу за блок, чтобы один замер не сбивал очередь
+        if target > self.depth:
+            self.depth += 1
+        elif target < self.depth:
+            self.depth -= 1
+
+    @property
+    def rate(self) -> float:
+        """
+        Скорость пира, байт в ms
+        """
+        if self._ms_per_byte is None:
+            return None
+        return 1 / self._ms_per_byte
+
+    def timeout(self, maximum: int) -> int:
+        """
+        :param maximum: верхняя граница таймаута, ms
+        """
+        if self.srtt is None:
+            timeout = INITIAL_REQUEST_TIMEOUT
+        else:
+            timeout = self.srtt + 4 * self.rttvar + \
+                self.outstanding / self.rate
+        timeout = max(timeout, MIN_REQUEST_TIMEOUT) * self.backoff
+        return int(min(timeout, maximum))
+
+    def expired(self):
+        self.backoff = min(self.backoff * 2, 64)
+        self.shrink()
+
+    def shrink(self):
+        self.depth = max(self.depth // 2, 1)
+
+
+def _now() -> int:
+    return int(time.monotonic() * 1000)
 
 
 class PieceManager:
     """
     Должен находить доступные куски у других пиров и  помечать те куски которые можно отдать пирам
     """
-    def __init__(self, torrent):
+    def __init__(self, torrent, file_priorities=None,
+                 endgame_copies: int = ENDGAME_COPIES,
+                 endgame_bytes: int = ENDGAME_BYTES,
+                 max_queue_depth: int = MAX_QUEUE_DEPTH,
+                 memory: MemoryBudget = None,
+                 hasher: PieceHasher = None,
+                 read_cache: int = READ_CACHE):
+        """
+        :param read_cache: сколько байт кусков держать в памяти для раздачи
+        :param hasher: пул, в котором проверяются хэши готовых кусков
+        :param memory: бюджет памяти под куски, общий для нескольких
+                       торрентов, если передать один и тот же
+        :param max_queue_depth: сколько запросов не больше держать в пути
+                                у одного пира
+        :param endgame_copies: у скольких пиров сразу запрашивать блок,
+                               когда все оставшиеся блоки уже в пути
+        :param endgame_bytes: предел байт в пути у дублирующих запросов
+        """
         self.torrent = torrent # обобщенный класс со списком фалов и кусков реализация в модуле torrent.py
         self.peers = {}
-        self.pending_blocks = []
-        self.missing_pieces = []
-        self.ongoing_pieces = []
-        self.have_pieces = []
-        self.max_pending_time = 300 * 1000  # 5 min сколько можно ждать что нам отдадут кусок
-        self.missing_pieces = self._initiate_pieces() # что нам нужно
+        self.pending_blocks = {} # (индекс куска, offset) -> PendingRequest
+        self.duplicates = {} # (индекс куска, offset) -> {пир: PendingRequest}, копии в эндшпиле
+        self.endgame_copies = endgame_copies
+        self.endgame_bytes = endgame_bytes
+        self.max_queue_depth = max_queue_depth
+        self.read_cursor = None # кусок, который сейчас читают, None - не читают
+        self.stream_window = 0 # сколько кусков от курсора качать первыми
+        self._unwritten = set() # проверенные куски, ещё не записанные на диск
+        self._waiters = {} # индекс куска -> futures, ждущие его записи
+        self.duplicate_bytes = 0 # байт в пути у запросов из duplicates
+        self._receiving = {} # (индекс куска, offset) -> пир, чей блок читается прямо в буфер куска
+        self._on_cancel = {} # пир -> функция, отправляющая ему Cancel
+        self._on_have = {} # пир -> функция, отправляющая ему Have
+        self._on_wakeup = {} # пир -> функция, дозапрашивающая у него блоки
+        self.peer_requests = {} # пир -> его запросы в пути, (индекс, offset) -> PendingRequest
+        self.timers = {} # пир -> RequestTimer
+        self._deadlines = [] # куча (deadline, номер, PendingRequest), ответившие удаляются лениво
+        self._sequence = itertools.count()
+        self.ongoing_pieces = {} # индекс куска -> Piece
+        self._requestable = {} # куски из ongoing_pieces с незапрошенными блоками
+        self.have_pieces = set() # индексы скачанных кусков
+        self.missing_pieces = set() # индексы ещё не начатых кусков, что нам нужно
+        self.skipped_pieces = set() # куски, целиком лежащие в пропускаемых файлах
+        self.max_pending_time = 300 * 1000  # 5 min, больше этого не ждём блок даже от медленного пира
         self.total_pieces = len(torrent.pieces)
-        self.fd = os.open(self.torrent.output_file,  os.O_RDWR | os.O_CREAT) #файл для записи
-
-    def _initiate_pieces(self) -> [Piece]:
+        self.storage = FileStorage(torrent.files, priorities=file_priorities) #файлы для записи
+        self.writer = StorageWriter(self.storage) # запись на диск в пуле потоков
+        self.availability = PieceAvailability(self.total_pieces) # у скольких пиров есть каждый кусок
+        self.stats = TransferStats() # байты всех соединений торрента
+        self.memory = memory or MemoryBudget() # память под начатые и незаписанные куски
+        self.hasher = hasher or PieceHasher() # проверка хэшей вне цикла событий
+        self.read_cache = ReadCache(read_cache) # горячие куски для раздачи
+        self._initiate_pieces()
+        self._apply_priorities()
+
+    def _initiate_pieces(self):
         """
-        Pre-construct the list of pieces and blocks based on the number of
-        pieces and request size for this torrent.
+        Allocate the block state of the whole torrent as one compact array,
+        Piece objects are only created for pieces being downloaded.
         """
-        torrent = self.torrent
-        pieces = []
-        total_pieces = len(torrent.pieces)
-        std_piece_blocks = math.ceil(torrent.piece_length / REQUEST_SIZE)
+        self.piece_blocks = math.ceil(self.torrent.piece_length / REQUEST_SIZE)
          # расчет количества блоков для куска, округляет результат деления
-
-        for index, hash_value in enumerate(torrent.pieces):
-
-            if index < (total_pieces - 1):
-                blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                          for offset in range(std_piece_blocks)]
+        self.block_status = bytearray(self.total_pieces * self.piece_blocks) # состояние каждого блока торрента
+        self.piece_priority = bytearray(self.total_pieces) # приоритет каждого куска
+        self.missing_pieces = set(range(self.total_pieces))
+
+    def piece_length(self, index: int) -> int:
+        # последний кусок обычно короче остальных
+        if index < self.total_pieces - 1:
+            return self.torrent.piece_length
+        return self.storage.total_size - index * self.torrent.piece_length
+
+    def _make_piece(self, index: int) -> Piece:
+        first = index * self.piece_blocks
+        status = memoryview(self.block_status)[first:first + self.piece_blocks]
+        length = self.piece_length(index)
+        piece = Piece(index, length, self.torrent.pieces.hash_at(index),
+                      status[:-(-length // REQUEST_SIZE)])
+        piece.priority = self.piece_priority[index]
+        return piece
+
+    def set_file_priority(self, index: int, priority: int):
+        """
+        Меняет приоритет файла. Куски, все файлы которых пропускаются
+        (SKIP), убираются из выбора и не запрашиваются у пиров.
+        """
+        self.storage.priorities[index] = priority
+        self._apply_priorities()
+
+    def _apply_priorities(self):
+        piece_length = self.torrent.piece_length
+        priorities = self.storage.priorities
+        piece_priority = bytearray(self.total_pieces)
+        for index, offset in enumerate(self.storage.offsets):
+            length = self.storage.files[index].length
+            if not length:
+                continue
+            first = offset // piece_length
+            last = (offset + length - 1) // piece_length
+            for i in range(first, last + 1):
+                if piece_priority[i] < priorities[index]:
+                    piece_priority[i] = priorities[index]
+
+        self.piece_priority[:] = piece_priority
+        for index in sorted(self.missing_pieces | self.skipped_pieces):
+            if piece_priority[index] == SKIP:
+                self.missing_pieces.discard(index)
+                self.skipped_pieces.add(index)
+                self.availability.discard_candidate(index)
             else:
-                last_length = torrent.total_size % torrent.piece_length
-                num_blocks = math.ceil(last_length / REQUEST_SIZE)
-                blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                          for offset in range(num_blocks)]
-
-                if last_length % REQUEST_SIZE > 0:
-# тут идет расчет уже для последнего блока который меньше чем обычный
-                    last_block = blocks[-1]
-                    last_block.length = last_length % REQUEST_SIZE
-                    blocks[-1] = last_block
-            pieces.append(Piece(index, blocks, hash_value))
-        return pieces
+                self.skipped_pieces.discard(index)
+                self.missing_pieces.add(index)
+                self.availability.add_candidate(index, piece_priority[index])
+
+    def recheck(self, workers: int = None) -> int:
+        """
+        Проверяет уже лежащие на диске данные и отмечает совпавшие куски
+        скачанными. Вызывается до подключения к пирам, возвращает число
+        найденных кусков.
+        """
+        valid = recheck(self.storage.files, self.torrent.piece_length,
+                        self.torrent.pieces, self.storage.root,
+                        self.storage.priorities, workers)
+        for index in valid & self.missing_pieces:
+            self.missing_pieces.discard(index)
+            self.availability.discard_candidate(index)
+            self.have_pieces.add(index)
+            first = index * self.piece_blocks
+            blocks = -(-self.piece_length(index) // REQUEST_SIZE)
+            self.block_status[first:first + blocks] = \
+                bytes([Block.Retrieved]) * blocks
+        logging.info('Recheck found {have} / {total} pieces'.format(
+            have=len(self.have_pieces),
+            total=self.total_pieces - len(self.skipped_pieces)))
+        return len(self.have_pieces)
 
     def close(self):
-#закрывает файл для записи
-        if self.fd:
-            os.close(self.fd)
+#дописывает очередь записи и закрывает файлы
+        self.hasher.close()
+        self.writer.close()
+        self.storage.close()
+
+    def set_cursor(self, index: int):
+        """
+        Передвигает курсор чтения: куски окна после него запрашиваются
+        раньше всех остальных. None выключает окно.
+        """
+        if index != self.read_cursor:
+            self.read_cursor = index
+            self._wake_peers() # в окне могли появиться куски для запроса
+
+    def is_readable(self, index: int) -> bool:
+        return index in self.have_pieces and index not in self._unwritten
+
+    async def wait_piece(self, index: int):
+        """
+        Ждёт, пока кусок будет скачан, проверен и записан на диск.
+        Если записать его не удалось, поднимает ошибку записи.
+        """
+        if index in self.skipped_pieces:
+            raise ValueError('Piece {0} lies in skipped files'.format(index))
+        while not self.is_readable(index):
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(index, []).append(future)
+            await future
+
+    def _piece_written(self, index: int, data=None):
+        self._unwritten.discard(index)
+        self.memory.release(self.piece_length(index))
+        if data is not None and self.can_upload(index):
+            self.read_cache.put(index, data) # пиры запросят его первым
+        for on_have in list(self._on_have.values()):
+            on_have(index)
+        for future in self._waiters.pop(index, []):
+            if not future.done():
+                future.set_result(None)
+        self._wake_peers() # можно начинать новые куски
+
+    async def wait_writable(self):
+        """
+        Ждёт, пока очередь записи на диск не освободится
+        """
+        await self.writer.wait_writable()
 
     @property
     def complete(self):
         """
-Проверяет скачаны ли все куски торрента
+Проверяет скачаны ли все нужные куски торрента
         """
-        return len(self.have_pieces) == self.total_pieces
+        return len(self.have_pieces) == \
+            self.total_pieces - len(self.skipped_pieces)
 
     @property
     def bytes_downloaded(self) -> int:
         """
-Сколько блоков куска скачано
+Сколько байт данных получено от пиров, включая дубликаты и отброшенные
         """
-        return len(self.have_pieces) * self.torrent.piece_length
+        return self.stats.downloaded
 
     @property
     def bytes_uploaded(self) -> int:
-        return 0
+        return self.stats.uploaded
 
-    def add_peer(self, peer_id, bitfield):
+    @property
+    def bytes_left(self) -> int:
+        """
+        Сколько байт нужных кусков ещё не скачано и не проверено
+        """
+        return sum(self.piece_length(index) for index in range(self.total_pieces)
+                   if index not in self.have_pieces and
+                   index not in self.skipped_pieces)
 
+    def add_peer(self, peer_id, bitfield, on_cancel=None):
+        """
+        :param on_cancel: функция on_cancel(block), отправляющая пиру Cancel,
+                          когда блок уже получен от другого пира
+        """
+        if on_cancel:
+            self._on_cancel[peer_id] = on_cancel
+        if peer_id in self.peers:
+            self.availability.remove_peer(self.peers[peer_id])
         self.peers[peer_id] = bitfield
+        self.peer_requests.setdefault(peer_id, {})
+        self.timers.setdefault(peer_id, RequestTimer())
+        self.availability.add_peer(bitfield)
+
+    def subscribe(self, peer_id, on_have, on_wakeup=None):
+        """
+        :param on_have: функция on_have(index), отправляющая пиру Have,
+                        когда кусок записан на диск и его можно раздавать
+        :param on_wakeup: функция без аргументов, вызывается, когда снова
+                          есть что запросить: освободились память и место
+                          в очереди записи или блоки вернулись в выбор
+        """
+        self._on_have[peer_id] = on_have
+        if on_wakeup:
+            self._on_wakeup[peer_id] = on_wakeup
+
+    def _wake_peers(self):
+        # соединение дозапрашивает блоки только после сообщения пира,
+        # а пир, у которого ничего не запрошено, может молчать
+        for on_wakeup in list(self._on_wakeup.values()):
+            on_wakeup()
+
+    def can_upload(self, index: int, begin: int = 0, length: int = 0) -> bool:
+        """
+        Можно ли отдать пиру length байт куска с begin: кусок проверен,
+        записан и не задевает пропускаемых файлов, которых нет на диске
+        """
+        if not self.is_readable(index) or length > MAX_BLOCK or \
+                begin < 0 or begin + length > self.piece_length(index):
+            return False
+        priorities = self.storage.priorities
+        return all(priorities[i] != SKIP for i in self.storage.files_in_range(
+            index * self.torrent.piece_length, self.piece_length(index)))
+
+    def bitfield(self) -> bytes:
+        """
+        Куски, которые мы раздаём, для сообщения BitField
+        """
+        bits = bytearray(-(-self.total_pieces // 8))
+        for index in self.have_pieces:
+            if self.can_upload(index):
+                bits[index // 8] |= 0x80 >> index % 8
+        return bytes(bits)
+
+    def uploader(self, peer_id, outbox, stats=None) -> PeerUploader:
+        """
+        Очередь запросов пира к нам, отвечает из кэша и файлов торрента
+        """
+        return PeerUploader(self, peer_id, outbox, stats)
 
     def update_peer(self, peer_id, index: int):
         """
 Сколько кусков  имеет другой  пир
         """
         if peer_id in self.peers:
-            self.peers[peer_id][index] = 1
+            bitfield = self.peers[peer_id]
+            if index < min(len(bitfield), self.total_pieces) and \
+                    not bitfield[index]:
+                bitfield[index] = 1
+                self.availability.have(index)
 
     def remove_peer(self, peer_id):
         """
     Удаляет пир, используется при разрыве соединения
         """
+        self._on_wakeup.pop(peer_id, None) # его блоки достанутся остальным
+        self.release_peer(peer_id)
         if peer_id in self.peers:
+            self.availability.remove_peer(self.peers[peer_id])
             del self.peers[peer_id]
+        self.peer_requests.pop(peer_id, None)
+        self.timers.pop(peer_id, None)
+        self._on_cancel.pop(peer_id, None)
+        self._on_have.pop(peer_id, None)
+        for key in [key for key, peer in self._receiving.items()
+                    if peer == peer_id]:
+            del self._receiving[key] # блок так и не дочитан
+
+    def release_peer(self, peer_id):
+        """
+        Возвращает в выбор все блоки, запрошенные у пира. Вызывается, когда
+        пир нас заблокировал (Choke) или отключился.
+        """
+        requests = list(self.peer_requests.get(peer_id, {}).values())
+        for request in requests:
+            self._release(request)
+        if peer_id in self.timers:
+            self.timers[peer_id].shrink()
+        if requests:
+            self._wake_peers()
+
+    def request_slots(self, peer_id) -> int:
+        """
+        Сколько ещё запросов можно отправить пиру, чтобы в пути их было
+        столько, сколько позволяет его очередь.
+        """
+        if peer_id not in self.peers:
+            return 0
+        depth = min(self.timers[peer_id].depth, self.max_queue_depth)
+        if self.memory_tight:
+            # пока память не освободится, у пиров держим короткие очереди
+            depth = min(depth, LOW_MEMORY_DEPTH)
+        return max(depth - len(self.peer_requests[peer_id]), 0)
 
     def next_request(self, peer_id) -> Block:
 #видимо ищет следующий блок в пире, сначала проверяется является ли блок недостающим
@@ -179,103 +612,325 @@ class PieceManager:
         if peer_id not in self.peers:
             return None
 
-        block = self._expired_requests(peer_id)
+        self._expire_requests(_now())
+        block = None
+        if self.read_cursor is not None and self.stream_window:
+            block = self._next_window(peer_id)
         if not block:
             block = self._next_ongoing(peer_id)
-            if not block:
-                block = self._get_rarest_piece(peer_id).next_request()
+        if not block and self.can_start_piece: # новые куски не начинаем, пока диск не успевает или нет памяти
+            piece = self._get_rarest_piece(peer_id)
+            if piece:
+                block = self._request_block(piece, peer_id)
+        if not block and self.endgame:
+            block = self._next_endgame(peer_id)
         return block
 
-    def block_received(self, peer_id, piece_index, block_offset, data):
+    @property
+    def memory_tight(self) -> bool:
+        """
+        Ещё один кусок не помещается в бюджет памяти
+        """
+        return not self.memory.can_reserve(self.torrent.piece_length)
 
-        logging.debug('Received block {block_offset} for piece {piece_index} '
-                      'from peer {peer_id}: '.format(block_offset=block_offset,
-                                                     piece_index=piece_index,
-                                                     peer_id=peer_id))
+    @property
+    def can_start_piece(self) -> bool:
+        # новый кусок займёт память до записи на диск
+        return not self.writer.full and not self.memory_tight
+
+    @property
+    def endgame(self) -> bool:
+        """
+        Все оставшиеся блоки уже запрошены: последние куски больше не
+        ждут самого медленного пира, блоки просятся у нескольких сразу.
+        """
+        return not self.missing_pieces and not self._requestable and \
+            bool(self.pending_blocks)
 
-        for index, request in enumerate(self.pending_blocks):
-            if request.block.piece == piece_index and \
-               request.block.offset == block_offset:
-                del self.pending_blocks[index]
-                break
+    def block_buffer(self, peer_id, piece_index, block_offset, length):
+        """
+        Место в буфере куска, куда соединение может читать блок прямо из
+        сокета, или None: блок у этого пира не запрашивали, он уже получен
+        или его так же читает другое соединение. Когда блок дочитан, он
+        передаётся в block_received() как есть.
+        """
+        key = (piece_index, block_offset)
+        piece = self.ongoing_pieces.get(piece_index)
+        if piece is None or key in self._receiving or \
+                key not in self.peer_requests.get(peer_id, ()):
+            return None
+        view = piece.block_view(block_offset, length)
+        if view is not None:
+            self._receiving[key] = peer_id
+        return view
+
+    def block_received(self, peer_id, piece_index, block_offset, data):
+
+        logging.debug('Received block %d for piece %d from peer %s',
+                      block_offset, piece_index, peer_id)
+
+        key = (piece_index, block_offset)
+        receiver = self._receiving.get(key)
+        if receiver == peer_id:
+            del self._receiving[key]
+        elif receiver is not None:
+            # другой пир сейчас пишет этот блок прямо в буфер куска, копия
+            # поверх него могла бы испортить уже проверенные данные
+            self.stats.waste(len(data))
+            return
+        requests = []
+        if key in self.pending_blocks:
+            requests.append(self.pending_blocks.pop(key))
+        copies = self.duplicates.pop(key, None)
+        if copies:
+            requests.extend(copies.values())
+            self.duplicate_bytes -= len(copies) * requests[0].block.length
+        for request in requests:
+            self._forget(request)
+            if request.peer_id == peer_id:
+                self.timers[peer_id].sample(request.added, _now(), len(data))
+            elif request.peer_id in self._on_cancel:
+                # первая копия пришла, остальные пиры могут не отправлять
+                self._on_cancel[request.peer_id](request.block)
       #тут проверяется закачан ли кусок и скидывается на диск по итогам
-        pieces = [p for p in self.ongoing_pieces if p.index == piece_index]
-        piece = pieces[0] if pieces else None
+        piece = self.ongoing_pieces.get(piece_index)
         if piece:
-            piece.block_received(block_offset, data)
-            if piece.is_complete_retrieved():
-                if piece.is_hash_matching():
-                    self._write(piece) #запись на диск данных куска
-                    self.ongoing_pieces.remove(piece)
-                    self.have_pieces.append(piece)
-                    complete = (self.total_pieces -
-                                len(self.missing_pieces) -
-                                len(self.ongoing_pieces))
-                    logging.info(
-                        '{complete} / {total} pieces downloaded {per:.3f} %'
-                        .format(complete=complete,
-                                total=self.total_pieces,
-                                per=(complete/self.total_pieces)*100))
-                else:
-                    logging.info('Discarding corrupt piece {index}'
-                                 .format(index=piece.index))
-                    piece.reset()
+            if not piece.block_received(block_offset, data):
+                self.stats.waste(len(data))
+            elif piece.is_complete_retrieved():
+                # пока хэш считается, кусок остаётся в ongoing_pieces
+                self.hasher.submit(piece, self._piece_verified)
+        elif piece_index in self.have_pieces:
+            logging.debug('Duplicate block for piece %d', piece_index)
+            self.stats.waste(len(data))
         else:
             logging.warning('Trying to update piece that is not ongoing!')
+            self.stats.waste(len(data))
+
+    def _piece_verified(self, piece, matches: bool):
+        if self.ongoing_pieces.get(piece.index) is not piece:
+            return
+        if matches:
+            self._write(piece) #запись на диск данных куска
+            del self.ongoing_pieces[piece.index]
+            self.have_pieces.add(piece.index)
+            complete = len(self.have_pieces)
+            total = self.total_pieces - len(self.skipped_pieces)
+            logging.info(
+                '{complete} / {total} pieces downloaded {per:.3f} %'
+                .format(complete=complete,
+                        total=total,
+                        per=(complete/total)*100))
+        else:
+            logging.info('Discarding corrupt piece {index}'
+                         .format(index=piece.index))
+            self.stats.waste(piece.length)
+            piece.reset()
+            self._requestable[piece.index] = piece
+            self._wake_peers()
+
+    def _expire_requests(self, now: int):
+#провал закачки блока: просроченные запросы снимаются с вершины кучи
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            request = heapq.heappop(deadlines)[2]
+            block = request.block
+            if not self._in_flight(request):
+                continue # блок уже получен или запрос снят
+            logging.info('Request for block {block} of piece {piece} timed '
+                         'out on peer {peer}'.format(block=block.offset,
+                                                     piece=block.piece,
+                                                     peer=request.peer_id))
+            self.timers[request.peer_id].expired()
+            self._release(request)
+
+    def _in_flight(self, request) -> bool:
+        # каждый живой запрос, основной или копия, есть в списке своего пира
+        block = request.block
+        return self.peer_requests.get(request.peer_id, {}).get(
+            (block.piece, block.offset)) is request
+
+    def _forget(self, request):
+        block = request.block
+        self.peer_requests[request.peer_id].pop((block.piece, block.offset))
+        self.timers[request.peer_id].outstanding -= block.length
+
+    def _release(self, request):
+        block = request.block
+        key = (block.piece, block.offset)
+        self._forget(request)
+        copies = self.duplicates.get(key)
+        if copies:
+            self.duplicate_bytes -= block.length
+            if self.pending_blocks[key] is request:
+                # основным становится запрос, оставшийся у другого пира
+                _, request = copies.popitem()
+                self.pending_blocks[key] = request
+            else:
+                del copies[request.peer_id]
+            if not copies:
+                del self.duplicates[key]
+            return
+        del self.pending_blocks[key]
+        piece = self.ongoing_pieces.get(block.piece)
+        if piece:
+            piece.block_released(block.offset)
+            self._requestable[piece.index] = piece
 
-    def _expired_requests(self, peer_id) -> Block:
-#провал закачки блока
-        current = int(round(time.time() * 1000))
-        for request in self.pending_blocks:
-            if self.peers[peer_id][request.block.piece]:
-                if request.added + self.max_pending_time < current: #закончилось время
-                    logging.info('Re-requesting block {block} for '
-                                 'piece {piece}'.format(
-                                    block=request.block.offset,
-                                    piece=request.block.piece))
-                    request.added = current
-                    return request.block
-        return None
+    def _next_endgame(self, peer_id) -> Block:
+        # блок, который ещё не просили у этого пира и у которого меньше
+        # всего копий в пути; при равенстве самый давно запрошенный
+        if self.duplicate_bytes >= self.endgame_bytes:
+            return None
+        bitfield = self.peers[peer_id]
+        own = self.peer_requests.get(peer_id, {})
+        best = None
+        best_copies = self.endgame_copies
+        for key, request in self.pending_blocks.items():
+            if key in own or not bitfield[key[0]]:
+                continue
+            copies = 1 + len(self.duplicates.get(key, ()))
+            if copies < best_copies:
+                best, best_copies = request.block, copies
+                if copies == 1:
+                    break
+        if best:
+            self._track(best, peer_id, duplicate=True)
+        return best
 
     def _next_ongoing(self, peer_id) -> Block:
+        # просматриваются только куски, у которых остались незапрошенные
+        # блоки, полностью запрошенные из _requestable убираются
+        bitfield = self.peers[peer_id]
+        for piece in self._requestable.values():
+            if bitfield[piece.index]:
+                return self._request_block(piece, peer_id)
+        return None
 
-        for piece in self.ongoing_pieces:
-            if self.peers[peer_id][piece.index]:
-                block = piece.next_request()
+    def _next_window(self, peer_id) -> Block:
+        # куски после курсора чтения, ближайший к курсору нужен раньше всех,
+        # поэтому окно просматривается по порядку; за его пределами rarest-first.
+        # Срок куска - когда рой успел бы скачать всё окно до него; медленный
+        # пир не берёт куски, к сроку которых он не успеет, иначе чтение
+        # встанет на нём
+        bitfield = self.peers[peer_id]
+        timer = self.timers[peer_id]
+        rates = [t.rate for t in self.timers.values() if t.rate]
+        late = None # сколько ms пир отдаёт блок, если он не самый быстрый
+        if timer.rate and timer.rate < max(rates):
+            late = (timer.outstanding + REQUEST_SIZE) / timer.rate
+            swarm_rate = sum(rates)
+        end = min(self.read_cursor + self.stream_window, self.total_pieces)
+        for index in range(self.read_cursor, end):
+            if not bitfield[index]:
+                continue
+            if late is not None:
+                ahead = (index - self.read_cursor + 1) * self.torrent.piece_length
+                if late > STREAM_SLACK * ahead / swarm_rate:
+                    continue
+            piece = self._requestable.get(index)
+            if piece is None and index in self.missing_pieces and \
+                    self.can_start_piece:
+                self.missing_pieces.remove(index)
+                self.availability.discard_candidate(index)
+                piece = self._make_piece(index)
+                self._start_piece(piece)
+            if piece:
+                block = self._request_block(piece, peer_id)
                 if block:
-                    self.pending_blocks.append(
-                        PendingRequest(block, int(round(time.time() * 1000))))
                     return block
         return None
 
-    def _get_rarest_piece(self, peer_id):
+    def _request_block(self, piece, peer_id) -> Block:
+        block = piece.next_request_block()
+        if not piece.has_unrequested:
+            self._requestable.pop(piece.index, None)
+        if block:
+            self._track(block, peer_id)
+        return block
 
-        piece_count = defaultdict(int)
-        for piece in self.missing_pieces:
-            if not self.peers[peer_id][piece.index]:
-                continue
-            for p in self.peers:
-                if self.peers[p][piece.index]:
-                    piece_count[piece] += 1
+    def _track(self, block, peer_id, duplicate=False):
+        # запрос попадает в общий словарь (копия в эндшпиле - в duplicates),
+        # в список запросов пира и в кучу сроков; таймаут зависит от того,
+        # как быстро отвечает этот пир
+        requests = self.peer_requests.setdefault(peer_id, {})
+        timer = self.timers.setdefault(peer_id, RequestTimer())
+        now = _now()
+        request = PendingRequest(block, peer_id, now,
+                                 now + timer.timeout(self.max_pending_time))
+        timer.outstanding += block.length
+        key = (block.piece, block.offset)
+        if duplicate:
+            self.duplicates.setdefault(key, {})[peer_id] = request
+            self.duplicate_bytes += block.length
+        else:
+            self.pending_blocks[key] = request
+        requests[key] = request
+        if len(self._deadlines) > 2 * len(self.pending_blocks) + 64:
+            # в куче в основном ответившие запросы, собираем её заново
+            self._deadlines = [entry for entry in self._deadlines
+                               if self._in_flight(entry[2])]
+            heapq.heapify(self._deadlines)
+        heapq.heappush(self._deadlines,
+                       (request.deadline, next(self._sequence), request))
+
+    def _get_rarest_piece(self, peer_id):
 
-        rarest_piece = min(piece_count, key=lambda p: piece_count[p])
-        self.missing_pieces.remove(rarest_piece)
-        self.ongoing_pieces.append(rarest_piece)
+        skip = ()
+        if self.read_cursor is not None and self.stream_window:
+            # куски окна уже предлагались в _next_window: если пир их не
+            # взял, он к ним не успевает
+            skip = range(self.read_cursor,
+                         self.read_cursor + self.stream_window)
+        index = self.availability.rarest(self.peers[peer_id], skip)
+        if index is None:
+            return None
+        self.missing_pieces.remove(index)
+        self.availability.discard_candidate(index)
+        rarest_piece = self._make_piece(index)
+        self._start_piece(rarest_piece)
         return rarest_piece
 
+    def _start_piece(self, piece):
+        self.memory.reserve(piece.length) # освобождается после записи на диск
+        self.ongoing_pieces[piece.index] = piece
+        self._requestable[piece.index] = piece
+
     def _next_missing(self, peer_id) -> Block:
 
-        for index, piece in enumerate(self.missing_pieces):
-            if self.peers[peer_id][piece.index]:
+        for index in self.missing_pieces:
+            if self.peers[peer_id][index]:
                 # Помещает блок в списокн недостающих
-                piece = self.missing_pieces.pop(index)
-                self.ongoing_pieces.append(piece)
+                self.missing_pieces.remove(index)
+                self.availability.discard_candidate(index)
+                piece = self._make_piece(index)
+                self._start_piece(piece)
 
-                return piece.next_request_block()
+                return self._request_block(piece, peer_id)
         return None
 
     def _write(self, piece):
 
         pos = piece.index * self.torrent.piece_length
-        os.lseek(self.fd, pos, os.SEEK_SET)
-        os.write(self.fd, piece.data)
+        self._unwritten.add(piece.index)
+        self.writer.submit(pos, piece.data,
+                           lambda: self._piece_written(piece.index, piece.data),
+                           lambda error: self._write_failed(piece, error))
+
+    def _write_failed(self, piece, error):
+        # кусок не попал на диск: он снова недостающий и скачается заново,
+        # а ждущие его чтения получают ошибку
+        index = piece.index
+        self._unwritten.discard(index)
+        self.have_pieces.discard(index)
+        self.memory.release(piece.length)
+        piece.reset()
+        if self.piece_priority[index] == SKIP:
+            self.skipped_pieces.add(index)
+        else:
+            self.missing_pieces.add(index)
+            self.availability.add_candidate(index, self.piece_priority[index])
+        for future in self._waiters.pop(index, []):
+            if not future.done():
+                future.set_exception(error)
+        self._wake_peers()
@@ -2,10 +2,17 @@ import struct  # Интерпретировать байты как упаков
 from concurrent.futures import CancelledError #Это исключение можно перехватить для выполнения пользовательских операций при отмене асинхронных задач. Почти во всех ситуациях необходимо повторно вызвать исключение.
 import asyncio # это библиотека для написания параллельного кода с использованием синтаксиса async/await
 from asyncio import Queue # очереди asyncio спроектированы так, чтобы быть похожими на классы queueмодуля. Хотя асинхронные очереди не являются потокобезопасными, они предназначены специально для использования в асинхронном/ожидающем коде
+import os
+import socket
+from collections import deque
+
+from stats import TransferStats
 
 import bitstring # это чистый модуль Python, разработанный, чтобы сделать создание и анализ двоичных данных максимально простым и естественным
 
 REQUEST_SIZE = 2**14 # размер запроса
+READ_AHEAD = 2**18 # сколько PeerProtocol читает из сокета за раз вне данных блока
+RECEIVE_BUFFER = 4 * 2**20 # SO_RCVBUF соединения с пиром, ядро ограничивает его net.core.rmem_max
 
 
 class ProtocolBaseError(BaseException): # исключение при работе протокола
@@ -36,7 +43,8 @@ class ProtocolBaseError(BaseException): # исключение при работ
 
 class ConnectionToPeer: # подключение к пиру
     def __init__(self, torrent_queue, torrent_hash,
-                 torrent_peer_id, torrent_piece_manager, torrent_on_block_cb=None):
+                 torrent_peer_id, torrent_piece_manager, torrent_on_block_cb=None,
+                 buffered: bool = False, choker=None):
         """
         :param torrent_queue: асинхронная очередь, содержащая список доступных пиров
         :param torrent_hash: Хэш SHA1 для информации метаданных
@@ -45,6 +53,10 @@ class ConnectionToPeer: # подключение к пиру
                               запросить
         :param torrent_on_block_cb: Функция обратного вызова для вызова, когда блок
                             получено от удаленного узла
+        :param buffered: соединение через PeerProtocol: данные блоков
+                         читаются из сокета прямо в буферы кусков
+        :param choker: Choker торрента, решающий, кому мы отдаём данные;
+                       без него разблокируется каждый заинтересованный пир
         """
 
         """
@@ -59,10 +71,18 @@ class ConnectionToPeer: # подключение к пиру
         self.torrent_hash = torrent_hash
         self.torrent_peer_id = torrent_peer_id
         self.torrent_remote_id = None # нигде не используется в коде
+        self.remote_id = None # id пира, известен после handshake
+        self.writer = None
+        self.outbox = None # OutgoingQueue текущего соединения
+        self.uploader = None # запросы пира к нам, PeerUploader
+        self._refill = None # запланированный wakeup() дозапрос блоков
+        self.stats = TransferStats(torrent_piece_manager.stats) # байты текущего пира, входят в счётчики торрента
         self.torrent_writer = None # нигде не используется в коде, но судя по всему нужен для записи данных
         self.torrent_reader = None # нигде не используется в коде, но судя по всему нужен для чтения данных
         self.torrent_piece_manager = torrent_piece_manager
         self.torrent_on_block_cb = torrent_on_block_cb
+        self.buffered = buffered
+        self.choker = choker
         self.torrent_future = asyncio.ensure_future(self.start()) # запускаем задачу из произвольного ожидаемого асинхронно
 
     async def start(self):
@@ -71,30 +91,57 @@ class ConnectionToPeer: # подключение к пиру
             print('Got assigned peer with: {ip}'.format(ip=ip)) # сообщение о том по какому ip назначен узел
 
             try: # пытаемся
-                self.reader, self.writer = await asyncio.open_connection(
-                    ip, port) # получить кортеж из открытого соединения
+                self.stats = TransferStats(self.torrent_piece_manager.stats)
+                if self.buffered: # PeerProtocol и читает, и пишет
+                    _, self.reader = await asyncio.get_running_loop() \
+                        .create_connection(
+                            lambda: PeerProtocol(self._block_buffer, self.stats),
+                            ip, port)
+                    self.writer = self.reader
+                else:
+                    self.reader, self.writer = await asyncio.open_connection(
+                        ip, port) # получить кортеж из открытого соединения
+                    _tune_socket(self.writer.transport)
+                self.outbox = OutgoingQueue(self.writer, self.stats)
                 print('Connection open to peer: {ip}'.format(ip=ip)) # если все хорошо пишем, что соединение открыто
 
-                buffer = await self.handshake() # ждем хэндшейк
+                buffer = await self.handshake() # ждем хэндшейк, Interested ушёл вместе с нашим
 
                 self.my_state.append('choked') # добавляем в список наших состояниц choked
-
-                await self.send_interested() # посылаем заинтересованное состояние
-                self.my_state.append('interested') # добавляем заинтересованное состояние к себе
-
-                async for message in StreamOfPeerIteratoration(self.reader, buffer): # итерируемся по итераторам Пира ка по range
+                if not self.torrent_piece_manager.complete: # раздающему от пира ничего не нужно
+                    self.my_state.append('interested') # добавляем заинтересованное состояние к себе
+                self.peer_state = ['choked'] # пир заблокирован нами, пока не попросит
+                self.uploader = self.torrent_piece_manager.uploader(
+                    self.remote_id, self.outbox, self.stats)
+                self.torrent_piece_manager.subscribe(self.remote_id,
+                                                     self.send_have,
+                                                     self.wakeup)
+                if self.choker:
+                    self.choker.add(self)
+
+                if self.buffered:
+                    messages = self.reader # после рукопожатия в нём ничего не осталось
+                else:
+                    messages = StreamOfPeerIteratoration(self.reader, buffer, self.stats)
+                async for message in messages: # итерируемся по итераторам Пира ка по range
                     if 'stopped' in self.my_state: # если наше состояние stopped, то break
                         break
                     if type(message) is BitField: # проверка типа на BitField
                         self.torrent_piece_manager.add_peer(self.remote_id,
-                                                    message.bitfield) # добавляем через add_peer id и bitfield MAGIC!
+                                                    message.bitfield,
+                                                    self.send_cancel) # добавляем через add_peer id и bitfield MAGIC!
                     elif type(message) is Interested: # проверка типа на Interested
                         self.peer_state.append('interested') # добавление в список пира состояния Interested
+                        if self.choker: # разблокирует, если есть свободный слот
+                            self.choker.interested(self)
+                        else:
+                            self.unchoke_peer()
                     elif type(message) is NotInterested: # проверка типа на NotInterested
                         if 'interested' in self.peer_state: # если в списке пира есть interested
                             self.peer_state.remove('interested') # удаляем из списка пира interested
                     elif type(message) is Choke: # проверка типа на Choke
                         self.my_state.append('choked') # добавление в наш список состояния Choke
+                        self.torrent_piece_manager.release_peer(self.remote_id) # запрошенное у пира больше не придёт
                     elif type(message) is Unchoke: # проверка типа на Unchoke
                         if 'choked' in self.my_state: # если в нашем списке есть chocked
                             self.my_state.remove('choked') # удалить из нашего списка состояний
@@ -104,22 +151,24 @@ class ConnectionToPeer: # подключение к пиру
                     elif type(message) is KeepAlive: # проверка типа на KeepAlive
                         pass # заглушка либо ничего не надо делать
                     elif type(message) is Piece: # проверка типа на Piece
-                        self.my_state.remove('pending_request') # удалить из наших состояний ожидающий запрос
+                        self.stats.payload_in(len(message.block))
                         self.torrent_on_block_cb(
                             peer_id=self.remote_id,
                             piece_index=message.index,
                             block_offset=message.begin,
                             data=message.block) # Вызов функции обратного вызова для вызова, когда блок получено от удаленного узла
+                        await self.torrent_piece_manager.wait_writable() # не читаем дальше, пока диск не догонит
                     elif type(message) is Request: # проверка типа на Request
-                        print('Ignoring the received Request message.')
+                        if 'choked' not in self.peer_state: # заблокированному не отвечаем
+                            self.uploader.request(message.index, message.begin,
+                                                  message.length)
                     elif type(message) is Cancel: # проверка типа на Cancel
-                        print('Ignoring the received Cancel message.')
+                        self.uploader.cancel(message.index, message.begin,
+                                             message.length) # блок ещё не ушёл - не отправим
 
                     if 'choked' not in self.my_state: # если choked нету в списке наших состояний
                         if 'interested' in self.my_state: # и если interested нету в списке наших состояний
-                            if 'pending_request' not in self.my_state: # и если pending_request нету в списке наших состояний
-                                self.my_state.append('pending_request') # добавить в список наших состояний ожидающий запрос
-                                await self.request_chunk() # вызвать асинхронную функцию
+                            await self.request_chunks() # дополнить очередь запросов к пиру
 
             except ProtocolBaseError as e: # обработка исключения протокола
                 print('Protocol error')
@@ -135,9 +184,20 @@ class ConnectionToPeer: # подключение к пиру
 
     def cancel(self):
         print('Closing peer {id}'.format(id=self.remote_id)) # закрываем пир
+        self.torrent_piece_manager.remove_peer(self.remote_id) # блоки пира снова доступны другим
+        if self.uploader: # его запросы к нам больше не нужны
+            self.uploader.close()
+            self.uploader = None
+        if self.choker:
+            self.choker.remove(self)
+        self.peer_state = []
+        if self._refill: # дозапрашивать уже некому
+            self._refill.cancel()
+            self._refill = None
         if not self.torrent_future.done(): # если не выполненно закрытие
             self.torrent_future.cancel() # то отменяем через torrent_future.cancel(). Есть прототип если перейти
         if self.writer: # если запись в файл открыта
+            self.outbox.flush() # Cancel и прочее, что ещё не ушло
             self.writer.close() # закрыть файл
 
         self.torrent_queue.task_done() # задание выполнено
@@ -147,29 +207,105 @@ class ConnectionToPeer: # подключение к пиру
         if not self.torrent_future.done(): # если не выполненно закрытие
             self.torrent_future.cancel()  # то отменяем через torrent_future.cancel(). Есть прототип если перейти
 
-    async def request_chunk(self):
-        block = self.torrent_piece_manager.next_request(self.remote_id) # получаем bool ответ от next_request. Реализация в Piece.py
-        if block: # если правда
-            message = Request(block.piece, block.offset, block.length).encode() # получаем message через Request.encode()
-            print('Requesting block {block} for piece {piece} '
-                          'of {length} bytes from peer {peer}'.format(
-                            piece=block.piece,
-                            block=block.offset,
-                            length=block.length,
-                            peer=self.remote_id))
+    async def request_chunks(self):
+        """
+        Держит в пути столько запросов, сколько позволяет очередь пира
+        (PieceManager.request_slots), все новые запросы уходят одной записью.
+        """
+        self._fill_requests()
+        await self.outbox.wait_writable() # ждём, только если пир не успевает принимать
+
+    def _fill_requests(self):
+        messages = []
+        for _ in range(self.torrent_piece_manager.request_slots(self.remote_id)):
+            block = self.torrent_piece_manager.next_request(self.remote_id) # получаем bool ответ от next_request. Реализация в Piece.py
+            if not block:
+                break
+            messages.append(
+                Request(block.piece, block.offset, block.length).encode()) # получаем message через Request.encode()
+        if messages:
+            print('Requesting {count} blocks from peer {peer}'.format(
+                count=len(messages), peer=self.remote_id))
+            self._write(b''.join(messages)) # уйдут одной записью со всем, что отправлено в этом проходе цикла
+
+    def wakeup(self):
+        """
+        PieceManager зовёт, когда снова есть что запросить. Запросы
+        дополняются в следующем проходе цикла, даже если пир молчит
+        """
+        if self._refill is None:
+            self._refill = asyncio.get_running_loop().call_soon(self._refill_requests)
+
+    def _refill_requests(self):
+        self._refill = None
+        if 'choked' not in self.my_state and 'interested' in self.my_state:
+            self._fill_requests()
+
+    def _block_buffer(self, index: int, begin: int, length: int):
+        return self.torrent_piece_manager.block_buffer(
+            self.remote_id, index, begin, length)
+
+    def _write(self, data: bytes):
+        # все исходящие байты проходят здесь: очередь соединения их
+        # склеивает и считает в счётчики
+        self.outbox.send(data)
 
-            self.writer.write(message) # запись message через поток writer в файл
-            await self.writer.drain() # делаем запись асинхронно
+    def send_cancel(self, block):
+        """
+        Отменяет запрос блока, который уже получен от другого пира
+        (эндшпиль). Ждать этот блок больше не нужно.
+        """
+        if self.outbox:
+            self._write(
+                Cancel(block.piece, block.offset, block.length).encode())
+
+    @property
+    def peer_interested(self) -> bool:
+        return self.uploader is not None and 'interested' in self.peer_state
+
+    @property
+    def peer_choked(self) -> bool:
+        return 'choked' in self.peer_state
+
+    def choke_peer(self):
+        """
+        Перестаём отдавать пиру данные, его запросы отбрасываются
+        """
+        if not self.peer_choked:
+            self.peer_state.append('choked')
+            if self.uploader:
+                self.uploader.clear()
+            self._write(Choke().encode())
+
+    def unchoke_peer(self):
+        if self.peer_choked:
+            self.peer_state.remove('choked')
+            self._write(Unchoke().encode())
+
+    def send_have(self, index: int):
+        """
+        Сообщает пиру, что у нас появился кусок index
+        """
+        self._write(Have(index).encode())
+        if self.torrent_piece_manager.complete and 'interested' in self.my_state:
+            self.send_not_interested() # скачано всё, дальше только раздаём
 
     async def handshake(self): # получение handshake. Обмен рукопожатиями инициирует подключающийся клиент.
-        self.writer.write(ClientHandshake(self.torrent_hash, self.torrent_peer_id).encode()) # Он позволяет записывать любую строку в открытый файл по полю writer
-        await self.writer.drain() # Подождите, пока не будет уместно возобновить запись в поток.
+        self._write(ClientHandshake(self.torrent_hash, self.torrent_peer_id).encode()) # Он позволяет записывать любую строку в открытый файл по полю writer
+        bitfield = self.torrent_piece_manager.bitfield()
+        if any(bitfield): # BitField может быть только первым сообщением
+            self._write(BitField(bitfield).encode())
+        if not self.torrent_piece_manager.complete:
+            self.send_interested() # не дожидаясь ответа: пир прочитает его после рукопожатия
+        self.outbox.flush() # всё одним пакетом, дальше ждём ответ
 
         buf = b'' # инициализация бинарной строкой
         tries = 1 # счетчик попыток
         while len(buf) < ClientHandshake.length and tries < 10: # если попыток меньше 10 и длина буфера меньше фиксированной длины handshake
             tries += 1
-            buf = await self.reader.read(StreamOfPeerIteratoration.CHUNK_SIZE) # пытаемся поймать handshake
+            data = await self.reader.read(StreamOfPeerIteratoration.CHUNK_SIZE) # пытаемся поймать handshake
+            self.stats.wire_in(len(data))
+            buf += data # рукопожатие может прийти в нескольких чтениях
 
         response = ClientHandshake.decode(buf[:ClientHandshake.length]) # ответ на рукопожатие
         if not response: # если ошибка
@@ -182,105 +318,482 @@ class ConnectionToPeer: # подключение к пиру
 
         return buf[ClientHandshake.length:] # возварт handshake
 
-    async def send_interested(self):
+    def send_interested(self):
         message = Interested() # инициализация message
         print('Sending message: {type}'.format(type=message))
-        self.writer.write(message.encode()) # записываем message encode в файл
-        await self.writer.drain() # Подождите, пока не будет уместно возобновить запись в поток.
+        self._write(message.encode()) # записываем message encode в файл
+
+    def send_not_interested(self):
+        while 'interested' in self.my_state: # состояния копятся от прошлых пиров
+            self.my_state.remove('interested')
+        self._write(NotInterested().encode())
+
+
+class OutgoingQueue:
+    """
+    Исходящие сообщения одного соединения. Всё, что отправлено за один
+    проход цикла событий (пачка Request, Cancel в эндшпиле, Have), уходит
+    одной записью в конце прохода, а накопив FLUSH_BYTES - сразу.
+
+    Вместо drain() после каждого сообщения отправитель ждёт
+    wait_writable(), и то лишь пока в очереди и буфере транспорта больше
+    MAX_BUFFERED байт.
+
+    sendfile() отправляет данные прямо из файла, минуя память процесса.
+    """
+    FLUSH_BYTES = 64 * 2**10
+    MAX_BUFFERED = 256 * 2**10
+
+    def __init__(self, writer, stats=None):
+        """
+        :param writer: StreamWriter или PeerProtocol
+        """
+        self.writer = writer
+        self.stats = stats
+        self.writes = 0 # сколько раз писали в транспорт
+        self._messages = []
+        self._size = 0 # байт в _messages
+        self._flush = None # запланированный flush
+        self._held = 0 # идущие sendfile(), до их конца очередь не пишется
+        transport = writer.transport
+        if transport is not None:
+            # drain() ждёт, пока в транспорте не станет меньше MAX_BUFFERED
+            transport.set_write_buffer_limits(high=self.MAX_BUFFERED)
+
+    @property
+    def buffered(self) -> int:
+        """
+        Байт в очереди и в буфере транспорта
+        """
+        return self._size + self.writer.transport.get_write_buffer_size()
+
+    def send(self, data: bytes):
+        self._messages.append(data)
+        self._size += len(data)
+        if self.stats:
+            self.stats.wire_out(len(data))
+        if self._size >= self.FLUSH_BYTES:
+            self.flush()
+        elif self._flush is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush() # без цикла событий копить нечего
+                return
+            self._flush = loop.call_soon(self.flush)
+
+    def flush(self):
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+        if not self._messages or self._held:
+            return
+        messages = self._messages
+        self._messages = []
+        self._size = 0
+        self.writer.write(messages[0] if len(messages) == 1
+                          else b''.join(messages))
+        self.writes += 1
+
+    async def wait_writable(self):
+        if self.buffered > self.MAX_BUFFERED:
+            self.flush()
+            await self.writer.drain()
+
+    async def sendfile(self, fd: int, offset: int, count: int):
+        """
+        Отправляет count байт файла fd с offset. Диск читается в пуле
+        потоков: если транспорту нечего дописывать, данные уходят
+        os.sendfile из файла прямо в сокет, а то, что не поместилось в
+        буфер сокета, читается и встаёт в очередь на место этого вызова.
+        Пока идёт чтение, очередь не пишется в транспорт, поэтому
+        сообщения, отправленные тем временем, не разрывают данные.
+        """
+        self.flush()
+        transport = self.writer.transport
+        sock = transport.get_extra_info('socket')
+        out = None
+        if hasattr(os, 'sendfile') and sock is not None and \
+                not transport.get_write_buffer_size() and \
+                not transport.is_closing():
+            out = os.dup(sock.fileno()) # сокет могут закрыть, пока поток пишет
+        position = len(self._messages)
+        self._messages.append(b'')
+        self._held += 1
+        try:
+            sent, rest = await asyncio.get_running_loop().run_in_executor(
+                None, _send_from_file, out, fd, offset, count)
+            self._messages[position] = rest
+            self._size += len(rest)
+        finally:
+            self._held -= 1
+            if out is not None:
+                os.close(out)
+            if not self._held: # и при ошибке: накопленное ждало только нас
+                self.flush()
+        if self.stats:
+            self.stats.wire_out(count)
+
+
+def _send_from_file(out, fd: int, offset: int, count: int):
+    """
+    Выполняется в пуле потоков: os.sendfile в сокет out, затем чтение
+    того, что не поместилось. Возвращает (отправлено, остаток)
+    """
+    sent = 0
+    if out is not None:
+        try:
+            sent = os.sendfile(out, fd, offset, count)
+        except OSError: # сокет полон или файл не поддерживает sendfile
+            sent = 0
+    rest = os.pread(fd, count - sent, offset + sent) if sent < count else b''
+    return sent, rest
 
 
 class StreamOfPeerIteratoration: # итератор потока Пира
+    """
+    Разбор потока сообщений пира. Прочитанное дописывается в bytearray,
+    разобранное отмечается смещением _offset; перед следующим чтением
+    в начало переносится только недочитанный хвост. После каждого чтения
+    разбираются все целые сообщения, и они отдаются без новых чтений.
+    """
     CHUNK_SIZE = 10*1024 # размер куска
 
-    def __init__(self, reader, initial: bytes=None):
+    def __init__(self, reader, initial: bytes=None, stats=None):
         self.reader = reader # инициализация потока чтения
-        self.buffer = initial if initial else b'' #инициализация буффера
-
-    async def __aiter__(self): # для возврата асинхронного оператора
+        self.stats = stats # TransferStats, куда считать прочитанные байты
+        self._buffer = bytearray(initial or b'')
+        self._offset = 0 # сколько байт с начала _buffer уже разобрано
+        self._ready = deque() # разобранные, но ещё не отданные сообщения
+
+    @property
+    def buffer(self) -> bytes:
+        # неразобранные данные
+        return bytes(self._buffer[self._offset:])
+
+    @buffer.setter
+    def buffer(self, data):
+        self._buffer = bytearray(data or b'')
+        self._offset = 0
+
+    def __aiter__(self): # для возврата асинхронного оператора
         return self
 
     async def __anext__(self): # для возврата следующего асинхронного оператора
-        while True: # бесконечный цикл
-            try:
+        try:
+            while not self._ready:
+                self._ready.extend(self.drain()) # всё, что уже пришло
+                if self._ready:
+                    break
                 data = await self.reader.read(StreamOfPeerIteratoration.CHUNK_SIZE) # читаем 1 chunk
-                if data: # если все хорошо
-                    self.buffer += data # записываем chunk в buffer
-                    message = self.parse() # парсим итератор
-                    if message: # если успех вернуть message
-                        return message
-                else: # если ошибка вернуть,что не удалось прочитать chunk
+                if not data: # если ошибка вернуть,что не удалось прочитать chunk
                     print('No data read from stream')
-                    if self.buffer: # парсим итератор
-                        message = self.parse()
-                        if message: # если успех вернуть message
-                            return message
                     raise StopAsyncIteration() # вызов исключения асинхронного итератора
-            except ConnectionResetError: # исключение закрытие пира
-                print('Connection closed by peer')
-                raise StopAsyncIteration()
-            except CancelledError: # исключение закрытие пира
-                raise StopAsyncIteration()
-            except StopAsyncIteration as e:
-                raise e
-            except Exception: # исключение ошибки итерации
-                print('Error when iterating over stream!')
-                raise StopAsyncIteration()
+                if self.stats:
+                    self.stats.wire_in(len(data))
+                self.feed(data)
+        except ConnectionResetError: # исключение закрытие пира
+            print('Connection closed by peer')
+            raise StopAsyncIteration()
+        except CancelledError: # исключение закрытие пира
+            raise StopAsyncIteration()
+        except StopAsyncIteration as e:
+            raise e
+        except Exception: # исключение ошибки итерации
+            print('Error when iterating over stream!')
+            raise StopAsyncIteration()
+        return self._ready.popleft()
+
+    def feed(self, data):
+        if self._offset:
+            # сдвигаем только неразобранный хвост, обычно часть одного сообщения
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer += data
+
+    def drain(self) -> list:
+        """
+        Все целые сообщения из буфера
+        """
+        messages = []
+        while True:
+            message = self.parse()
+            if message is None:
+                return messages
+            messages.append(message)
 
     def parse(self): # парсер объекта
-        header_length = 4 # длина заголовка
-
-        if len(self.buffer) > 4:  # нужно для идентификации message
-            message_length = struct.unpack('>I', self.buffer[0:4])[0] # получаем длинну сообщения
-
+        """
+        Следующее целое сообщение из буфера или None, если оно пришло не
+        целиком. Неизвестные сообщения пропускаются.
+        """
+        buffer = self._buffer
+        while len(buffer) - self._offset >= 4: # нужно для идентификации message
+            start = self._offset
+            message_length = _LENGTH.unpack_from(buffer, start)[0] # получаем длинну сообщения
             if message_length == 0: # если длина равна нулю, то KeepAlive()
+                self._offset = start + 4
                 return KeepAlive()
+            end = start + 4 + message_length
+            if len(buffer) < end:
+                return None # ждём остаток сообщения
+            self._offset = end
+            decode = MESSAGE_DECODERS.get(buffer[start + 4])
+            if decode:
+                with memoryview(buffer) as view, view[start:end] as data:
+                    return decode(data)
+            print('Unsupported message!') # пакет не поддерживается, пропускаем
+        return None
 
-            if len(self.buffer) >= message_length: # если длинна буффера больше длины сообщения
-                message_id = struct.unpack('>b', self.buffer[4:5])[0] # полукчаем message_id
-
-                def _consume(): # функция потребитель
-                    self.buffer = self.buffer[header_length + message_length:] # возврат обрезанного buffer
-
-                def _data():  # функция данные
-                    return self.buffer[:header_length + message_length]  # возврат обрезанного buffer
-
-                if message_id is PeerResponse.BitField: # проверка на равенство message_id и BitField
-                    data = _data() # запись данных
-                    _consume() # потребить буффер
-                    return BitField.decode(data) # возврат декодированных данных
-                elif message_id is PeerResponse.Interested: # проверка на состояние Interested
-                    _consume() # потребить буффер
-                    return Interested() # вернуть заинтересованность
-                elif message_id is PeerResponse.NotInterested: # проверка на состояние not Interested
-                    _consume() # потребить буффер
-                    return NotInterested() # вернуть незаинтересованность
-                elif message_id is PeerResponse.Choke: # проверка на состояние Choke
-                    _consume() # потребить буффер
-                    return Choke() # вернуть закрытое состояние, но не Stopped!!!
-                elif message_id is PeerResponse.Unchoke: # проверка на состояние Unchoke
-                    _consume() # потребить буффер
-                    return Unchoke() # вернуть открыть
-                elif message_id is PeerResponse.Have: # проверка на Have. Have — сообщение, которое в любой момент может отправить нам удалённый пир
-                    data = _data() # получение данных
-                    _consume() # потребить буффер
-                    return Have.decode(data) # вернуть декодированные данные
-                elif message_id is PeerResponse.Piece: # проверка message_id на равенство Piece
-                    data = _data() # получение данных
-                    _consume() # потребить буффер
-                    return Piece.decode(data) # вернуть декодированные данные
-                elif message_id is PeerResponse.Request: # проверка message_id на соответсвие запросу
-                    data = _data() # получение данных
-                    _consume() # потребить буффер
-                    return Request.decode(data) # вернуть декодированные данные
-                elif message_id is PeerResponse.Cancel:  # проверка message_id на состояние отмены
-                    data = _data() # получение данных
-                    _consume() # потребить буффер
-                    return Cancel.decode(data) # вернуть декодированные данные
-                else:
-                    print('Unsupported message!') # иначе сказать, что пакет не поддреживается
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    """
+    Соединение с пиром на BufferedProtocol вместо пары StreamReader и
+    StreamWriter: read() и write()/drain()/close() для ConnectionToPeer,
+    асинхронная итерация отдаёт сообщения, как StreamOfPeerIteratoration.
+
+    После заголовка Piece get_buffer() отдаёт место в буфере куска от
+    block_buffer(index, begin, length), и ядро копирует данные блока сразу
+    туда; часть блока, уже прочитанная в буфер протокола вместе с
+    заголовком, переносится одним копированием. Блок, под который места
+    нет (не запрошен или уже получен), читается во временный буфер.
+
+    Вне данных блока из сокета читается до read_ahead байт. При
+    read_ahead=0 читается не дальше 13 байт за границей известного
+    сообщения, и данные блоков вообще не копируются, но на каждый блок
+    уходит два чтения, а итерация цикла событий дороже копирования 16 KiB.
+
+    До рукопожатия читается ровно рукопожатие, его забирает read().
+    """
+    MAX_MESSAGE = 2**20 # длиннее не бывает даже BitField, такой пир закрывается
+    MAX_QUEUED = 64 # сколько разобранных сообщений держать, дальше чтение на паузе
+
+    def __init__(self, block_buffer=None, stats=None):
+        """
+        :param block_buffer: функция (index, begin, length) -> memoryview в
+                             буфере куска или None
+        :param stats: TransferStats, куда считать байты после рукопожатия
+        """
+        self.block_buffer = block_buffer
+        self.stats = stats
+        self.read_ahead = READ_AHEAD
+        self.transport = None
+        self._buffer = bytearray(2**16)
+        self._start = 0 # начало неразобранных данных в _buffer
+        self._end = 0 # конец прочитанных данных в _buffer
+        self._handshake = True # пока ждём рукопожатие
+        self._payload = None # memoryview, куда читаются данные текущего Piece
+        self._received = 0 # сколько байт из _payload уже прочитано
+        self._header = None # (index, begin) текущего Piece
+        self._in_place = False # _payload лежит в буфере куска
+        self._messages = deque()
+        self._waiter = None # future, которую ждут read() и __anext__
+        self._drain_waiter = None
+        self._write_paused = False
+        self._read_paused = False
+        self._closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        _tune_socket(transport)
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self._wakeup()
+        if self._drain_waiter and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        if self._drain_waiter and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def get_buffer(self, sizehint):
+        if self._payload is not None:
+            return self._payload[self._received:]
+        want = self._wanted()
+        if self._end + want > len(self._buffer):
+            # здесь на _buffer нет чужих memoryview, его можно двигать
+            size = self._end - self._start
+            self._buffer[:size] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, size
+            if size + want > len(self._buffer):
+                self._buffer.extend(bytes(size + want - len(self._buffer)))
+        return memoryview(self._buffer)[self._end:self._end + want]
+
+    def buffer_updated(self, nbytes):
+        if self.stats and not self._handshake:
+            self.stats.wire_in(nbytes)
+        if self._payload is not None:
+            self._received += nbytes
+            if self._received == len(self._payload):
+                self._finish_piece()
+            return
+        self._end += nbytes
+        if self._handshake:
+            if self._end - self._start >= ClientHandshake.length:
+                self._pause_reading() # до read() читать больше нечего
+            self._wakeup()
+            return
+        self._parse()
+
+    def eof_received(self):
+        return False # транспорт закрывается, connection_lost завершит итерацию
+
+    async def read(self, n: int) -> bytes:
+        """
+        Данные рукопожатия, b'' - соединение закрыто
+        """
+        while self._start == self._end and not self._closed:
+            await self._wait()
+        end = min(self._end, self._start + n)
+        data = bytes(self._buffer[self._start:end])
+        self._start = end
+        if self._handshake and self._start >= ClientHandshake.length:
+            self._handshake = False
+            self._start = self._end = 0
+            self._resume_reading()
+        return data
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        if self._closed:
+            raise ConnectionResetError('Connection lost')
+        if self._write_paused:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+            await self._drain_waiter
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._messages:
+            if self._closed:
+                raise StopAsyncIteration()
+            await self._wait()
+        message = self._messages.popleft()
+        if self._read_paused and len(self._messages) < self.MAX_QUEUED // 2:
+            self._resume_reading()
+        return message
+
+    def _wanted(self) -> int:
+        # сколько читать в _buffer: до конца текущего сообщения и ещё 13
+        # байт - столько занимает заголовок Piece, если он следующий
+        available = self._end - self._start
+        if self._handshake:
+            return ClientHandshake.length - available
+        want = Piece.length + 4 - available
+        if available >= 5:
+            length = _LENGTH.unpack_from(self._buffer, self._start)[0]
+            if self._buffer[self._start + 4] != PeerResponse.Piece:
+                want = 4 + length - available + Piece.length + 4
+        return max(want, self.read_ahead)
+
+    def _parse(self):
+        buffer = self._buffer
+        while self._end - self._start >= 4 and self._payload is None:
+            start = self._start
+            available = self._end - start
+            length = _LENGTH.unpack_from(buffer, start)[0]
+            if length == 0:
+                self._start = start + 4
+                self._push(KeepAlive())
+                continue
+            if length > self.MAX_MESSAGE:
+                print('Message is too long, closing peer')
+                self.transport.close()
+                return
+            if available < 5:
+                break
+            message_id = buffer[start + 4]
+            if message_id == PeerResponse.Piece and length > Piece.length:
+                if available < Piece.length + 4:
+                    break
+                index, begin = _PIECE_HEADER.unpack_from(buffer, start + 5)
+                self._start = start + Piece.length + 4
+                self._begin_piece(index, begin, length - Piece.length)
+                continue
+            if available < 4 + length:
+                break
+            self._start = start + 4 + length
+            decode = MESSAGE_DECODERS.get(message_id)
+            if decode:
+                with memoryview(buffer) as view, view[start:start + 4 + length] as data:
+                    self._push(decode(data))
             else:
-                print('Not enough in buffer in order to parse') # иначе недостаточно данных из буффера
-        return None
+                print('Unsupported message!') # пакет не поддерживается, пропускаем
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _begin_piece(self, index: int, begin: int, length: int):
+        view = self.block_buffer(index, begin, length) \
+            if self.block_buffer else None
+        self._in_place = view is not None
+        if view is None:
+            view = memoryview(bytearray(length))
+        self._payload = view
+        self._header = (index, begin)
+        # начало блока, прочитанное вместе с заголовком, переносим на место
+        self._received = min(self._end - self._start, length)
+        if self._received:
+            view[:self._received] = \
+                self._buffer[self._start:self._start + self._received]
+            self._start += self._received
+        if self._received == length:
+            self._finish_piece()
+
+    def _finish_piece(self):
+        index, begin = self._header
+        block = self._payload if self._in_place else self._payload.obj
+        self._payload = None
+        self._push(Piece(index, begin, block))
+
+    def _push(self, message):
+        self._messages.append(message)
+        if len(self._messages) >= self.MAX_QUEUED:
+            self._pause_reading() # ConnectionToPeer не успевает
+        self._wakeup()
+
+    def _pause_reading(self):
+        if not self._read_paused and not self._closed:
+            self._read_paused = True
+            self.transport.pause_reading()
+
+    def _resume_reading(self):
+        if self._read_paused and not self._closed:
+            self._read_paused = False
+            self.transport.resume_reading()
+
+    async def _wait(self):
+        self._waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+
+    def _wakeup(self):
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+def _tune_socket(transport):
+    # с большим окном приёма быстрый пир держит в пути больше данных;
+    # явный SO_RCVBUF выключает автонастройку ядра
+    sock = transport.get_extra_info('socket')
+    if sock is not None:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        except OSError:
+            pass
 
 
 class PeerResponse: # Ответы Пира
@@ -348,11 +861,11 @@ class BitField(PeerResponse):
         self.bitfield = bitstring.BitArray(bytes=data) # превращаем в bitstring байты data
 
     def encode(self) -> bytes:
-        bits_length = len(self.bitfield) # получаем длинну битовой строки
-        return struct.pack('>Ib' + str(bits_length) + 's',
-                           1 + bits_length,
+        data = self.bitfield.tobytes() # биты, дополненные нулями до целого байта
+        return struct.pack('>Ib' + str(len(data)) + 's',
+                           1 + len(data),
                            PeerResponse.BitField,
-                           self.bitfield) # упаковываем длину строки, ответ от пира в структуру
+                           data) # упаковываем длину строки, ответ от пира в структуру
 
     @classmethod
     def decode(cls, data: bytes):
@@ -378,16 +891,25 @@ class Interested(PeerResponse):
 
 
 class NotInterested(PeerResponse):
+    def encode(self) -> bytes:
+        return struct.pack('>Ib', 1, PeerResponse.NotInterested)
+
     def __str__(self):
         return 'NotInterested'
 
 
 class Choke(PeerResponse):
+    def encode(self) -> bytes:
+        return struct.pack('>Ib', 1, PeerResponse.Choke)
+
     def __str__(self):
         return 'Choke'
 
 
 class Unchoke(PeerResponse):
+    def encode(self) -> bytes:
+        return struct.pack('>Ib', 1, PeerResponse.Unchoke)
+
     def __str__(self):
         return 'Unchoke'
 
@@ -456,6 +978,15 @@ class Piece(PeerResponse): # класс Piece но это не ток класс
                            self.begin,
                            self.block) # упаковка в структуру ответа пира, индекса куска в потоке, с какого момента начинаем запись, блока данных
 
+    @staticmethod
+    def header(index: int, begin: int, length: int) -> bytes:
+        """
+        Заголовок сообщения Piece с блоком длины length: сам блок можно
+        отправить следом отдельно, не склеивая с заголовком
+        """
+        return struct.pack('>IbII', Piece.length + length, PeerResponse.Piece,
+                           index, begin)
+
     @classmethod
     def decode(cls, data: bytes):
         print('Decoding Piece of length: {length}'.format(
@@ -494,4 +1025,20 @@ class Cancel(PeerResponse): # класс отмены
         return 'Cancel'
 
 
-# последние 4 класса друг с другом очень похожи. Have, Request, Piece, Cancel имеют почти одинаковую структуру и отличаются лишь ответами
\ No newline at end of file
+# последние 4 класса друг с другом очень похожи. Have, Request, Piece, Cancel имеют почти одинаковую структуру и отличаются лишь ответами
+
+
+_LENGTH = struct.Struct('>I')
+_PIECE_HEADER = struct.Struct('>II') # index и begin сообщения Piece
+
+MESSAGE_DECODERS = { # message_id -> функция, разбирающая сообщение целиком
+    PeerResponse.Choke: lambda data: Choke(),
+    PeerResponse.Unchoke: lambda data: Unchoke(),
+    PeerResponse.Interested: lambda data: Interested(),
+    PeerResponse.NotInterested: lambda data: NotInterested(),
+    PeerResponse.Have: Have.decode,
+    PeerResponse.BitField: BitField.decode,
+    PeerResponse.Request: Request.decode,
+    PeerResponse.Piece: Piece.decode,
+    PeerResponse.Cancel: Cancel.decode,
+}
@@ -0,0 +1,75 @@
+"""
+Проверка уже скачанных данных: файлы отображаются в память через mmap,
+хэши кусков считаются параллельно в пуле процессов. Каждый процесс
+получает непрерывный диапазон кусков и возвращает индексы совпавших.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+
+from storage import FileStorage
+from torrent import HASH_LENGTH, PieceHashes
+
+
+def recheck(files, piece_length: int, hashes, root: str = '',
+            priorities=None, workers: int = None) -> set:
+    """
+    Индексы кусков, данные которых на диске совпадают с хэшами.
+
+    :param files: список TorrentFile(name, length) в порядке торрента
+    :param hashes: таблица хэшей кусков (PieceHashes или bytes)
+    :param priorities: приоритеты файлов, пропускаемые файлы не читаются
+    """
+    data = hashes.tobytes() if isinstance(hashes, PieceHashes) else bytes(hashes)
+    total = len(data) // HASH_LENGTH
+    if not total:
+        return set()
+    workers = workers or os.cpu_count() or 1
+    # по несколько диапазонов на процесс, чтобы быстрые не простаивали
+    step = max(1, -(-total // (workers * 4)))
+    jobs = [(files, root, priorities, piece_length, first,
+             data[first * HASH_LENGTH:(first + step) * HASH_LENGTH])
+            for first in range(0, total, step)]
+
+    valid = set()
+    if workers == 1:
+        results = map(_check_range, jobs)
+        for result in results:
+            valid.update(result)
+        return valid
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(_check_range, jobs):
+            valid.update(result)
+    return valid
+
+
+def _check_range(job) -> list:
+    # выполняется в процессе пула, поэтому функция модульного уровня
+    files, root, priorities, piece_length, first, hashes = job
+    storage = FileStorage(files, root, priorities, readonly=True)
+    maps = {}
+    valid = []
+    try:
+        for i in range(len(hashes) // HASH_LENGTH):
+            index = first + i
+            offset = index * piece_length
+            length = min(piece_length, storage.total_size - offset)
+            piece_hash = sha1()
+            for file_index, file_offset, size in storage.spans(offset, length):
+                if file_index not in maps:
+                    maps[file_index] = storage.map(file_index)
+                mapped = maps[file_index]
+                if mapped is None or len(mapped) < file_offset + size:
+                    break # файла нет или он ещё не дописан
+                with memoryview(mapped) as view:
+                    piece_hash.update(view[file_offset:file_offset + size])
+            else:
+                if piece_hash.digest() == \
+                        hashes[i * HASH_LENGTH:(i + 1) * HASH_LENGTH]:
+                    valid.append(index)
+    finally:
+        for mapped in maps.values():
+            if mapped is not None:
+                mapped.close()
+        storage.close()
+    return valid
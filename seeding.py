@@ -0,0 +1,179 @@
+"""
+Раздача: ответы на запросы блоков (Request) от пиров.
+"""
+import asyncio
+from collections import OrderedDict, deque
+
+from protocol import Piece
+
+READ_CACHE = 32 * 2**20 # байт кусков в кэше чтения
+MAX_BLOCK = 2**17 # запросы длиннее не обслуживаются
+MAX_REQUESTS = 256 # сколько запросов пира держать в очереди, лишние отбрасываются
+READ_AHEAD = 16 # сколько запросов пира отдавать за одно обращение к пулу потоков
+MISSES_KEPT = 1024 # сколько последних промахов кэша помнить
+
+
+class ReadCache:
+    """
+    LRU-кэш целых кусков для раздачи с пределом limit байт.
+
+    В кэш попадают только горячие куски: только что скачанные (их
+    данные и так в памяти, а пиры запросят их первыми после нашего Have)
+    и те, что просят сразу несколько пиров. Кусок, который читает один
+    пир, из кэша не вытесняет ничего и отдаётся прямо из файла.
+    """
+    def __init__(self, limit: int = READ_CACHE):
+        self.limit = limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._pieces = OrderedDict() # индекс куска -> данные, последний - самый свежий
+        self._missed = OrderedDict() # индекс куска -> пир, первым промахнувшийся по нему
+
+    def get(self, index: int):
+        data = self._pieces.get(index)
+        if data is not None:
+            self._pieces.move_to_end(index)
+            self.hits += 1
+        return data
+
+    def miss(self, index: int, peer_id) -> bool:
+        """
+        Отмечает промах пира по куску. True, если по нему уже промахнулся
+        другой пир: кусок стоит прочитать целиком и положить в кэш.
+        """
+        self.misses += 1
+        first = self._missed.get(index)
+        if first is None:
+            self._missed[index] = peer_id
+            if len(self._missed) > MISSES_KEPT:
+                self._missed.popitem(last=False)
+            return False
+        return first != peer_id
+
+    def put(self, index: int, data):
+        if len(data) > self.limit:
+            return
+        self.discard(index)
+        self._missed.pop(index, None)
+        self._pieces[index] = data
+        self.size += len(data)
+        while self.size > self.limit:
+            _, old = self._pieces.popitem(last=False)
+            self.size -= len(old)
+
+    def discard(self, index: int):
+        data = self._pieces.pop(index, None)
+        if data is not None:
+            self.size -= len(data)
+
+
+class PeerUploader:
+    """
+    Очередь запросов одного пира к нам. Блоки отдаются по порядку
+    задачей, которая живёт, пока очередь не пуста: из кэша чтения, а
+    холодные куски читаются preadv в пуле потоков прямо в буфер блока,
+    не останавливая цикл событий. С sendfile=True они уходят os.sendfile
+    из файлов, но для блоков по 16 KiB это лишний системный вызов на
+    блок и выходит медленнее (benchmarks.py upload).
+    Запросы берутся пачками по READ_AHEAD, Cancel убирает запрос, пока
+    его пачка не начала читаться.
+    """
+    def __init__(self, manager, peer_id, outbox, stats=None,
+                 sendfile: bool = False):
+        """
+        :param manager: PieceManager торрента
+        :param outbox: OutgoingQueue соединения с пиром
+        """
+        self.manager = manager
+        self.peer_id = peer_id
+        self.outbox = outbox
+        self.stats = stats
+        self.sendfile = sendfile
+        self.requests = deque() # (индекс, begin, length)
+        self._task = None
+
+    def request(self, index: int, begin: int, length: int) -> bool:
+        if len(self.requests) >= MAX_REQUESTS or \
+                not self.manager.can_upload(index, begin, length):
+            return False
+        self.requests.append((index, begin, length))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return True
+
+    def cancel(self, index: int, begin: int, length: int):
+        try:
+            self.requests.remove((index, begin, length))
+        except ValueError:
+            pass # уже отправлен
+
+    def clear(self):
+        """
+        Забывает все запросы, например когда мы заблокировали пира
+        """
+        self.requests.clear()
+
+    def close(self):
+        self.requests.clear()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        try:
+            while self.requests:
+                batch = [self.requests.popleft()
+                         for _ in range(min(len(self.requests), READ_AHEAD))]
+                await self._send(batch)
+                await self.outbox.wait_writable() # пир не успевает принимать
+        except ConnectionError:
+            self.requests.clear() # соединение закроет ConnectionToPeer
+        finally:
+            self._task = None
+
+    async def _send(self, batch):
+        manager = self.manager
+        cache = manager.read_cache
+        storage = manager.storage
+        loop = asyncio.get_running_loop()
+        blocks = [] # данные каждого блока, None - читать с диска
+        for index, begin, length in batch:
+            data = cache.get(index)
+            if data is None and cache.miss(index, self.peer_id):
+                data = await loop.run_in_executor(
+                    None, storage.read, index * manager.torrent.piece_length,
+                    manager.piece_length(index))
+                cache.put(index, data)
+            blocks.append(None if data is None
+                          else memoryview(data)[begin:begin + length])
+
+        cold = [i for i, block in enumerate(blocks) if block is None]
+        if cold and not self.sendfile:
+            # все холодные блоки пачки - одним заданием пула потоков
+            for i in cold:
+                blocks[i] = bytearray(batch[i][2])
+            await loop.run_in_executor(
+                None, _read_blocks, storage, manager.torrent.piece_length,
+                [batch[i] for i in cold], [blocks[i] for i in cold])
+
+        for (index, begin, length), block in zip(batch, blocks):
+            self.outbox.send(Piece.header(index, begin, length))
+            if block is not None:
+                self.outbox.send(block)
+            else:
+                offset = index * manager.torrent.piece_length + begin
+                for file_index, file_offset, size in storage.spans(offset,
+                                                                   length):
+                    await self.outbox.sendfile(storage.fileno(file_index),
+                                               file_offset, size)
+            if self.stats:
+                self.stats.payload_out(length)
+
+
+def _read_blocks(storage, piece_length: int, requests, buffers):
+    """
+    Выполняется в пуле потоков: читает блоки requests в buffers
+    """
+    for (index, begin, _), buffer in zip(requests, buffers):
+        storage.readinto(index * piece_length + begin, buffer)
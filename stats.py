@@ -0,0 +1,107 @@
+"""
+Учёт переданных байт: полезная нагрузка (данные блоков) и всё, что
+прошло через сокет, отдельно для каждого соединения и для торрента.
+"""
+import time
+
+
+class RateMeter:
+    """
+    Экспоненциально сглаженная скорость, байт в секунду.
+
+    add() только накапливает байты; раз в tick секунд накопленное
+    вливается в оценку с весом, при котором вклад старых замеров
+    уменьшается вдвое за half_life секунд. rate() стоит O(1).
+    """
+    __slots__ = ('half_life', 'tick', '_rate', '_pending', '_start')
+
+    def __init__(self, half_life: float = 5.0, tick: float = 0.5,
+                 now: float = None):
+        self.half_life = half_life
+        self.tick = tick
+        self._rate = 0.0
+        self._pending = 0 # байт с начала текущего интервала
+        self._start = time.monotonic() if now is None else now
+
+    def add(self, count: int, now: float):
+        if now - self._start >= self.tick:
+            self._fold(now)
+        self._pending += count
+
+    def rate(self, now: float = None) -> float:
+        if now is None:
+            now = time.monotonic()
+        if now - self._start >= self.tick:
+            self._fold(now)
+        return self._rate
+
+    def _fold(self, now: float):
+        elapsed = now - self._start
+        weight = 1 - 0.5 ** (elapsed / self.half_life)
+        self._rate += weight * (self._pending / elapsed - self._rate)
+        self._pending = 0
+        self._start = now
+
+
+class TransferStats:
+    """
+    Счётчики одного соединения или торрента. Счётчики соединения
+    передают всё и в счётчики торрента (parent).
+
+    downloaded, uploaded - байты данных блоков (Piece);
+    received, sent - все байты через сокет, включая служебные;
+    wasted - полученные данные, которые не пригодились: дубликаты и
+    куски с неверным хэшем.
+    """
+    __slots__ = ('parent', 'downloaded', 'uploaded', 'received', 'sent',
+                 'wasted', 'download_rate', 'upload_rate')
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.downloaded = 0
+        self.uploaded = 0
+        self.received = 0
+        self.sent = 0
+        self.wasted = 0
+        now = time.monotonic()
+        self.download_rate = RateMeter(now=now)
+        self.upload_rate = RateMeter(now=now)
+
+    @property
+    def protocol_received(self) -> int:
+        return self.received - self.downloaded
+
+    @property
+    def protocol_sent(self) -> int:
+        return self.sent - self.uploaded
+
+    def wire_in(self, count: int):
+        self.received += count
+        if self.parent:
+            self.parent.received += count
+
+    def wire_out(self, count: int):
+        self.sent += count
+        if self.parent:
+            self.parent.sent += count
+
+    def payload_in(self, count: int, now: float = None):
+        if now is None:
+            now = time.monotonic()
+        self.downloaded += count
+        self.download_rate.add(count, now)
+        if self.parent:
+            self.parent.payload_in(count, now)
+
+    def payload_out(self, count: int, now: float = None):
+        if now is None:
+            now = time.monotonic()
+        self.uploaded += count
+        self.upload_rate.add(count, now)
+        if self.parent:
+            self.parent.payload_out(count, now)
+
+    def waste(self, count: int):
+        self.wasted += count
+        if self.parent:
+            self.parent.waste(count)
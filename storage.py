@@ -0,0 +1,361 @@
+import asyncio
+import logging
+import mmap
+import os
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Приоритеты файлов торрента
+SKIP = 0 # файл не скачивается и не создаётся на диске
+NORMAL = 1
+HIGH = 2
+
+IOV_MAX = 1024 # сколько буферов можно передать в один pwritev
+
+
+class FileStorage:
+    """
+    Отображает сплошной поток байт торрента на его файлы.
+
+    Начала файлов хранятся в отсортированном списке offsets, поэтому
+    файл для любого смещения находится через bisect. Кусок, лежащий на
+    границе файлов, пишется одним os.pwrite на каждый затронутый файл.
+    Файлы с приоритетом SKIP не открываются и не создаются.
+    """
+    def __init__(self, files, root: str = '', priorities=None,
+                 readonly: bool = False):
+        """
+        :param files: список TorrentFile(name, length) в порядке торрента
+        :param root: каталог, относительно которого создаются файлы
+        :param priorities: приоритеты файлов, по умолчанию все NORMAL
+        :param readonly: только читать существующие файлы, ничего не создавать
+        """
+        self.files = files
+        self.root = root
+        self.readonly = readonly
+        self.priorities = list(priorities) if priorities else \
+            [NORMAL] * len(files)
+        self.offsets = []
+        offset = 0
+        for f in files:
+            self.offsets.append(offset)
+            offset += f.length
+        self.total_size = offset
+        self._fds = {}
+        self._lock = threading.Lock() # файлы открываются и из потоков записи
+
+        for index, f in enumerate(files):
+            if f.length == 0 and self.priorities[index] != SKIP \
+                    and not readonly:
+                self._fd(index)
+
+    def spans(self, offset: int, length: int):
+        """
+        Участки (индекс файла, смещение в файле, длина), покрывающие
+        length байт потока начиная с offset.
+        """
+        index = bisect_right(self.offsets, offset) - 1
+        end = offset + length
+        while offset < end and index < len(self.files):
+            file_end = self.offsets[index] + self.files[index].length
+            if file_end > offset:
+                size = min(end, file_end) - offset
+                yield index, offset - self.offsets[index], size
+                offset += size
+            index += 1
+
+    def files_in_range(self, offset: int, length: int):
+        """
+        Индексы файлов, которые пересекает заданный диапазон.
+        """
+        return [index for index, _, _ in self.spans(offset, length)]
+
+    def write(self, offset: int, data):
+        view = memoryview(data)
+        position = 0
+        for index, file_offset, size in self.spans(offset, len(view)):
+            if self.priorities[index] != SKIP:
+                _pwrite_all(self._fd(index), view[position:position + size],
+                            file_offset)
+            position += size
+
+    def writev(self, offset: int, buffers):
+        """
+        Пишет подряд идущие буферы начиная с offset: один pwritev на
+        каждый затронутый файл вместо отдельной записи на каждый буфер.
+        """
+        views = [memoryview(b).cast('B') for b in buffers]
+        length = sum(len(v) for v in views)
+        for index, file_offset, size in self.spans(offset, length):
+            # отрезаем от начала views ровно size байт для этого файла
+            parts = []
+            while size:
+                view = views[0]
+                if len(view) <= size:
+                    parts.append(view)
+                    views.pop(0)
+                else:
+                    parts.append(view[:size])
+                    views[0] = view[size:]
+                size -= len(parts[-1])
+            if self.priorities[index] != SKIP:
+                _pwritev_all(self._fd(index), parts, file_offset)
+
+    def fsync(self):
+        for fd in list(self._fds.values()):
+            os.fsync(fd)
+
+    def read(self, offset: int, length: int) -> bytes:
+        parts = []
+        for index, file_offset, size in self.spans(offset, length):
+            if self.priorities[index] == SKIP:
+                parts.append(bytes(size))
+            else:
+                parts.append(os.pread(self._fd(index), size, file_offset))
+        return b''.join(parts)
+
+    def readinto(self, offset: int, buffer):
+        """
+        Читает len(buffer) байт потока с offset прямо в buffer: один
+        preadv на каждый затронутый файл, без промежуточных bytes.
+        """
+        view = memoryview(buffer).cast('B')
+        position = 0
+        for index, file_offset, size in self.spans(offset, len(view)):
+            part = view[position:position + size]
+            if self.priorities[index] == SKIP:
+                part[:] = bytes(size)
+            else:
+                _preadv_all(self._fd(index), part, file_offset)
+            position += size
+        return position
+
+    def fileno(self, index: int) -> int:
+        """
+        Дескриптор файла торрента, например для os.sendfile
+        """
+        return self._fd(index)
+
+    def map(self, index: int):
+        """
+        mmap уже записанной части файла только для чтения или None, если
+        файла нет или он пуст. Отображение может быть короче файла торрента.
+        """
+        if self.priorities[index] == SKIP:
+            return None
+        try:
+            fd = self._fd(index)
+        except FileNotFoundError:
+            return None
+        size = min(os.fstat(fd).st_size, self.files[index].length)
+        if not size:
+            return None
+        return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+
+    def path(self, index: int) -> str:
+        return os.path.join(self.root, self.files[index].name)
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+    def _fd(self, index: int) -> int:
+        fd = self._fds.get(index)
+        if fd is None:
+            with self._lock:
+                fd = self._fds.get(index)
+                if fd is None:
+                    path = self.path(index)
+                    directory = os.path.dirname(path)
+                    if directory and not self.readonly:
+                        os.makedirs(directory, exist_ok=True)
+                    if self.readonly:
+                        fd = os.open(path, os.O_RDONLY)
+                    else:
+                        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+                    self._fds[index] = fd
+        return fd
+
+
+class StorageWriter:
+    """
+    Отложенная запись проверенных кусков вне цикла событий.
+
+    submit() только ставит кусок в очередь, запись выполняет пул потоков.
+    Куски, накопившиеся в очереди, сортируются по смещению и соседние
+    пишутся одним pwritev. Объём очереди ограничен max_queued байт:
+    пока она полна, full == True и wait_writable() ждёт её освобождения.
+    Если запись не удалась, вместо done вызывается failed(error).
+
+    fsync_interval: None - не вызывать fsync, 0 - после каждой записи,
+    иначе не чаще раза в fsync_interval секунд.
+    """
+    def __init__(self, storage: FileStorage, max_queued: int = 64 * 2**20,
+                 max_batch: int = 8 * 2**20, workers: int = 2,
+                 fsync_interval: float = None):
+        self.storage = storage
+        self.max_queued = max_queued
+        self.max_batch = max_batch
+        self.workers = workers
+        self.fsync_interval = fsync_interval
+        self.queued = 0 # байт в очереди и в процессе записи
+        self._pending = deque() # (offset, data, done, failed)
+        self._executor = ThreadPoolExecutor(workers,
+                                            thread_name_prefix='storage')
+        self._task = None
+        self._wakeup = None
+        self._writable = None
+        self._slots = None
+        self._last_fsync = time.monotonic()
+
+    @property
+    def full(self) -> bool:
+        return self.queued >= self.max_queued
+
+    def submit(self, offset: int, data, done=None, failed=None):
+        """
+        :param done: вызывается без аргументов в цикле событий, когда
+                     данные записаны на диск
+        :param failed: вызывается с исключением, если записать не удалось
+        """
+        self.queued += len(data)
+        self._pending.append((offset, data, done, failed))
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # без цикла событий (утилиты, тесты) пишем сразу
+            self._write_pending()
+            return
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._writable = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.workers)
+            self._task = asyncio.ensure_future(self._run())
+        self._wakeup.set()
+
+    async def wait_writable(self):
+        while self.full and self._writable:
+            self._writable.clear()
+            await self._writable.wait()
+
+    def close(self):
+        """
+        Дописывает всё, что осталось в очереди, и останавливает потоки.
+        """
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._executor.shutdown(wait=True)
+        self._write_pending()
+        if self.fsync_interval is not None:
+            self.storage.fsync()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                await self._slots.acquire()
+                batch, size, callbacks = self._take_batch()
+                future = loop.run_in_executor(self._executor,
+                                              self._write_batch, batch)
+                future.add_done_callback(
+                    lambda f, size=size, callbacks=callbacks:
+                    self._batch_done(f, size, callbacks))
+
+    def _batch_done(self, future, size, callbacks):
+        self._slots.release()
+        self.queued -= size
+        if not self.full:
+            self._writable.set()
+        if future.cancelled():
+            return
+        self._finish(callbacks, future.exception())
+
+    def _finish(self, callbacks, error):
+        if error is not None:
+            logging.error('Unable to write to disk: {error}'.format(
+                error=error))
+        for done, failed in callbacks:
+            if error is None:
+                if done:
+                    done()
+            elif failed:
+                failed(error)
+
+    def _take_batch(self):
+        # до max_batch байт из очереди, соседние куски склеиваются в серии
+        items = []
+        callbacks = []
+        size = 0
+        while self._pending and (not items or size < self.max_batch):
+            offset, data, done, failed = self._pending.popleft()
+            items.append((offset, data))
+            if done or failed:
+                callbacks.append((done, failed))
+            size += len(data)
+        items.sort(key=lambda item: item[0])
+
+        runs = []
+        for offset, data in items:
+            if runs and runs[-1][0] + runs[-1][1] == offset and \
+                    len(runs[-1][2]) < IOV_MAX:
+                runs[-1][1] += len(data)
+                runs[-1][2].append(data)
+            else:
+                runs.append([offset, len(data), [data]])
+        return runs, size, callbacks
+
+    def _write_batch(self, runs):
+        for offset, _, buffers in runs:
+            self.storage.writev(offset, buffers)
+        if self.fsync_interval is not None:
+            now = time.monotonic()
+            if now - self._last_fsync >= self.fsync_interval:
+                self._last_fsync = now
+                self.storage.fsync()
+
+    def _write_pending(self):
+        while self._pending:
+            batch, size, callbacks = self._take_batch()
+            error = None
+            try:
+                self._write_batch(batch)
+            except OSError as e:
+                error = e
+            self.queued -= size
+            self._finish(callbacks, error)
+
+
+def _pwrite_all(fd: int, data, offset: int):
+    # pwrite может записать не всё, дописываем остаток
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+
+def _pwritev_all(fd: int, buffers, offset: int):
+    while buffers:
+        written = os.pwritev(fd, buffers, offset)
+        offset += written
+        # убираем целиком записанные буферы, остаток первого оставляем
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers[0])
+            buffers = buffers[1:]
+        if written:
+            buffers = [buffers[0][written:]] + buffers[1:]
+
+
+def _preadv_all(fd: int, view, offset: int):
+    while view:
+        read = os.preadv(fd, [view], offset)
+        if not read:
+            raise EOFError('File is shorter than expected')
+        view = view[read:]
+        offset += read
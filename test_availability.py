@@ -0,0 +1,51 @@
+import random
+import unittest
+
+import bitstring
+
+from availability import PieceAvailability
+
+
+class PieceAvailabilityTests(unittest.TestCase):
+    def setUp(self):
+        self.availability = PieceAvailability(4, random.Random(1))
+        for index in range(4):
+            self.availability.add_candidate(index, 1)
+
+    def test_counts_follow_peers(self):
+        first = bitstring.BitArray(bytes=b'\xe0')
+        self.availability.add_peer(first)
+        self.availability.add_peer([0, 1, 0, 0])
+        self.availability.have(3)
+        self.assertEqual([1, 2, 1, 1], list(self.availability.counts))
+
+        self.availability.remove_peer(first)
+        self.assertEqual([0, 1, 0, 1], list(self.availability.counts))
+
+    def test_rarest_among_peer_pieces(self):
+        self.availability.add_peer([1, 1, 1, 0])
+        self.availability.add_peer([1, 1, 0, 0])
+        self.availability.add_peer([0, 1, 0, 1])
+        self.assertEqual(2, self.availability.rarest([1, 1, 1, 1]))
+        self.assertEqual(0, self.availability.rarest([1, 1, 0, 0]))
+        self.assertIsNone(self.availability.rarest([0, 0, 0, 0]))
+        self.assertEqual(0, self.availability.rarest([1, 1, 1, 1],
+                                                     skip=range(2, 4)))
+
+    def test_discarded_candidates_are_not_picked(self):
+        self.availability.add_peer([1, 1, 0, 0])
+        self.availability.discard_candidate(0)
+        self.assertEqual(1, self.availability.rarest([1, 1, 0, 0]))
+        self.availability.discard_candidate(1)
+        self.assertIsNone(self.availability.rarest([1, 1, 0, 0]))
+
+    def test_priority_before_rarity(self):
+        self.availability.add_peer([1, 1, 1, 1])
+        self.availability.add_peer([1, 1, 1, 0])
+        self.availability.add_candidate(1, 2)
+        self.assertEqual(1, self.availability.rarest([1, 1, 1, 1]))
+
+    def test_ties_are_broken_randomly(self):
+        self.availability.add_peer([1, 1, 1, 1])
+        picks = {self.availability.rarest([1, 1, 1, 1]) for _ in range(50)}
+        self.assertEqual({0, 1, 2, 3}, picks)
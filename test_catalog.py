@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from catalog import Catalog
+from torrent import Torrent
+
+TORRENTS = ['RimWorld.torrent', 'random.torrent',
+            'windows_10_pro_64bit_fleshka.torrent']
+
+
+class CatalogTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for filename in TORRENTS:
+            shutil.copy(filename, self.directory)
+        self.catalog = Catalog(os.path.join(self.directory, 'index.sqlite'))
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.directory)
+
+    def test_scan_and_lookup(self):
+        result = self.catalog.scan(self.directory, workers=2)
+        self.assertEqual((3, 0, 0, 0), tuple(result))
+
+        torrent = Torrent('windows_10_pro_64bit_fleshka.torrent')
+        entries = self.catalog.lookup(torrent.info_hash)
+        self.assertEqual(1, len(entries))
+        entry = entries[0]
+        self.assertEqual(torrent.output_file, entry.name)
+        self.assertEqual(torrent.total_size, entry.total_size)
+        self.assertEqual(torrent.piece_length, entry.piece_length)
+        self.assertEqual(len(torrent.pieces), entry.piece_count)
+        self.assertEqual(torrent.announce, entry.announce.split('\n')[0])
+
+    def test_rescan_skips_unchanged(self):
+        self.catalog.scan(self.directory, workers=2)
+        path = os.path.join(self.directory, 'random.torrent')
+        os.utime(path, (0, 0))
+        os.remove(os.path.join(self.directory, 'RimWorld.torrent'))
+
+        result = self.catalog.scan(self.directory, workers=2)
+        self.assertEqual((1, 1, 0, 1), tuple(result))
+        self.assertEqual(2, len(self.catalog))
+
+    def test_broken_file_is_reported(self):
+        with open(os.path.join(self.directory, 'broken.torrent'), 'wb') as f:
+            f.write(b'd4:info')
+        result = self.catalog.scan(self.directory, workers=1)
+        self.assertEqual(1, result.failed)
+        self.assertEqual(3, len(self.catalog))
+
+    def test_broken_rewrite_drops_old_entry(self):
+        self.catalog.scan(self.directory, workers=1)
+        path = os.path.join(self.directory, 'random.torrent')
+        with open(path, 'wb') as f:
+            f.write(b'd4:info')
+        os.utime(path, (0, 0))
+        result = self.catalog.scan(self.directory, workers=1)
+        self.assertEqual((0, 2, 1, 0), tuple(result))
+        self.assertEqual(2, len(self.catalog))
@@ -0,0 +1,147 @@
+import random
+import unittest
+from types import SimpleNamespace
+
+from choker import Choker
+from stats import RateMeter, TransferStats
+
+
+class FakeConnection:
+    def __init__(self, name, interested=True):
+        self.name = name
+        self.stats = TransferStats()
+        # модельное время начинается с нуля
+        self.stats.download_rate = RateMeter(now=0)
+        self.stats.upload_rate = RateMeter(now=0)
+        self.peer_state = ['choked'] + (['interested'] if interested else [])
+
+    @property
+    def peer_interested(self):
+        return 'interested' in self.peer_state
+
+    @property
+    def peer_choked(self):
+        return 'choked' in self.peer_state
+
+    def choke_peer(self):
+        self.peer_state.append('choked')
+
+    def unchoke_peer(self):
+        self.peer_state.remove('choked')
+
+
+class ChokerTests(unittest.TestCase):
+    def setUp(self):
+        self.manager = SimpleNamespace(complete=False)
+        self.choker = Choker(self.manager, slots=3, rng=random.Random(1))
+        # скорость отдачи нам растёт с номером пира, пир 5 не заинтересован
+        self.peers = [FakeConnection(i, interested=i != 5) for i in range(6)]
+        for peer in self.peers:
+            self.choker.add(peer)
+            for second in range(1, 11):
+                peer.stats.payload_in(1000 * peer.name, second)
+                peer.stats.payload_out(1000 * (5 - peer.name), second)
+
+    def _unchoked(self):
+        return {peer.name for peer in self.peers if not peer.peer_choked}
+
+    def test_fastest_peers_and_one_optimistic(self):
+        self.choker.rechoke(10)
+        unchoked = self._unchoked()
+        self.assertEqual(3, len(unchoked))
+        self.assertTrue({3, 4} < unchoked)
+        self.assertIn(self.choker.optimistic.name, [0, 1, 2])
+
+    def test_optimistic_rotates(self):
+        self.choker.rechoke(10)
+        first = self.choker.optimistic
+        self.choker.rechoke(20)
+        self.assertIs(first, self.choker.optimistic)
+        self.choker.rechoke(40)
+        self.assertIsNot(first, self.choker.optimistic)
+        self.assertTrue(first.peer_choked)
+        self.assertEqual(3, len(self._unchoked()))
+
+    def test_seeding_ranks_by_upload_rate(self):
+        self.manager.complete = True
+        self.choker.rechoke(10)
+        self.assertTrue({0, 1} < self._unchoked())
+
+    def test_interested_peer_takes_free_slot(self):
+        self.choker.interested(self.peers[0])
+        self.assertFalse(self.peers[0].peer_choked)
+        self.choker.rechoke(10)
+        late = FakeConnection('late')
+        self.choker.add(late)
+        self.choker.interested(late)
+        self.assertTrue(late.peer_choked) # все слоты заняты до пересмотра
+        optimistic = self.choker.optimistic
+        self.choker.remove(optimistic)
+        self.assertIsNone(self.choker.optimistic)
+        self.assertNotIn(optimistic, self.choker.connections)
+
+
+class ReciprocationTests(unittest.TestCase):
+    """
+    Рой в модельном времени: каждый пир отдаёт нам со своей скоростью,
+    но только пока мы отдаём ему (разблокирован нами). Скачав торрент,
+    мы остаёмся в рое и раздаём: быстрее всех забирают те, кто медленнее
+    всех отдавал.
+    """
+    def _swarm(self, rechoke, manager=None, seconds=900):
+        # seconds секунд качаем, затем столько же раздаём; возвращает
+        # средние скорости загрузки и раздачи
+        peers = [FakeConnection(i) for i in range(12)]
+        downloaded = uploaded = 0
+        for second in range(2 * seconds):
+            seeding = second >= seconds
+            if manager:
+                manager.complete = seeding
+            if second % 10 == 0:
+                rechoke(peers, second)
+            for peer in peers:
+                if peer.peer_choked:
+                    continue
+                take = 10000 * (12 - peer.name)
+                peer.stats.payload_out(take, second + 1)
+                if seeding:
+                    uploaded += take
+                else:
+                    rate = 10000 * (peer.name + 1)
+                    peer.stats.payload_in(rate, second + 1)
+                    downloaded += rate
+        return downloaded / seconds, uploaded / seconds
+
+    def test_tit_for_tat_beats_random_slots(self):
+        seeding = [] # (раздача tit-for-tat, раздача случайных слотов)
+        for seed in range(4):
+            with self.subTest(seed=seed):
+                manager = SimpleNamespace(complete=False)
+                choker = Choker(manager, slots=4, rng=random.Random(seed))
+                rng = random.Random(seed)
+
+                def tit_for_tat(peers, now):
+                    for peer in peers:
+                        choker.add(peer)
+                    choker.rechoke(now)
+
+                def random_slots(peers, now):
+                    chosen = rng.sample(peers, 4)
+                    for peer in peers:
+                        if peer in chosen and peer.peer_choked:
+                            peer.unchoke_peer()
+                        elif peer not in chosen and not peer.peer_choked:
+                            peer.choke_peer()
+
+                # лучшие три пира и оптимистичный слот против четырёх
+                # случайных: в среднем 260 KB/s и на загрузке, и на раздаче
+                downloaded, uploaded = self._swarm(tit_for_tat, manager)
+                random_downloaded, random_uploaded = \
+                    self._swarm(random_slots)
+                self.assertGreater(downloaded, 1.2 * random_downloaded)
+                # на раздаче слоты переходят к тем, кто быстрее забирает;
+                # их ищет оптимистичный слот, поэтому не за один прогон
+                self.assertGreater(uploaded, random_uploaded)
+                seeding.append((uploaded, random_uploaded))
+        self.assertGreater(sum(u for u, _ in seeding),
+                           1.2 * sum(r for _, r in seeding))
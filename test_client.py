@@ -0,0 +1,142 @@
+import asyncio
+import contextlib
+import io
+import os
+import unittest
+from types import SimpleNamespace
+
+from clientTorrent import TorrentClient, TorrentReader
+from protocol import REQUEST_SIZE
+from storage import SKIP
+from testutil import temp_manager
+
+
+class TorrentReaderTests(unittest.TestCase):
+    # 6 кусков по одному блоку, последний короче
+    def setUp(self):
+        self.data = os.urandom(5 * REQUEST_SIZE + 100)
+        self.manager = temp_manager(self, self.data, REQUEST_SIZE)
+        self.manager.add_peer('peer', [1] * 6)
+
+    def _deliver(self, block):
+        self.manager.block_received(
+            'peer', block.piece, block.offset,
+            self.data[block.piece * REQUEST_SIZE + block.offset:]
+            [:block.length])
+
+    def test_window_follows_cursor(self):
+        reader = TorrentReader(self.manager, window=2)
+        reader.seek(3 * REQUEST_SIZE + 10)
+        self.assertEqual([3, 4], [self.manager.next_request('peer').piece
+                                  for _ in range(2)])
+        reader.seek(-1, io.SEEK_END)
+        self.assertEqual(5, self.manager.next_request('peer').piece)
+        reader.close()
+        self.assertNotIn(self.manager.next_request('peer').piece, [3, 4, 5])
+
+    def test_read_waits_only_for_needed_pieces(self):
+        async def run():
+            reader = TorrentReader(self.manager, window=2)
+            reader.seek(REQUEST_SIZE - 5)
+            read = asyncio.ensure_future(reader.read(10))
+            await asyncio.sleep(0)
+            blocks = [self.manager.next_request('peer') for _ in range(2)]
+            self.assertEqual([0, 1], [b.piece for b in blocks])
+            self._deliver(blocks[1])
+            await asyncio.sleep(0.01)
+            self.assertFalse(read.done())
+            self._deliver(blocks[0])
+            self.assertEqual(self.data[REQUEST_SIZE - 5:REQUEST_SIZE + 5],
+                             await read)
+            self.assertEqual(REQUEST_SIZE + 5, reader.tell())
+            self.assertEqual(1, self.manager.read_cursor)
+
+            reader.seek(0, io.SEEK_END)
+            self.assertEqual(b'', await reader.read())
+
+        asyncio.run(run())
+
+    def test_read_of_skipped_file_fails(self):
+        # кусок 2 начинается в первом файле и заканчивается во втором
+        manager = temp_manager(self, self.data, REQUEST_SIZE,
+                               split=[2 * REQUEST_SIZE + 10])
+        manager.set_file_priority(1, SKIP)
+        self.assertNotIn(2, manager.skipped_pieces)
+
+        async def run():
+            reader = TorrentReader(manager)
+            reader.seek(2 * REQUEST_SIZE)
+            with self.assertRaisesRegex(ValueError, 'Piece 2'):
+                await reader.read(20)
+            self.assertEqual(2 * REQUEST_SIZE, reader.tell())
+
+        asyncio.run(run())
+
+    def test_invalid_seek(self):
+        reader = TorrentReader(self.manager)
+        with self.assertRaises(ValueError):
+            reader.seek(-1)
+        with self.assertRaises(ValueError):
+            reader.seek(0, 5)
+
+
+class FakeTracker:
+    # запоминает анонсы, пиров не возвращает
+    def __init__(self):
+        self.torrent = SimpleNamespace(info_hash=bytes(20))
+        self.peer_id = b'-PC0001-000000000000'
+        self.announces = []
+
+    async def connect(self, **kwargs):
+        self.announces.append(kwargs)
+        await asyncio.sleep(0)
+        return SimpleNamespace(interval=0.005)
+
+    def close(self):
+        pass
+
+
+class SeedingTests(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(2 * REQUEST_SIZE)
+        # файлы уже на диске, клиент находит их проверкой
+        self.torrent = temp_manager(self, self.data, REQUEST_SIZE,
+                                    write=True).torrent
+
+    def _run(self, seed):
+        async def run():
+            client = TorrentClient(self.torrent, seed=seed)
+            await client.tracker.http_client.close()
+            client.tracker = tracker = FakeTracker()
+            client.check_interval = 0.001
+            task = asyncio.ensure_future(client.start())
+            while not tracker.announces:
+                await asyncio.sleep(0.001)
+            client.piece_manager.recheck(workers=1) # торрент скачан
+            for _ in range(50):
+                await asyncio.sleep(0.001)
+            running = not task.done()
+            client.abort = True
+            await task
+            return tracker.announces, running
+
+        with contextlib.redirect_stdout(io.StringIO()): # соединения печатают
+            return asyncio.run(run())
+
+    def test_keeps_announcing_after_download(self):
+        announces, running = self._run(seed=True)
+        self.assertTrue(running)
+        self.assertTrue(announces[0]['first'])
+        self.assertEqual(len(self.data), announces[0]['left'])
+        events = [a['completed'] for a in announces]
+        self.assertEqual(1, events.count(True))
+        completed = events.index(True)
+        self.assertEqual(0, announces[completed]['left'])
+        self.assertGreater(len(announces), completed + 1) # раздача идёт дальше
+
+    def test_exits_without_seeding(self):
+        announces, running = self._run(seed=False)
+        self.assertFalse(running)
+        # трекер узнаёт о завершении и без раздачи
+        self.assertEqual([False, True], [a['completed'] for a in announces])
+        self.assertEqual(0, announces[-1]['left'])
@@ -0,0 +1,146 @@
+import io
+import unittest
+from collections import OrderedDict
+
+from decoder import Decoder, Encoder, ViewDecoder, StreamDecoder, \
+    StreamEncoder
+
+
+class ViewDecoderTests(unittest.TestCase):
+    def test_same_output_as_decoder(self):
+        for data in [b'i-42e', b'4:spam', b'0:', b'le', b'de',
+                     b'l4:spami7ee', b'd3:cow3:moo4:spaml1:a1:bee']:
+            self.assertEqual(Decoder(data).decode(),
+                             ViewDecoder(data).decode())
+
+    def test_same_output_on_torrent_files(self):
+        for filename in ['RimWorld.torrent', 'random.torrent',
+                         'windows_10_pro_64bit_fleshka.torrent']:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            self.assertEqual(Decoder(data).decode(),
+                             ViewDecoder(data).decode())
+
+    def test_dict_is_ordered(self):
+        result = ViewDecoder(b'd1:bi1e1:ai2ee').decode()
+        self.assertIsInstance(result, OrderedDict)
+        self.assertEqual([b'b', b'a'], list(result.keys()))
+
+    def test_lazy_views(self):
+        result = ViewDecoder(b'd3:key5:valuee', copy=False).decode()
+        self.assertIsInstance(list(result.keys())[0], bytes)
+        self.assertIsInstance(result[b'key'], memoryview)
+        self.assertEqual(b'value', bytes(result[b'key']))
+
+    def test_top_level_spans(self):
+        data = b'd4:infod1:bi1e1:ai2ee3:keyi3ee'
+        decoder = ViewDecoder(data)
+        decoder.decode()
+        start, end = decoder.spans[b'info']
+        # исходный порядок ключей сохраняется, в отличие от Encoder
+        self.assertEqual(b'd1:bi1e1:ai2ee', data[start:end])
+        start, end = decoder.spans[b'key']
+        self.assertEqual(b'i3e', data[start:end])
+
+    def test_bytearray_input(self):
+        self.assertEqual(b'spam', ViewDecoder(bytearray(b'4:spam')).decode())
+
+    def test_max_depth(self):
+        data = b'l' * 10 + b'e' * 10
+        self.assertEqual(10, _depth(ViewDecoder(data).decode()))
+        with self.assertRaises(RuntimeError):
+            ViewDecoder(data, max_depth=9).decode()
+
+    def test_max_size(self):
+        with self.assertRaises(ValueError):
+            ViewDecoder(b'4:spam', max_size=5)
+
+    def test_truncated_string(self):
+        with self.assertRaises(IndexError):
+            ViewDecoder(b'10:spam').decode()
+
+    def test_unexpected_end(self):
+        with self.assertRaises(EOFError):
+            ViewDecoder(b'l4:spam').decode()
+
+
+class StreamDecoderTests(unittest.TestCase):
+    def test_chunked_feed_matches_decoder(self):
+        with open('RimWorld.torrent', 'rb') as f:
+            data = f.read()
+        for chunk_size in [1, 10, 4096]:
+            decoder = StreamDecoder()
+            for i in range(0, len(data), chunk_size):
+                decoder.feed(data[i:i + chunk_size])
+            self.assertEqual(Decoder(data).decode(), decoder.close())
+
+    def test_top_level_items_emitted_when_complete(self):
+        decoder = StreamDecoder()
+        self.assertEqual([], decoder.feed(b'd8:intervali18'))
+        self.assertEqual([(b'interval', 1800)], decoder.feed(b'00e5:peer'))
+        self.assertEqual([], decoder.feed(b's'))
+        self.assertEqual([(b'peers', b'abcdef')], decoder.feed(b'6:abcdefe'))
+        self.assertTrue(decoder.done)
+
+    def test_keep_false_does_not_accumulate(self):
+        decoder = StreamDecoder(keep=False)
+        items = list(decoder.feed_file(io.BytesIO(b'd1:ai1e1:bl1:cee')))
+        self.assertEqual([(b'a', 1), (b'b', [b'c'])], items)
+        self.assertEqual(OrderedDict(), decoder.result)
+
+    def test_incomplete_input(self):
+        decoder = StreamDecoder()
+        decoder.feed(b'd1:a')
+        with self.assertRaises(EOFError):
+            decoder.close()
+
+
+
+class StreamEncoderTests(unittest.TestCase):
+    def test_same_output_as_encoder(self):
+        data = OrderedDict([(b'a', [b'spam', 42, -1]), (b'b', b''),
+                            (b'c', OrderedDict([(b'd', [])]))])
+        self.assertEqual(bytes(Encoder(data).encode()),
+                         StreamEncoder().encode(data))
+
+    def test_round_trip_torrent(self):
+        with open('random.torrent', 'rb') as f:
+            data = f.read()
+        self.assertEqual(data, StreamEncoder().encode(Decoder(data).decode()))
+
+    def test_keys_are_sorted(self):
+        self.assertEqual(b'd1:ai2e1:bi1ee',
+                         StreamEncoder().encode({'b': 1, b'a': 2}))
+
+    def test_file_sink(self):
+        sink = io.BytesIO()
+        written = StreamEncoder(sink, flush_size=4).encode(
+            [b'spam', 'eggs', 1, (2, 3)])
+        self.assertEqual(b'l4:spam4:eggsi1eli2ei3eee', sink.getvalue())
+        self.assertEqual(len(sink.getvalue()), written)
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            StreamEncoder().encode([1.5])
+
+    def test_failed_value_is_not_left_in_buffer(self):
+        encoder = StreamEncoder()
+        with self.assertRaises(TypeError):
+            encoder.encode({b'a': [1, None]})
+        self.assertEqual(b'2:xy', encoder.encode(b'xy'))
+
+        sink = io.BytesIO()
+        encoder = StreamEncoder(sink, flush_size=4)
+        with self.assertRaises(TypeError):
+            encoder.encode([b'spam', None])
+        sink.seek(0)
+        sink.truncate()
+        encoder.encode(b'xy')
+        self.assertEqual(b'2:xy', sink.getvalue())
+
+def _depth(value):
+    depth = 0
+    while isinstance(value, list):
+        depth += 1
+        value = value[0] if value else None
+    return depth
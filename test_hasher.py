@@ -0,0 +1,90 @@
+import asyncio
+import os
+import unittest
+from hashlib import sha1
+
+from hasher import PieceHasher
+from piece import Piece
+from protocol import REQUEST_SIZE
+from testutil import temp_manager
+from torrent import PieceHashes
+
+
+def _piece(data, hash_value=None):
+    piece = Piece(0, len(data), hash_value or sha1(data).digest())
+    # последний блок первым: хэш по ходу не считается, всё остаётся пулу
+    for offset in reversed(range(0, len(data), REQUEST_SIZE)):
+        piece.block_received(offset, data[offset:offset + REQUEST_SIZE])
+    return piece
+
+
+class PieceHasherTests(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(3 * REQUEST_SIZE)
+
+    def _check(self, hasher, piece):
+        async def run():
+            future = asyncio.get_running_loop().create_future()
+            hasher.submit(piece, lambda p, matches: future.set_result(matches))
+            self.assertFalse(future.done())
+            return await future
+
+        try:
+            return asyncio.run(run())
+        finally:
+            hasher.close()
+
+    def test_without_loop_hashes_at_once(self):
+        results = []
+        PieceHasher().submit(_piece(self.data),
+                             lambda piece, matches: results.append(matches))
+        PieceHasher().submit(_piece(self.data, bytes(20)),
+                             lambda piece, matches: results.append(matches))
+        self.assertEqual([True, False], results)
+
+    def test_threads_finish_incremental_hash(self):
+        piece = Piece(0, len(self.data), sha1(self.data).digest())
+        # первый блок уже в хэше, потоку остаются два последних
+        piece.block_received(0, self.data[:REQUEST_SIZE])
+        piece.block_received(2 * REQUEST_SIZE, self.data[2 * REQUEST_SIZE:])
+        piece.block_received(REQUEST_SIZE,
+                             self.data[REQUEST_SIZE:2 * REQUEST_SIZE])
+        hasher = PieceHasher()
+        self.assertTrue(self._check(hasher, piece))
+        self.assertEqual(0, hasher.in_progress)
+        self.assertFalse(self._check(PieceHasher(),
+                                     _piece(self.data, bytes(20))))
+
+    def test_processes(self):
+        self.assertTrue(self._check(PieceHasher(1, processes=True),
+                                    _piece(self.data)))
+
+
+class AsyncVerificationTests(unittest.TestCase):
+    # 2 куска по 2 блока, второй с неверным хэшем
+    def setUp(self):
+        self.data = os.urandom(4 * REQUEST_SIZE)
+        length = 2 * REQUEST_SIZE
+        self.manager = temp_manager(
+            self, self.data, length,
+            hashes=PieceHashes(sha1(self.data[:length]).digest() + bytes(20)))
+        self.manager.add_peer('peer', [1, 1])
+
+    def test_result_comes_back_to_manager(self):
+        async def run():
+            for _ in range(4):
+                block = self.manager.next_request('peer')
+                start = block.piece * 2 * REQUEST_SIZE + block.offset
+                self.manager.block_received(
+                    'peer', block.piece, block.offset,
+                    self.data[start:start + block.length])
+            # хэши ещё в пуле
+            self.assertEqual(set(), self.manager.have_pieces)
+            self.assertEqual(2, self.manager.hasher.in_progress)
+            while self.manager.hasher.in_progress:
+                await asyncio.sleep(0.001)
+
+        asyncio.run(run())
+        self.assertEqual({0}, self.manager.have_pieces)
+        self.assertEqual(1, self.manager.next_request('peer').piece)
+        self.assertEqual(2 * REQUEST_SIZE, self.manager.stats.wasted)
@@ -0,0 +1,483 @@
+import asyncio
+import errno
+import math
+import os
+import unittest
+from hashlib import sha1
+
+from memory import MemoryBudget, LOW_MEMORY_DEPTH
+from piece import Block, Piece, PieceManager, RequestTimer, \
+    MIN_REQUEST_TIMEOUT, INITIAL_QUEUE_DEPTH
+from protocol import REQUEST_SIZE
+from storage import SKIP, HIGH
+from testutil import FakeTorrent, piece_hashes, temp_manager
+from torrent import PieceHashes, TorrentFile
+
+
+def _torrent(lengths, piece_length):
+    total = sum(lengths)
+    count = (total + piece_length - 1) // piece_length
+    return FakeTorrent(
+        [TorrentFile('file{0}'.format(i), length)
+         for i, length in enumerate(lengths)],
+        piece_length, PieceHashes(bytes(20 * count)))
+
+
+class PieceTests(unittest.TestCase):
+    def setUp(self):
+        self.piece = Piece(0, 3 * REQUEST_SIZE, b'')
+
+    def test_blocks_requested_in_order(self):
+        offsets = [self.piece.next_request_block().offset for _ in range(3)]
+        self.assertEqual([0, REQUEST_SIZE, 2 * REQUEST_SIZE], offsets)
+        self.assertIsNone(self.piece.next_request_block())
+
+    def test_remaining_counter(self):
+        a, b, c = [bytes([i]) * REQUEST_SIZE for i in range(3)]
+        self.piece.block_received(REQUEST_SIZE, b)
+        self.piece.block_received(REQUEST_SIZE, b)
+        self.assertEqual(2, self.piece.remaining)
+        self.piece.block_received(0, a)
+        self.piece.block_received(2 * REQUEST_SIZE, c)
+        self.assertTrue(self.piece.is_complete_retrieved())
+        self.assertEqual(a + b + c, self.piece.data)
+
+    def test_hash_is_built_incrementally(self):
+        data = bytes(range(256)) * (3 * REQUEST_SIZE // 256)
+        piece = Piece(0, len(data), sha1(data).digest())
+        # хэш продвигается только по непрерывному началу куска
+        for offset, hashed in [(2 * REQUEST_SIZE, 0), (0, REQUEST_SIZE),
+                               (REQUEST_SIZE, 3 * REQUEST_SIZE)]:
+            piece.block_received(offset, data[offset:offset + REQUEST_SIZE])
+            self.assertEqual(hashed, piece._hashed)
+        self.assertTrue(piece.is_hash_matching())
+
+    def test_short_last_block(self):
+        piece = Piece(0, REQUEST_SIZE + 5, sha1(bytes(REQUEST_SIZE + 5)).digest())
+        piece.block_received(REQUEST_SIZE, bytes(5))
+        piece.block_received(0, bytes(REQUEST_SIZE))
+        self.assertTrue(piece.is_hash_matching())
+
+    def test_wrong_block_length_is_ignored(self):
+        self.piece.block_received(0, b'a')
+        self.assertEqual(3, self.piece.remaining)
+
+    def test_unknown_offset_is_ignored(self):
+        self.piece.block_received(5, b'x')
+        self.piece.block_received(10 * REQUEST_SIZE, b'x')
+        self.assertEqual(3, self.piece.remaining)
+
+    def test_reset(self):
+        for _ in range(3):
+            self.piece.next_request_block()
+        self.piece.block_received(0, bytes(REQUEST_SIZE))
+        self.piece.reset()
+        self.assertEqual(3, self.piece.remaining)
+        self.assertEqual(0, self.piece.next_request_block().offset)
+
+
+class PieceManagerFileTests(unittest.TestCase):
+    # три файла по 40000, 40000 и 20000 байт, куски по 32 KiB:
+    # кусок 0 - файл 0, 1 - файлы 0 и 1, 2 - файлы 1 и 2, 3 - файл 2
+    def setUp(self):
+        self.torrent = _torrent([40000, 40000, 20000], 2**15)
+
+    def _missing(self, manager):
+        return sorted(manager.missing_pieces)
+
+    def test_last_piece_blocks(self):
+        manager = PieceManager(self.torrent)
+        last = manager._make_piece(3)
+        self.assertEqual(100000 - 3 * 2**15, last.length)
+        self.assertEqual(100000 - 3 * 2**15, sum(
+            last.block_length(i) for i in range(last.block_count)))
+
+    def test_skip_removes_only_exclusive_pieces(self):
+        manager = PieceManager(self.torrent, file_priorities=[1, SKIP, 1])
+        self.assertEqual([0, 1, 2, 3], self._missing(manager))
+
+        manager.set_file_priority(0, SKIP)
+        self.assertEqual([2, 3], self._missing(manager))
+        self.assertEqual([0, 1], sorted(manager.skipped_pieces))
+
+        manager.set_file_priority(1, 1)
+        self.assertEqual([1, 2, 3], self._missing(manager))
+
+    def test_complete_ignores_skipped_pieces(self):
+        manager = PieceManager(self.torrent, file_priorities=[1, SKIP, SKIP])
+        manager.have_pieces = set(manager.missing_pieces)
+        manager.missing_pieces = set()
+        self.assertTrue(manager.complete)
+
+    def test_high_priority_pieces_are_picked_first(self):
+        manager = PieceManager(self.torrent, file_priorities=[1, 1, HIGH])
+        manager.add_peer('peer', [1, 1, 1, 1])
+        self.assertIn(manager._get_rarest_piece('peer').index, [2, 3])
+
+
+class PieceManagerIndexTests(unittest.TestCase):
+    def test_block_lookup(self):
+        manager = PieceManager(_torrent([3 * REQUEST_SIZE], REQUEST_SIZE))
+        manager.add_peer('peer', [1, 1, 1])
+        blocks = [manager.next_request('peer') for _ in range(3)]
+        self.assertIsNone(manager.next_request('peer'))
+        self.assertEqual(3, len(manager.pending_blocks))
+        self.assertEqual(3, len(manager.ongoing_pieces))
+
+        # хэш неверный, кусок сбрасывается и снова доступен для запроса
+        manager.block_received('peer', blocks[1].piece, 0, bytes(REQUEST_SIZE))
+        self.assertEqual(2, len(manager.pending_blocks))
+        self.assertEqual(blocks[1].piece, manager.next_request('peer').piece)
+
+    def test_wasted_and_left_bytes(self):
+        manager = PieceManager(_torrent([2 * REQUEST_SIZE + 10], REQUEST_SIZE))
+        manager.add_peer('peer', [1, 1, 1])
+        self.assertEqual(2 * REQUEST_SIZE + 10, manager.bytes_left)
+        block = manager.next_request('peer')
+        # хэш неверный: кусок отброшен целиком
+        manager.block_received('peer', block.piece, 0, bytes(block.length))
+        self.assertEqual(block.length, manager.stats.wasted)
+        # блок куска, который не качается
+        manager.block_received('peer', 99, 0, bytes(10))
+        self.assertEqual(block.length + 10, manager.stats.wasted)
+        self.assertEqual(0, manager.bytes_downloaded)
+
+        manager.have_pieces.add(2)
+        self.assertEqual(2 * REQUEST_SIZE, manager.bytes_left)
+
+    def test_block_status_array(self):
+        manager = PieceManager(_torrent([2 * REQUEST_SIZE + 10], REQUEST_SIZE))
+        manager.add_peer('peer', [1, 1, 1])
+        blocks = [manager.next_request('peer') for _ in range(3)]
+        self.assertEqual([10, REQUEST_SIZE, REQUEST_SIZE],
+                         sorted(b.length for b in blocks))
+        self.assertEqual(bytes([Block.Pending] * 3), manager.block_status)
+
+        # кусок из одного блока с неверным хэшем снова становится Missing
+        manager.block_received('peer', blocks[0].piece, 0,
+                               bytes(blocks[0].length))
+        self.assertEqual(Block.Missing,
+                         manager.block_status[blocks[0].piece])
+        self.assertEqual(2, manager.block_status.count(Block.Pending))
+
+    def test_recheck_seeds_have_pieces(self):
+        data = bytes(range(256)) * (3 * REQUEST_SIZE // 256)
+        manager = temp_manager(
+            self, data[:REQUEST_SIZE] + bytes(REQUEST_SIZE) +
+            data[2 * REQUEST_SIZE:], REQUEST_SIZE,
+            hashes=piece_hashes(data, REQUEST_SIZE), write=True)
+
+        self.assertEqual(2, manager.recheck(workers=1))
+        self.assertEqual({0, 2}, manager.have_pieces)
+        self.assertEqual({1}, manager.missing_pieces)
+        manager.add_peer('peer', [1, 1, 1])
+        self.assertEqual(1, manager.next_request('peer').piece)
+        self.assertIsNone(manager.next_request('peer'))
+
+
+class RequestTrackingTests(unittest.TestCase):
+    def setUp(self):
+        self.manager = PieceManager(_torrent([4 * REQUEST_SIZE], REQUEST_SIZE))
+        self.manager.add_peer('a', [1, 1, 1, 1])
+        self.manager.add_peer('b', [1, 1, 1, 1])
+
+    def test_remove_peer_releases_blocks(self):
+        blocks = [self.manager.next_request('a') for _ in range(2)]
+        self.assertEqual(2, len(self.manager.peer_requests['a']))
+        self.manager.remove_peer('a')
+        self.assertEqual({}, self.manager.pending_blocks)
+        self.assertEqual(0, self.manager.timers['b'].outstanding)
+        # снятые блоки отдаются следующему пиру раньше новых кусков
+        released = {(b.piece, b.offset) for b in blocks}
+        again = {(b.piece, b.offset) for b in
+                 [self.manager.next_request('b') for _ in range(2)]}
+        self.assertEqual(released, again)
+
+    def test_choke_releases_only_that_peer(self):
+        self.manager.next_request('a')
+        block = self.manager.next_request('b')
+        self.manager.release_peer('a')
+        self.assertEqual([(block.piece, block.offset)],
+                         list(self.manager.pending_blocks))
+        self.assertIn('a', self.manager.peers)
+
+    def test_expired_request_is_released(self):
+        block = self.manager.next_request('a')
+        request = self.manager.pending_blocks[(block.piece, block.offset)]
+        self.manager._expire_requests(request.deadline - 1)
+        self.assertEqual(1, len(self.manager.pending_blocks))
+        self.manager._expire_requests(request.deadline)
+        self.assertEqual({}, self.manager.pending_blocks)
+        self.assertEqual(2, self.manager.timers['a'].backoff)
+        self.assertEqual(0, self.manager.timers['a'].outstanding)
+        self.assertEqual(Block.Missing,
+                         self.manager.block_status[block.piece])
+
+    def test_late_block_after_release(self):
+        block = self.manager.next_request('a')
+        self.manager.release_peer('a')
+        self.manager.block_received('a', block.piece, 0, bytes(REQUEST_SIZE))
+        self.assertEqual({}, self.manager.pending_blocks)
+
+    def test_block_read_in_place(self):
+        block = self.manager.next_request('a')
+        key = (block.piece, block.offset, block.length)
+        self.assertIsNone(self.manager.block_buffer('b', *key)) # не запрашивали
+        view = self.manager.block_buffer('a', *key)
+        self.assertIsNone(self.manager.block_buffer('a', *key)) # уже читается
+        piece = self.manager.ongoing_pieces[block.piece]
+        self.assertIs(piece.buffer, view.obj)
+        view[:] = b'x' * block.length
+        # копия от другого пира не пишется поверх читаемого блока
+        self.manager.block_received('b', block.piece, block.offset,
+                                    bytes(block.length))
+        self.assertEqual(block.length, self.manager.stats.wasted)
+        self.manager.block_received('a', block.piece, block.offset, view)
+        self.assertEqual({}, self.manager.pending_blocks)
+        self.assertEqual({}, self.manager._receiving)
+        self.assertEqual(b'x' * block.length, bytes(piece.buffer))
+
+
+class RequestTimerTests(unittest.TestCase):
+    def test_timeout_follows_peer(self):
+        timer = RequestTimer()
+        self.assertEqual(60000, timer.timeout(300000))
+        for i in range(20):
+            timer.sample(i * 1000, i * 1000 + 400, REQUEST_SIZE)
+        self.assertAlmostEqual(400, timer.srtt, delta=1)
+        self.assertLess(timer.timeout(300000), 2 * MIN_REQUEST_TIMEOUT)
+        # чем больше запрошено у пира, тем дольше ждём
+        idle = timer.timeout(300000)
+        timer.outstanding = 100 * REQUEST_SIZE
+        self.assertGreater(timer.timeout(300000), idle)
+        self.assertEqual(1000, timer.timeout(1000))
+
+    def test_backoff(self):
+        timer = RequestTimer()
+        timer.sample(0, 100, REQUEST_SIZE)
+        base = timer.timeout(300000)
+        timer.expired()
+        self.assertEqual(2 * base, timer.timeout(300000))
+        timer.sample(1000, 1100, REQUEST_SIZE)
+        self.assertEqual(base, timer.timeout(300000))
+
+
+class EndgameTests(unittest.TestCase):
+    def setUp(self):
+        self.manager = PieceManager(_torrent([2 * REQUEST_SIZE], REQUEST_SIZE),
+                                    endgame_copies=2)
+        self.cancelled = []
+        for peer in ['a', 'b', 'c']:
+            self.manager.add_peer(
+                peer, [1, 1],
+                lambda block, peer=peer: self.cancelled.append(
+                    (peer, block.piece)))
+
+    def test_starts_when_everything_is_in_flight(self):
+        first = self.manager.next_request('a')
+        self.assertFalse(self.manager.endgame)
+        second = self.manager.next_request('a')
+        self.assertTrue(self.manager.endgame)
+        # у пира a уже всё запрошено, копий ему не дают
+        self.assertIsNone(self.manager.next_request('a'))
+        self.assertEqual(first.piece, self.manager.next_request('b').piece)
+        self.assertEqual(second.piece, self.manager.next_request('b').piece)
+        # endgame_copies=2: третий пир копий не получает
+        self.assertIsNone(self.manager.next_request('c'))
+
+    def test_first_copy_cancels_the_rest(self):
+        block = self.manager.next_request('a')
+        self.manager.next_request('a')
+        self.manager.next_request('b')
+        self.manager.block_received('b', block.piece, 0, bytes(REQUEST_SIZE))
+        self.assertEqual([('a', block.piece)], self.cancelled)
+        self.assertNotIn((block.piece, 0), self.manager.peer_requests['a'])
+        self.assertEqual(0, self.manager.duplicate_bytes)
+        self.assertEqual(REQUEST_SIZE, self.manager.timers['a'].outstanding)
+
+    def test_duplicate_takes_over_when_peer_leaves(self):
+        block = self.manager.next_request('a')
+        self.manager.next_request('a')
+        self.manager.next_request('b')
+        self.manager.remove_peer('a')
+        request = self.manager.pending_blocks[(block.piece, 0)]
+        self.assertEqual('b', request.peer_id)
+        self.assertEqual({}, self.manager.duplicates)
+        self.assertEqual(0, self.manager.duplicate_bytes)
+
+    def test_duplicate_bandwidth_limit(self):
+        self.manager.endgame_bytes = REQUEST_SIZE
+        self.manager.next_request('a')
+        self.manager.next_request('a')
+        self.assertIsNotNone(self.manager.next_request('b'))
+        self.assertIsNone(self.manager.next_request('b'))
+
+
+class QueueDepthTests(unittest.TestCase):
+    def test_depth_grows_to_bandwidth_delay_product(self):
+        timer = RequestTimer()
+        self.assertEqual(INITIAL_QUEUE_DEPTH, timer.depth)
+        # 100 ms до пира, 10 блоков в секунду на каждый блок очереди:
+        # скорость ограничена очередью, она растёт
+        now = 0
+        for _ in range(20):
+            now += 25
+            timer.sample(now - 100, now, REQUEST_SIZE)
+        self.assertGreater(timer.depth, INITIAL_QUEUE_DEPTH)
+        # канал 1 блок за 10 ms при 100 ms: BDP 10 блоков
+        for _ in range(200):
+            now += 10
+            timer.sample(now - 100, now, REQUEST_SIZE)
+        self.assertEqual(math.ceil(1.5 * 10) + 1, timer.depth)
+
+    def test_choke_and_timeout_shrink_depth(self):
+        manager = PieceManager(_torrent([8 * REQUEST_SIZE], REQUEST_SIZE),
+                               max_queue_depth=3)
+        manager.add_peer('a', [1] * 8)
+        self.assertEqual(3, manager.request_slots('a'))
+        manager.next_request('a')
+        self.assertEqual(2, manager.request_slots('a'))
+
+        manager.release_peer('a') # Choke
+        self.assertEqual(INITIAL_QUEUE_DEPTH // 2, manager.timers['a'].depth)
+        block = manager.next_request('a')
+        request = manager.pending_blocks[(block.piece, block.offset)]
+        manager._expire_requests(request.deadline)
+        self.assertEqual(INITIAL_QUEUE_DEPTH // 4, manager.timers['a'].depth)
+        self.assertEqual(0, manager.request_slots('unknown'))
+
+
+class MemoryBudgetTests(unittest.TestCase):
+    # 4 куска по 2 блока из нулей, в бюджет помещаются два куска
+    def setUp(self):
+        length = 2 * REQUEST_SIZE
+        self.budget = MemoryBudget(2 * length)
+        self.manager = temp_manager(self, bytes(4 * length), length,
+                                    memory=self.budget)
+        self.manager.add_peer('a', [1] * 4)
+
+    def test_new_pieces_wait_for_memory(self):
+        woken = []
+        self.manager.subscribe('a', lambda index: None,
+                               lambda: woken.append(True))
+        blocks = [self.manager.next_request('a') for _ in range(4)]
+        self.assertEqual(2, len({block.piece for block in blocks}))
+        self.assertTrue(self.manager.memory_tight)
+        self.assertIsNone(self.manager.next_request('a'))
+        self.assertEqual(4 * REQUEST_SIZE, self.budget.used)
+
+        # кусок записан на диск - память освободилась
+        for block in blocks[:2]:
+            self.manager.block_received('a', block.piece, block.offset,
+                                        bytes(REQUEST_SIZE))
+        self.assertEqual(2 * REQUEST_SIZE, self.budget.used)
+        self.assertFalse(self.manager.memory_tight)
+        self.assertEqual([True], woken) # пир сам может больше ничего не прислать
+        self.assertIsNotNone(self.manager.next_request('a'))
+
+    def test_corrupt_piece_wakes_peers(self):
+        woken = []
+        self.manager.subscribe('a', lambda index: None,
+                               lambda: woken.append(True))
+        blocks = [self.manager.next_request('a') for _ in range(2)]
+        for block in blocks:
+            self.manager.block_received('a', block.piece, block.offset,
+                                        b'x' * REQUEST_SIZE)
+        self.assertEqual([True], woken)
+        self.assertEqual(blocks[0].piece, self.manager.next_request('a').piece)
+        self.manager.remove_peer('a')
+        self.manager._wake_peers()
+        self.assertEqual([True], woken)
+
+    def test_pipeline_shrinks_while_tight(self):
+        self.manager.timers['a'].depth = 8
+        self.assertEqual(8, self.manager.request_slots('a'))
+        blocks = [self.manager.next_request('a') for _ in range(3)]
+        self.assertTrue(self.manager.memory_tight)
+        self.assertEqual(max(LOW_MEMORY_DEPTH - 3, 0),
+                         self.manager.request_slots('a'))
+        for block in blocks[:2]:
+            self.manager.block_received('a', block.piece, block.offset,
+                                        bytes(REQUEST_SIZE))
+        self.assertGreater(self.manager.request_slots('a'), LOW_MEMORY_DEPTH)
+
+    def test_one_piece_always_fits(self):
+        self.budget.limit = REQUEST_SIZE
+        self.assertIsNotNone(self.manager.next_request('a'))
+        self.assertIsNotNone(self.manager.next_request('a'))
+        self.assertIsNone(self.manager.next_request('a'))
+        self.assertEqual(2 * REQUEST_SIZE, self.budget.peak)
+
+
+class WriteFailureTests(unittest.TestCase):
+    # 2 куска по одному блоку, диск отказывает в записи
+    def setUp(self):
+        self.data = os.urandom(2 * REQUEST_SIZE)
+        self.manager = temp_manager(self, self.data, REQUEST_SIZE)
+        self.manager.add_peer('peer', [1, 1])
+
+    def _fail(self, offset, buffers):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    def _deliver(self):
+        block = self.manager.next_request('peer')
+        start = block.piece * REQUEST_SIZE + block.offset
+        self.manager.block_received('peer', block.piece, block.offset,
+                                    self.data[start:start + block.length])
+        return block.piece
+
+    def test_piece_is_downloaded_again(self):
+        manager = self.manager
+
+        async def run():
+            manager.storage.writev = self._fail
+            index = self._deliver()
+            with self.assertLogs(level='ERROR'), \
+                    self.assertRaises(OSError):
+                await manager.wait_piece(index)
+            self.assertNotIn(index, manager.have_pieces)
+            self.assertIn(index, manager.missing_pieces)
+            self.assertEqual(0, manager.memory.used)
+            self.assertEqual(Block.Missing, manager.block_status[index])
+
+            del manager.storage.writev
+            self._deliver()
+            self._deliver()
+            for i in range(2):
+                await manager.wait_piece(i)
+
+        asyncio.run(run())
+        self.assertTrue(manager.complete)
+        self.assertEqual(self.data, manager.storage.read(0, len(self.data)))
+
+
+class StreamingTests(unittest.TestCase):
+    def setUp(self):
+        self.manager = PieceManager(_torrent([8 * REQUEST_SIZE], REQUEST_SIZE))
+        self.manager.stream_window = 2
+        for peer in ['fast', 'slow']:
+            self.manager.add_peer(peer, [1] * 8)
+
+    def test_window_before_rarest(self):
+        self.manager.set_cursor(5)
+        self.assertEqual([5, 6], [self.manager.next_request('fast').piece
+                                  for _ in range(2)])
+        self.assertNotIn(self.manager.next_request('fast').piece, [5, 6])
+
+    def test_cursor_move_wakes_peers(self):
+        woken = []
+        self.manager.subscribe('fast', lambda index: None,
+                               lambda: woken.append('fast'))
+        self.manager.set_cursor(5)
+        self.manager.set_cursor(5)
+        self.assertEqual(['fast'], woken)
+        self.manager.set_cursor(None)
+        self.assertEqual(['fast', 'fast'], woken)
+
+    def test_slow_peer_skips_window(self):
+        # быстрый пир отдаёт блок за 10 ms, медленный за 1 s
+        self.manager.timers['fast'].sample(0, 10, REQUEST_SIZE)
+        self.manager.timers['slow'].sample(0, 1000, REQUEST_SIZE)
+        self.manager.set_cursor(0)
+        self.assertNotIn(self.manager.next_request('slow').piece, [0, 1])
+        self.assertEqual(0, self.manager.next_request('fast').piece)
@@ -1,7 +1,15 @@
+import asyncio
+import contextlib
+import io
+import tempfile
 import unittest
+from hashlib import sha1
 
+from memory import MemoryBudget
 from protocol import StreamOfPeerIteratoration, ClientHandshake, Have, Request, \
-    Piece, Interested, Cancel
+    Piece, Interested, Cancel, KeepAlive, PeerProtocol, OutgoingQueue, \
+    BitField, Choke, Unchoke, ConnectionToPeer
+from testutil import seed_server, temp_manager
 
 
 class PeerStreamIteratorTests(unittest.TestCase):
@@ -10,10 +18,215 @@ class PeerStreamIteratorTests(unittest.TestCase):
         iterator.buffer = ""
         self.assertIsNone(iterator.parse())
 
+    def test_parse_several_messages(self):
+        iterator = StreamOfPeerIteratoration(None)
+        piece = Piece(0, 0, b'ok').encode()
+        iterator.buffer = b'\x00\x00\x00\x00' + Have(33).encode() + piece[:-1]
+        self.assertIsInstance(iterator.parse(), KeepAlive)
+        self.assertEqual(33, iterator.parse().index)
+        self.assertIsNone(iterator.parse()) # Piece пришёл не целиком
+        iterator.buffer += piece[-1:]
+        self.assertEqual(b'ok', iterator.parse().block)
+        self.assertEqual(b'', iterator.buffer)
+
+    def test_drain_skips_unknown_messages(self):
+        iterator = StreamOfPeerIteratoration(None, Have(1).encode())
+        # Port (id 9) не поддерживается и пропускается
+        iterator.feed(b'\x00\x00\x00\x03\x09\x1a\xe1' + Have(2).encode() +
+                      Interested().encode()[:2])
+        messages = iterator.drain()
+        self.assertEqual([1, 2], [message.index for message in messages])
+        iterator.feed(Interested().encode()[2:])
+        self.assertIsInstance(iterator.parse(), Interested)
+        self.assertEqual([], iterator.drain())
+
 
 Tester = PeerStreamIteratorTests()
 Tester.test_parse_empty_buffer()
 
+class FakeTransport:
+    def __init__(self):
+        self.paused = False
+        self.closed = False
+
+    def get_extra_info(self, name):
+        return None
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def close(self):
+        self.closed = True
+
+
+class PeerProtocolTests(unittest.TestCase):
+    def setUp(self):
+        self.blocks = {} # (index, begin) -> bytearray, куда читать блок
+        self.protocol = PeerProtocol(
+            lambda index, begin, length:
+            memoryview(self.blocks[(index, begin)])
+            if (index, begin) in self.blocks else None)
+        self.transport = FakeTransport()
+        self.protocol.connection_made(self.transport)
+        self.reads = []
+
+    def _feed(self, data):
+        # как сокет, в котором уже лежат все данные
+        while data and not self.transport.paused:
+            buffer = self.protocol.get_buffer(-1)
+            size = min(len(buffer), len(data))
+            buffer[:size] = data[:size]
+            self.reads.append(size)
+            data = data[size:]
+            self.protocol.buffer_updated(size)
+        return data
+
+    def _messages(self):
+        async def collect():
+            self.protocol.connection_lost(None)
+            return [message async for message in self.protocol]
+        return asyncio.run(collect())
+
+    def test_handshake_then_messages(self):
+        handshake = ClientHandshake(bytes(20), b'-XX0000-000000000000').encode()
+        rest = self._feed(handshake + Have(7).encode())
+        self.assertEqual(Have(7).encode(), rest) # до read() дальше не читаем
+        self.assertEqual(handshake, asyncio.run(self.protocol.read(1024)))
+        self.assertEqual(b'', self._feed(rest))
+        self.assertEqual([7], [m.index for m in self._messages()])
+
+    def test_piece_data_lands_in_piece_buffer(self):
+        for read_ahead in [0, 2**16]:
+            with self.subTest(read_ahead=read_ahead):
+                self.setUp()
+                self.protocol._handshake = False
+                self.protocol.read_ahead = read_ahead
+                target = bytearray(8)
+                self.blocks[(1, 0)] = target
+                self._feed(b'\x00\x00\x00\x00' + Have(3).encode() +
+                           Piece(1, 0, b'12345678').encode() +
+                           Piece(2, 0, b'unwanted').encode() +
+                           Interested().encode())
+                if not read_ahead:
+                    # заголовок Piece не читается вместе с данными
+                    self.assertIn(8, self.reads)
+                keepalive, have, piece, unwanted, interested = \
+                    self._messages()
+                self.assertEqual(3, have.index)
+                self.assertIs(target, piece.block.obj)
+                self.assertEqual(b'12345678', target)
+                self.assertEqual(b'unwanted', unwanted.block)
+                self.assertIsInstance(interested, Interested)
+
+    def test_reading_pauses_while_messages_wait(self):
+        self.protocol._handshake = False
+        self._feed(Have(1).encode() * (PeerProtocol.MAX_QUEUED + 5))
+        self.assertTrue(self.transport.paused)
+
+        async def take():
+            return [await self.protocol.__anext__()
+                    for _ in range(PeerProtocol.MAX_QUEUED // 2 + 6)]
+        asyncio.run(take())
+        self.assertFalse(self.transport.paused)
+
+
+class FakeWriter:
+    def __init__(self):
+        self.transport = self
+        self.written = []
+        self.queued = 0 # байт в буфере транспорта
+        self.drained = 0
+
+    def set_write_buffer_limits(self, high=None):
+        self.high = high
+
+    def get_write_buffer_size(self):
+        return self.queued
+
+    def get_extra_info(self, name):
+        return None
+
+    def is_closing(self):
+        return False
+
+    def write(self, data):
+        self.written.append(data)
+
+    async def drain(self):
+        self.drained += 1
+        self.queued = 0
+
+
+class OutgoingQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.writer = FakeWriter()
+        self.queue = OutgoingQueue(self.writer)
+
+    def test_messages_of_one_tick_are_written_once(self):
+        async def run():
+            for i in range(3):
+                self.queue.send(Have(i).encode())
+            self.queue.send(Cancel(0, 0).encode())
+            self.assertEqual([], self.writer.written)
+            await asyncio.sleep(0)
+            self.queue.send(Have(9).encode())
+            await asyncio.sleep(0)
+
+        asyncio.run(run())
+        self.assertEqual([Have(0).encode() + Have(1).encode() +
+                          Have(2).encode() + Cancel(0, 0).encode(),
+                          Have(9).encode()], self.writer.written)
+        self.assertEqual(2, self.queue.writes)
+
+    def test_large_batch_is_written_at_once(self):
+        async def run():
+            self.queue.send(bytes(OutgoingQueue.FLUSH_BYTES))
+            self.assertEqual(1, len(self.writer.written))
+
+        asyncio.run(run())
+        # без цикла событий пишется сразу
+        self.queue.send(Have(1).encode())
+        self.assertEqual(Have(1).encode(), self.writer.written[-1])
+
+    def test_messages_sent_during_sendfile_follow_it(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'filedata')
+            f.flush()
+
+            async def run():
+                task = asyncio.ensure_future(
+                    self.queue.sendfile(f.fileno(), 0, 8))
+                await asyncio.sleep(0) # чтение идёт в пуле потоков
+                self.queue.send(Have(1).encode())
+                await task
+                # чтение упало - очередь всё равно пишется
+                task = asyncio.ensure_future(self.queue.sendfile(-1, 0, 8))
+                await asyncio.sleep(0)
+                self.queue.send(Have(2).encode())
+                with self.assertRaises(OSError):
+                    await task
+
+            asyncio.run(run())
+        self.assertEqual([b'filedata' + Have(1).encode(), Have(2).encode()],
+                         self.writer.written)
+
+    def test_backpressure_by_bytes(self):
+        async def run():
+            self.queue.send(Have(1).encode())
+            await self.queue.wait_writable()
+            self.assertEqual(0, self.writer.drained)
+            self.writer.queued = OutgoingQueue.MAX_BUFFERED
+            await self.queue.wait_writable()
+            self.assertEqual(1, self.writer.drained)
+            self.assertEqual([Have(1).encode()], self.writer.written)
+
+        asyncio.run(run())
+        self.assertEqual(OutgoingQueue.MAX_BUFFERED, self.writer.high)
+
+
 class HandshakeTests(unittest.TestCase):
     def test_construction(self):
         handshake = ClientHandshake(
@@ -95,6 +308,10 @@ class PieceTests(unittest.TestCase):
         self.assertEqual(piece.begin, 0)
         self.assertEqual(piece.block, b'ok')
 
+    def test_header_without_block(self):
+        self.assertEqual(Piece(3, 5, b'ok').encode()[:-2],
+                         Piece.header(3, 5, 2))
+
 
 Tester = PieceTests()
 Tester.test_can_construct_piece()
@@ -110,6 +327,17 @@ class InterestedTests(unittest.TestCase):
 Tester = InterestedTests()
 Tester.test_can_encode()
 
+class BitFieldTests(unittest.TestCase):
+    def test_round_trip(self):
+        raw = BitField(b'\xa0\x01').encode()
+        self.assertEqual(b'\x00\x00\x00\x03\x05\xa0\x01', raw)
+        self.assertEqual('a001', BitField.decode(raw).bitfield.hex)
+
+    def test_choke_unchoke(self):
+        self.assertEqual(b'\x00\x00\x00\x01\x00', Choke().encode())
+        self.assertEqual(b'\x00\x00\x00\x01\x01', Unchoke().encode())
+
+
 class CancelTests(unittest.TestCase):
     def test_can_encode(self):
         message = Cancel(0, 2)
@@ -125,6 +353,46 @@ class CancelTests(unittest.TestCase):
         self.assertEqual(message.index, 0)
         self.assertEqual(message.begin, 2)
 
+class ConnectionTests(unittest.TestCase):
+    def test_requests_resume_when_memory_is_released(self):
+        # в бюджет помещается один кусок: следующий можно начать, только
+        # когда предыдущий записан на диск, а сид к этому времени молчит
+        piece_length = 2**18
+        manager = temp_manager(self, bytes(16 * piece_length), piece_length,
+                               memory=MemoryBudget(piece_length))
+        info_hash = sha1(b'wakeup').digest()
+        connections = []
+
+        async def complete():
+            while not manager.complete:
+                await asyncio.sleep(0.005)
+
+        async def run():
+            server = await asyncio.start_server(
+                seed_server(info_hash, 16, connections), '127.0.0.1', 0)
+            queue = asyncio.Queue()
+            queue.put_nowait(server.sockets[0].getsockname()[:2])
+            peer = ConnectionToPeer(queue, info_hash, b'-PC0001-000000000000',
+                                    manager, manager.block_received)
+            try:
+                await asyncio.wait_for(complete(), 10)
+            finally:
+                peer.stop() # отменяет задачу, но соединение не закрывает
+                await asyncio.gather(peer.torrent_future,
+                                     return_exceptions=True)
+                peer.writer.close()
+                await peer.writer.wait_closed()
+                for writer in connections:
+                    writer.close()
+                    await writer.wait_closed()
+                server.close()
+                await server.wait_closed()
+
+        with contextlib.redirect_stdout(io.StringIO()): # соединение печатает
+            asyncio.run(run())
+        self.assertTrue(manager.complete)
+
+
 Tester = CancelTests()
 Tester.test_can_encode()
 Tester.test_can_decode()
\ No newline at end of file
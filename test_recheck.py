@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+from hashlib import sha1
+
+from recheck import recheck
+from storage import SKIP
+from torrent import PieceHashes, TorrentFile
+
+
+class RecheckTests(unittest.TestCase):
+    # куски по 16 байт поверх файлов 20, 0, 10 и 30 байт
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = [TorrentFile('a', 20), TorrentFile('empty', 0),
+                      TorrentFile('b', 10), TorrentFile('c', 30)]
+        self.data = bytes(range(60))
+        self.hashes = PieceHashes(b''.join(
+            sha1(self.data[i:i + 16]).digest() for i in range(0, 60, 16)))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, name, data):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(data)
+
+    def _recheck(self, **kwargs):
+        return recheck(self.files, 16, self.hashes, self.root, **kwargs)
+
+    def test_all_pieces_valid(self):
+        self._write('a', self.data[:20])
+        self._write('b', self.data[20:30])
+        self._write('c', self.data[30:])
+        self.assertEqual({0, 1, 2, 3}, self._recheck(workers=1))
+        self.assertEqual({0, 1, 2, 3}, self._recheck(workers=2))
+
+    def test_corrupt_and_missing_files(self):
+        self._write('a', self.data[:20])
+        self._write('b', b'x' + self.data[21:30])
+        # файла c нет: куски 1 и 2 испорчены, 3 целиком в c
+        self.assertEqual({0}, self._recheck(workers=1))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'c')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'empty')))
+
+    def test_short_file(self):
+        self._write('a', self.data[:20])
+        self._write('b', self.data[20:30])
+        # c дописан до 50-го байта потока, последний кусок неполный
+        self._write('c', self.data[30:50])
+        self.assertEqual({0, 1, 2}, self._recheck(workers=1))
+
+    def test_skipped_file_is_not_read(self):
+        self._write('a', self.data[:20])
+        self._write('b', self.data[20:30])
+        self._write('c', self.data[30:])
+        # куски 0 и 1 лежат в пропускаемом файле a
+        self.assertEqual({2, 3},
+                         self._recheck(priorities=[SKIP, 1, 1, 1], workers=1))
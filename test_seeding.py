@@ -0,0 +1,157 @@
+import asyncio
+import os
+import unittest
+
+from protocol import Have, OutgoingQueue, Piece, REQUEST_SIZE, \
+    StreamOfPeerIteratoration
+from seeding import ReadCache
+from stats import TransferStats
+from testutil import temp_manager
+
+
+class ReadCacheTests(unittest.TestCase):
+    def test_least_recently_used_is_evicted(self):
+        cache = ReadCache(10)
+        cache.put(0, b'aaaa')
+        cache.put(1, b'bbbb')
+        self.assertEqual(b'aaaa', cache.get(0))
+        cache.put(2, b'cccc')
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(8, cache.size)
+        cache.put(3, bytes(11)) # больше всего кэша
+        self.assertEqual([b'aaaa', b'cccc'], [cache.get(0), cache.get(2)])
+
+    def test_piece_is_hot_for_second_peer(self):
+        cache = ReadCache()
+        self.assertFalse(cache.miss(5, 'a'))
+        self.assertFalse(cache.miss(5, 'a'))
+        self.assertTrue(cache.miss(5, 'b'))
+        self.assertEqual(3, cache.misses)
+
+
+class UploadTests(unittest.TestCase):
+    # 3 куска по 2 блока поверх двух файлов, граница файлов внутри блока
+    def setUp(self):
+        self.data = os.urandom(5 * REQUEST_SIZE + 100)
+        self.manager = temp_manager(self, self.data, 2 * REQUEST_SIZE,
+                                    split=[REQUEST_SIZE + 10], write=True)
+
+    def _upload(self, requests, cancels=(), sendfile=False, peer='peer',
+                during=()):
+        """
+        Отдаёт блоки requests локальному приёмнику, возвращает полученные
+        сообщения Piece и счётчики соединения. Сообщения during
+        отправляются, пока читается первый блок
+        """
+        async def run():
+            done = asyncio.get_running_loop().create_future()
+
+            async def leecher(reader, writer):
+                messages = []
+                async for message in StreamOfPeerIteratoration(reader):
+                    messages.append(message)
+                writer.close()
+                await writer.wait_closed()
+                done.set_result(messages)
+
+            server = await asyncio.start_server(leecher, '127.0.0.1', 0)
+            _, writer = await asyncio.open_connection(
+                *server.sockets[0].getsockname()[:2])
+            stats = TransferStats()
+            uploader = self.manager.uploader(
+                peer, OutgoingQueue(writer, stats), stats)
+            uploader.sendfile = sendfile
+            accepted = [uploader.request(*request) for request in requests]
+            for cancel in cancels:
+                uploader.cancel(*cancel)
+            if during:
+                await asyncio.sleep(0) # отдача ждёт чтения с диска
+                for message in during:
+                    uploader.outbox.send(message)
+            while uploader._task:
+                await asyncio.sleep(0.001)
+            uploader.outbox.flush()
+            writer.close()
+            await writer.wait_closed()
+            messages = await done
+            server.close()
+            await server.wait_closed()
+            return accepted, messages, stats
+
+        return asyncio.run(run())
+
+    def _block(self, index, begin, length=REQUEST_SIZE):
+        start = index * 2 * REQUEST_SIZE + begin
+        return self.data[start:start + length]
+
+    def test_blocks_from_files(self):
+        self.manager.recheck(workers=1)
+        requests = [(0, REQUEST_SIZE, REQUEST_SIZE), (0, 0, REQUEST_SIZE),
+                    (2, REQUEST_SIZE, 100)]
+        for sendfile in [True, False]:
+            with self.subTest(sendfile=sendfile):
+                accepted, messages, stats = self._upload(requests,
+                                                         sendfile=sendfile)
+                self.assertEqual([True] * 3, accepted)
+                self.assertEqual([self._block(*r) for r in requests],
+                                 [message.block for message in messages])
+                self.assertEqual(2 * REQUEST_SIZE + 100, stats.uploaded)
+                self.assertEqual(stats.uploaded + 3 * 13, stats.sent)
+        self.assertEqual(0, self.manager.read_cache.hits)
+
+    def test_message_during_read_keeps_block_whole(self):
+        self.manager.recheck(workers=1)
+        request = (0, 0, REQUEST_SIZE)
+        for sendfile in [True, False]:
+            with self.subTest(sendfile=sendfile):
+                _, messages, _ = self._upload([request], sendfile=sendfile,
+                                              during=[Have(2).encode()])
+                self.assertEqual([self._block(*request)],
+                                 [message.block for message in messages
+                                  if isinstance(message, Piece)])
+                self.assertEqual([2], [message.index for message in messages
+                                       if isinstance(message, Have)])
+
+    def test_piece_read_whole_for_second_peer(self):
+        self.manager.recheck(workers=1)
+        requests = [(1, 0, REQUEST_SIZE), (1, REQUEST_SIZE, REQUEST_SIZE)]
+        self._upload(requests, peer='a')
+        self.assertEqual(0, self.manager.read_cache.size)
+        _, messages, _ = self._upload(requests, peer='b')
+        self.assertEqual([self._block(*r) for r in requests],
+                         [message.block for message in messages])
+        self.assertEqual(2 * REQUEST_SIZE, self.manager.read_cache.size)
+        self.assertEqual(1, self.manager.read_cache.hits)
+
+    def test_invalid_and_cancelled_requests(self):
+        self.manager.recheck(workers=1)
+        # нет куска, блок длиннее MAX_BLOCK, блок за концом короткого куска
+        accepted, messages, _ = self._upload(
+            [(3, 0, REQUEST_SIZE), (0, 0, 2**18), (2, REQUEST_SIZE, 200),
+             (0, 0, 10), (0, 10, 10)],
+            cancels=[(0, 0, 10), (0, 0, 20)])
+        self.assertEqual([False, False, False, True, True], accepted)
+        self.assertEqual([self._block(0, 10, 10)],
+                         [message.block for message in messages])
+
+    def test_written_piece_is_cached_and_announced(self):
+        self.manager.recheck(workers=1)
+        announced = []
+        self.manager.subscribe('peer', announced.append)
+        self.manager.have_pieces.discard(1)
+        self.assertEqual(b'\xa0', self.manager.bitfield())
+        self.manager.have_pieces.add(1)
+        self.manager._piece_written(1, self._block(1, 0, 2 * REQUEST_SIZE))
+        self.assertEqual([1], announced)
+        self.assertEqual(b'\xe0', self.manager.bitfield())
+
+        requests = [(1, 0, REQUEST_SIZE), (1, REQUEST_SIZE, REQUEST_SIZE)]
+        _, messages, _ = self._upload(requests, cancels=[requests[1]])
+        self.assertEqual([self._block(1, 0)],
+                         [message.block for message in messages])
+        self.assertEqual(1, self.manager.read_cache.hits)
+
+        # кусок 0 задевает пропускаемый файл b, которого может не быть на диске
+        self.manager.set_file_priority(1, 0)
+        self.assertFalse(self.manager.can_upload(0))
+        self.assertEqual(b'\x00', self.manager.bitfield())
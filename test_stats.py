@@ -0,0 +1,44 @@
+import unittest
+
+from stats import RateMeter, TransferStats
+
+
+class RateMeterTests(unittest.TestCase):
+    def test_converges_to_steady_rate(self):
+        meter = RateMeter(half_life=1.0, tick=0.5, now=0)
+        for step in range(1, 201):
+            meter.add(1000, step * 0.1) # 10 000 байт в секунду
+        self.assertAlmostEqual(10000, meter.rate(20.0), delta=100)
+
+    def test_decays_when_idle(self):
+        meter = RateMeter(half_life=1.0, tick=0.5, now=0)
+        for step in range(1, 101):
+            meter.add(1000, step * 0.1)
+        busy = meter.rate(10.0)
+        # за каждую секунду простоя оценка уменьшается примерно вдвое
+        self.assertLess(meter.rate(12.0), busy * 0.4)
+        self.assertLess(meter.rate(30.0), 1)
+
+    def test_rate_within_tick_is_cached(self):
+        meter = RateMeter(tick=0.5, now=0)
+        meter.add(1000, 0.6)
+        rate = meter.rate(0.7)
+        meter.add(1000, 0.8)
+        self.assertEqual(rate, meter.rate(0.9))
+
+
+class TransferStatsTests(unittest.TestCase):
+    def test_connection_counts_roll_up_to_torrent(self):
+        torrent = TransferStats()
+        first, second = TransferStats(torrent), TransferStats(torrent)
+        first.wire_in(100 + 13)
+        first.payload_in(100)
+        second.wire_out(17)
+        second.payload_out(0)
+        second.waste(5)
+        self.assertEqual((100, 113, 13), (first.downloaded, first.received,
+                                          first.protocol_received))
+        self.assertEqual((100, 113, 17, 5), (torrent.downloaded,
+                                             torrent.received, torrent.sent,
+                                             torrent.wasted))
+        self.assertEqual(17, torrent.protocol_sent)
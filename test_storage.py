@@ -0,0 +1,123 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage import FileStorage, StorageWriter, SKIP
+from torrent import TorrentFile
+
+
+class FileStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = [TorrentFile(os.path.join('t', 'a'), 10),
+                      TorrentFile(os.path.join('t', 'empty'), 0),
+                      TorrentFile(os.path.join('t', 'b'), 5),
+                      TorrentFile(os.path.join('t', 'c'), 20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_spans(self):
+        storage = FileStorage(self.files, self.root)
+        self.assertEqual([(0, 2, 8), (2, 0, 5), (3, 0, 3)],
+                         list(storage.spans(2, 16)))
+        self.assertEqual([(3, 19, 1)], list(storage.spans(34, 1)))
+        self.assertEqual([(2, 0, 5)], list(storage.spans(10, 5)))
+        storage.close()
+
+    def test_write_and_read_across_files(self):
+        storage = FileStorage(self.files, self.root)
+        data = bytes(range(35))
+        storage.write(0, data[:12])
+        storage.write(12, data[12:])
+        self.assertEqual(data[8:20], storage.read(8, 12))
+        storage.close()
+
+        with open(os.path.join(self.root, 't', 'b'), 'rb') as f:
+            self.assertEqual(data[10:15], f.read())
+        self.assertTrue(os.path.exists(os.path.join(self.root, 't', 'empty')))
+
+    def test_skipped_file_is_not_created(self):
+        storage = FileStorage(self.files, self.root,
+                              priorities=[1, 1, SKIP, 1])
+        storage.write(0, bytes(35))
+        storage.close()
+        self.assertFalse(os.path.exists(os.path.join(self.root, 't', 'b')))
+        self.assertEqual(20, os.path.getsize(os.path.join(self.root, 't', 'c')))
+
+    def test_writev_across_files(self):
+        storage = FileStorage(self.files, self.root)
+        data = bytes(range(35))
+        storage.writev(3, [data[3:6], bytearray(data[6:20]), data[20:35]])
+        self.assertEqual(data[3:], storage.read(3, 32))
+        storage.close()
+
+
+class StorageWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = FileStorage([TorrentFile('data', 64)], self.root)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.root)
+
+    def test_adjacent_pieces_are_merged(self):
+        writer = StorageWriter(self.storage)
+        for offset in [16, 0, 48, 8]:
+            writer._pending.append((offset, bytes(8), None, None))
+        runs, size, callbacks = writer._take_batch()
+        self.assertEqual(32, size)
+        self.assertEqual([], callbacks)
+        self.assertEqual([(0, 24), (48, 8)],
+                         [(offset, length) for offset, length, _ in runs])
+        writer.close()
+
+    def test_write_behind_with_backpressure(self):
+        data = bytes(range(64))
+
+        written = []
+
+        async def write():
+            writer = StorageWriter(self.storage, max_queued=16,
+                                   fsync_interval=0)
+            for offset in [32, 0, 48, 16]:
+                writer.submit(offset, data[offset:offset + 16],
+                              lambda offset=offset: written.append(offset))
+                self.assertTrue(writer.full)
+                await writer.wait_writable()
+            while writer.queued:
+                await asyncio.sleep(0.01)
+            writer.close()
+
+        asyncio.run(write())
+        self.assertEqual(data, self.storage.read(0, 64))
+        self.assertEqual([0, 16, 32, 48], sorted(written))
+
+    def test_failed_write_is_reported(self):
+        results = []
+
+        def fail(offset, buffers):
+            raise OSError(28, 'No space left on device')
+
+        async def write():
+            writer = StorageWriter(self.storage)
+            writer.submit(0, b'abc', lambda: results.append('done'),
+                          results.append)
+            while writer.queued:
+                await asyncio.sleep(0.01)
+            writer.close()
+
+        self.storage.writev = fail
+        with self.assertLogs(level='ERROR'):
+            asyncio.run(write())
+        self.assertEqual([28], [error.errno for error in results])
+
+    def test_submit_without_loop_writes_immediately(self):
+        writer = StorageWriter(self.storage)
+        writer.submit(0, b'abc')
+        self.assertEqual(0, writer.queued)
+        self.assertEqual(b'abc', self.storage.read(0, 3))
+        writer.close()
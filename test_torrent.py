@@ -0,0 +1,50 @@
+import unittest
+
+import os
+
+from torrent import PieceHashes, Torrent, TorrentFile, torrent_files
+
+
+class PieceHashesTests(unittest.TestCase):
+    def test_hash_at(self):
+        data = b'a' * 20 + b'b' * 20 + b'c' * 20
+        hashes = PieceHashes(data)
+        self.assertEqual(3, len(hashes))
+        self.assertEqual(b'b' * 20, hashes.hash_at(1))
+        self.assertEqual(b'c' * 20, hashes[-1])
+        self.assertEqual([b'a' * 20, b'b' * 20, b'c' * 20], list(hashes))
+        self.assertEqual(data, hashes.tobytes())
+
+    def test_out_of_range(self):
+        hashes = PieceHashes(b'a' * 20)
+        with self.assertRaises(IndexError):
+            hashes.hash_at(1)
+
+    def test_bad_length(self):
+        with self.assertRaises(ValueError):
+            PieceHashes(b'a' * 21)
+
+    def test_torrent_pieces_is_cached(self):
+        torrent = Torrent('windows_10_pro_64bit_fleshka.torrent')
+        self.assertIs(torrent.pieces, torrent.pieces)
+        data = torrent.meta_info[b'info'][b'pieces']
+        self.assertEqual(len(data) // 20, len(torrent.pieces))
+        self.assertEqual(data[20:40], torrent.pieces.hash_at(1))
+
+
+class TorrentFilesTests(unittest.TestCase):
+    def test_multi_file_under_name(self):
+        info = {b'name': b'dir', b'files': [
+            {b'path': [b'a'], b'length': 1},
+            {b'path': [b'sub', b'b'], b'length': 2}]}
+        self.assertEqual([TorrentFile(os.path.join('dir', 'a'), 1),
+                          TorrentFile(os.path.join('dir', 'sub', 'b'), 2)],
+                         torrent_files(info))
+
+    def test_unsafe_paths(self):
+        for info in [{b'name': b'..', b'length': 1},
+                     {b'name': b'/etc/passwd', b'length': 1},
+                     {b'name': b'dir', b'files': [
+                         {b'path': [b'..', b'x'], b'length': 1}]}]:
+            with self.subTest(info=info), self.assertRaises(RuntimeError):
+                torrent_files(info)
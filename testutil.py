@@ -0,0 +1,87 @@
+"""
+Общие заготовки для тестов и замеров: торрент без .torrent файла,
+PieceManager над файлами во временном каталоге и локальный пир-сид.
+"""
+import asyncio
+import os
+import shutil
+import struct
+import tempfile
+from collections import namedtuple
+from hashlib import sha1
+
+from piece import PieceManager
+from protocol import BitField, ClientHandshake, Piece, Unchoke
+from torrent import PieceHashes, TorrentFile
+
+FakeTorrent = namedtuple('FakeTorrent', ['files', 'piece_length', 'pieces'])
+
+
+def piece_hashes(data, piece_length: int) -> PieceHashes:
+    return PieceHashes(b''.join(sha1(data[i:i + piece_length]).digest()
+                                for i in range(0, len(data), piece_length)))
+
+
+def temp_manager(test, data, piece_length: int, split=(), hashes=None,
+                 write: bool = False, **kwargs) -> PieceManager:
+    """
+    PieceManager торрента с содержимым data во временном каталоге,
+    который вместе с менеджером закрывается после теста.
+
+    :param test: unittest.TestCase, на котором регистрируется очистка
+    :param split: смещения в data, на которых начинается следующий файл
+    :param hashes: хэши кусков, по умолчанию верные хэши data
+    :param write: сразу записать data в файлы
+    :param kwargs: остальные параметры PieceManager
+    """
+    root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, root)
+    bounds = [0, *split, len(data)]
+    files = []
+    for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        path = os.path.join(root, 'file{0}'.format(i))
+        if write:
+            with open(path, 'wb') as f:
+                f.write(data[start:end])
+        files.append(TorrentFile(path, end - start))
+    manager = PieceManager(FakeTorrent(
+        files, piece_length,
+        hashes if hashes is not None else piece_hashes(data, piece_length)),
+        **kwargs)
+    test.addCleanup(manager.close)
+    return manager
+
+
+def seed_server(info_hash, pieces, connections, rtt=0.0, bandwidth=None):
+    """
+    Обработчик asyncio.start_server - пир-сид: рукопожатие, BitField со
+    всеми кусками, Unchoke, затем ответ на каждый Request через rtt секунд
+    со скоростью не больше bandwidth байт в секунду (None - без предела).
+    Писатели соединений складываются в connections.
+    """
+    async def serve(reader, writer):
+        connections.append(writer)
+        await reader.readexactly(ClientHandshake.length)
+        writer.write(ClientHandshake(info_hash, b'-BM0001-000000000000')
+                     .encode())
+        bitfield = bytes([0xff]) * -(-pieces // 8)
+        writer.write(BitField(bitfield).encode())
+        writer.write(Unchoke().encode())
+        loop = asyncio.get_running_loop()
+        free = loop.time()
+        try:
+            while True:
+                length = struct.unpack('>I', await reader.readexactly(4))[0]
+                message = await reader.readexactly(length)
+                if length and message[0] == 6: # Request
+                    index, begin, size = struct.unpack('>III', message[1:])
+                    data = Piece(index, begin, bytes(size)).encode()
+                    if bandwidth is None:
+                        writer.write(data)
+                        continue
+                    free = max(loop.time() + rtt, free) + size / bandwidth
+                    loop.call_at(free, writer.write, data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    return serve
@@ -1,8 +1,72 @@
+import os
 from hashlib import sha1
 from collections import namedtuple
-from decoder import Decoder, Encoder
+from decoder import ViewDecoder
 TorrentFile = namedtuple('TorrentFile', ['name', 'length'])
 
+HASH_LENGTH = 20 # длина SHA1 хэша одного куска
+
+
+class PieceHashes:
+    """
+    Неизменяемая таблица хэшей кусков поверх исходной строки pieces.
+    Хэши не нарезаются заранее: hash_at(i) возвращает memoryview на
+    20 байт внутри исходных данных.
+    """
+    def __init__(self, data: bytes):
+        if len(data) % HASH_LENGTH:
+            raise ValueError('Pieces length {0} is not a multiple of {1}'
+                             .format(len(data), HASH_LENGTH))
+        self._view = memoryview(data).toreadonly()
+        self._count = len(data) // HASH_LENGTH
+
+    def hash_at(self, index: int) -> memoryview:
+        if not 0 <= index < self._count:
+            raise IndexError('Piece index {0} out of range'.format(index))
+        offset = index * HASH_LENGTH
+        return self._view[offset:offset + HASH_LENGTH]
+
+    def tobytes(self) -> bytes:
+        """
+        Все хэши одной строкой, например чтобы передать их в другой процесс
+        """
+        return self._view.tobytes()
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index: int) -> memoryview:
+        if index < 0:
+            index += self._count
+        return self.hash_at(index)
+
+    def __iter__(self):
+        for offset in range(0, self._count * HASH_LENGTH, HASH_LENGTH):
+            yield self._view[offset:offset + HASH_LENGTH]
+
+
+def _safe_part(part: bytes) -> str:
+    name = part.decode('utf-8')
+    if name in ('', '.', '..') or os.sep in name or \
+            (os.altsep and os.altsep in name):
+        raise RuntimeError('Unsafe file path in torrent: {0!r}'.format(name))
+    return name
+
+
+def torrent_files(info: dict) -> list:
+    """
+    Файлы торрента по словарю info. Имя торрента и каждая часть пути
+    проверяются: выйти за каталог раздачи через них нельзя
+    """
+    name = _safe_part(info[b'name'])
+    if b'files' not in info:
+        return [TorrentFile(name, info[b'length'])]
+    # Files of a multi-file torrent live in a directory named after
+    # the torrent, each under its own list of path components
+    return [TorrentFile(os.path.join(name, *map(_safe_part, f[b'path'])),
+                        f[b'length'])
+            for f in info[b'files']]
+
 
 class Torrent:
 
@@ -15,22 +79,21 @@ class Torrent:
 
         with open(self.filename, 'rb') as f:
             meta_info = f.read()
-            self.meta_info = Decoder(meta_info).decode()
-            info = Encoder(self.meta_info[b'info']).encode()
-            self.info_hash = sha1(info).digest()
+            decoder = ViewDecoder(meta_info)
+            self.meta_info = decoder.decode()
+            # хэш считается по исходным байтам info, а не по повторно
+            # закодированному словарю - так он верен и для
+            # неканонически упорядоченных info
+            start, end = decoder.spans[b'info']
+            self.info_hash = sha1(decoder.view[start:end]).digest()
+            self._pieces = PieceHashes(self.meta_info[b'info'][b'pieces'])
             self._identify_files()
 
     def _identify_files(self):
         """
         Identifies the files included in this torrent
         """
-        if self.multi_file:
-            # TODO Add support for multi-file torrents
-            raise RuntimeError('Multi-file torrents is not supported!')
-        self.files.append(
-            TorrentFile(
-                self.meta_info[b'info'][b'name'].decode('utf-8'),
-                self.meta_info[b'info'][b'length']))
+        self.files.extend(torrent_files(self.meta_info[b'info']))
 
     @property
     def announce(self) -> str:
@@ -63,24 +126,14 @@ class Torrent:
 
         :return: The total size (in bytes) for this torrent's data.
         """
-        if self.multi_file:
-            raise RuntimeError('Multi-file torrents is not supported!')
-        return self.files[0].length
+        return sum(f.length for f in self.files)
 
     @property
-    def pieces(self):
+    def pieces(self) -> PieceHashes:
         # The info pieces is a string representing all pieces SHA1 hashes
-        # (each 20 bytes long). Read that data and slice it up into the
-        # actual pieces
-        data = self.meta_info[b'info'][b'pieces']
-        pieces = []
-        offset = 0
-        length = len(data)
-
-        while offset < length:
-            pieces.append(data[offset:offset + 20])
-            offset += 20
-        return pieces
+        # (each 20 bytes long). The table is built once and indexes that
+        # data in place
+        return self._pieces
 
     @property
     def output_file(self):
@@ -91,6 +144,6 @@ class Torrent:
                'File length: {1}\n' \
                'Announce URL: {2}\n' \
                'Hash: {3}'.format(self.meta_info[b'info'][b'name'],
-                                  self.meta_info[b'info'][b'length'],
+                                  self.total_size,
                                   self.meta_info[b'announce'],
                                   self.info_hash)
@@ -8,6 +8,8 @@ import socket
 from struct import unpack
 from urllib.parse import urlencode
 
+FAILURE_REASON = b'failure reason' # ключ ответа трекера с текстом ошибки
+
 
 class TrackerResponse:
 
@@ -18,8 +20,8 @@ class TrackerResponse:
     @property
     def fail(self):
 
-        if b'fail reason' in self.response:
-            return self.response[b'fail reason'].decode('utf-8')
+        if FAILURE_REASON in self.response:
+            return self.response[FAILURE_REASON].decode('utf-8', 'replace')
         return None
 
     @property
@@ -41,18 +43,7 @@ class TrackerResponse:
     def peers(self):
 
 
-        peers = self.response[b'peers']
-        if type(peers) == list:
-            logging.debug('Dictionary model peers are returned by tracker')
-            raise NotImplementedError()
-        else:
-            logging.debug('Binary model peers are returned by tracker')
-
-
-            peers = [peers[i:i+6] for i in range(0, len(peers), 6)]
-
-            return [(socket.inet_ntoa(p[:4]), _decode_port(p[4:]))
-                    for p in peers]
+        return _decode_peers(self.response[b'peers'])
 
     def __str__(self):
         return "incomplete: {incomplete}\n" \
@@ -76,7 +67,10 @@ class Tracker:
     async def connect(self,
                       first: bool = None,
                       uploaded: int = 0,
-                      downloaded: int = 0):
+                      downloaded: int = 0,
+                      on_peers=None,
+                      left: int = None,
+                      completed: bool = False):
 
         params = {
             'info_hash': self.torrent.info_hash,
@@ -84,10 +78,13 @@ class Tracker:
             'port': 6889,
             'uploaded': uploaded,
             'downloaded': downloaded,
-            'left': self.torrent.total_size - downloaded,
+            'left': self.torrent.total_size - downloaded if left is None
+                    else left,
             'compact': 1}
         if first:
             params['event'] = 'started'
+        elif completed: # торрент только что скачан
+            params['event'] = 'completed'
 
         url = self.torrent.announce + '?' + urlencode(params)
         logging.info('Connecting to tracker at: ' + url)
@@ -95,24 +92,22 @@ class Tracker:
         async with self.http_client.get(url) as response:
             if not response.status == 200:
                 raise ConnectionError('Unable to connect to tracker: status code {}'.format(response.status))
-            data = await response.read()
-            self.raise_for_error(data)
-            return TrackerResponse(bencoding.Decoder(data).decode())
+            # Разбираем ответ по мере получения: список пиров отдаём
+            # в on_peers, не дожидаясь конца тела ответа
+            decoder = StreamDecoder()
+            async for chunk in response.content.iter_any():
+                for key, value in decoder.feed(chunk):
+                    if key == FAILURE_REASON:
+                        raise ConnectionError('Unable to connect to tracker: {}'.format(value.decode('utf-8', 'replace')))
+                    if key == b'peers' and on_peers:
+                        on_peers(_decode_peers(value))
+                if decoder.done:
+                    break
+            return TrackerResponse(decoder.close())
 
     def close(self):
         self.http_client.close()
 
-    def raise_for_error(self, tracker_response):
-
-        try:
-
-            message = tracker_response.decode("utf-8")
-            if "fail" in message:
-                raise ConnectionError('Unable to connect to tracker: {}'.format(message))
-
-        except UnicodeDecodeError:
-            pass
-
     def _construct_tracker_parameters(self):
 
         return {
@@ -131,6 +126,19 @@ def _calculate_peer_id():
         [str(random.randint(0, 9)) for _ in range(12)])
 
 
+def _decode_peers(peers):
+
+    if type(peers) == list:
+        logging.debug('Dictionary model peers are returned by tracker')
+        raise NotImplementedError()
+    logging.debug('Binary model peers are returned by tracker')
+
+    peers = [peers[i:i+6] for i in range(0, len(peers), 6)]
+
+    return [(socket.inet_ntoa(p[:4]), _decode_port(p[4:]))
+            for p in peers]
+
+
 def _decode_port(port):
 
     return unpack(">H", port)[0]